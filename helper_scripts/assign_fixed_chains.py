@@ -3,16 +3,17 @@ import argparse
 
 def main(args):
     import json
+    import os
+    import sys
 
-    with open(args.input_path) as json_file:
-        json_list = list(json_file)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils import read_parsed_pdbs
 
     global_designed_chain_list = []
     if args.chain_list != "":
         global_designed_chain_list = [str(item) for item in args.chain_list.split()]
     my_dict = {}
-    for json_str in json_list:
-        result = json.loads(json_str)
+    for result in read_parsed_pdbs(args.input_path):
         all_chain_list = [
             item[-1:] for item in list(result) if item[:9] == "seq_chain"
         ]  # ['A','B', 'C',...]
@@ -0,0 +1,203 @@
+import argparse
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def main(args):
+    import os
+    import sys
+    import time
+
+    import numpy as np
+    import torch
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils import ProteinMPNN, StructureDataset, _scores, tied_featurize
+
+    logging.basicConfig(
+        encoding="utf-8",
+        level=logging.INFO,
+        format="%(message)s",
+    )
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    checkpoint = torch.load(args.checkpoint, map_location=device)
+    model = ProteinMPNN(
+        ca_only=args.ca_only,
+        num_letters=21,
+        node_features=128,
+        edge_features=128,
+        hidden_dim=128,
+        num_encoder_layers=3,
+        num_decoder_layers=3,
+        augment_eps=0.0,
+        k_neighbors=checkpoint["num_edges"],
+    )
+    model.to(device)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    model.eval()
+
+    dataset = StructureDataset(args.jsonl_path, max_length=args.max_length)
+    num_batches = max(1, args.num_samples // args.batch_size)
+    results = {"standard": [], "parallel": []}
+    with torch.no_grad():
+        for protein in dataset:
+            (
+                X,
+                S,
+                mask,
+                _,
+                chain_M,
+                chain_encoding_all,
+                _,
+                _,
+                _,
+                _,
+                chain_M_pos,
+                omit_AA_mask,
+                residue_idx,
+                _,
+                _,
+                pssm_coef,
+                pssm_bias,
+                _,
+                bias_by_res,
+                _,
+            ) = tied_featurize(
+                [protein],
+                device,
+                None,
+                ca_only=args.ca_only,
+                num_copies=args.batch_size,
+            )
+            encoding = model.encode(X, mask, residue_idx, chain_encoding_all)
+            mask_for_loss = mask * chain_M * chain_M_pos
+            for mode in results:
+                start = time.time()
+                num_steps, scores, recovery = [], [], []
+                for _ in range(num_batches):
+                    randn = torch.randn(chain_M.shape, device=device)
+                    sample_dict = model.sample(
+                        X,
+                        randn,
+                        S,
+                        chain_M,
+                        chain_encoding_all,
+                        residue_idx,
+                        mask=mask,
+                        temperature=args.sampling_temp,
+                        omit_AAs_np=np.zeros(21),
+                        bias_AAs_np=np.zeros(21),
+                        chain_M_pos=chain_M_pos,
+                        omit_AA_mask=omit_AA_mask,
+                        pssm_coef=pssm_coef,
+                        pssm_bias=pssm_bias,
+                        pssm_multi=0.0,
+                        pssm_log_odds_flag=False,
+                        pssm_log_odds_mask=None,
+                        pssm_bias_flag=False,
+                        bias_by_res=bias_by_res,
+                        encoding=encoding,
+                        parallel_decoding=mode == "parallel",
+                    )
+                    S_sample = sample_dict["S"]
+                    log_probs = model(
+                        X,
+                        S_sample,
+                        mask,
+                        chain_M * chain_M_pos,
+                        residue_idx,
+                        chain_encoding_all,
+                        randn,
+                        use_input_decoding_order=True,
+                        decoding_order=sample_dict["decoding_order"],
+                        encoding=encoding,
+                    )
+                    num_steps.append(sample_dict["num_steps"])
+                    scores.append(_scores(S_sample, log_probs, mask_for_loss))
+                    recovery.append(
+                        torch.sum((S_sample == S) * mask_for_loss, -1)
+                        / torch.sum(mask_for_loss, -1)
+                    )
+                results[mode].append(
+                    {
+                        "name": protein["name"],
+                        "length": int(mask[0].sum()),
+                        "time": time.time() - start,
+                        "num_steps": float(np.mean(num_steps)),
+                        "score": torch.cat(scores).cpu().numpy(),
+                        "recovery": torch.cat(recovery).cpu().numpy(),
+                    }
+                )
+
+    logger.info(
+        "%-12s%8s%10s%8s%10s%16s%16s",
+        "name",
+        "length",
+        "mode",
+        "steps",
+        "time [s]",
+        "score",
+        "recovery",
+    )
+    for standard, parallel in zip(
+        results["standard"], results["parallel"], strict=True
+    ):
+        for mode, row in (("standard", standard), ("parallel", parallel)):
+            logger.info(
+                "%-12s%8d%10s%8.0f%10.2f%10.4f ±%.3f%10.4f ±%.3f",
+                row["name"],
+                row["length"],
+                mode,
+                row["num_steps"],
+                row["time"],
+                row["score"].mean(),
+                row["score"].std(),
+                row["recovery"].mean(),
+                row["recovery"].std(),
+            )
+    for mode, rows in results.items():
+        score = np.concatenate([row["score"] for row in rows])
+        recovery = np.concatenate([row["recovery"] for row in rows])
+        logger.info(
+            "%s: %.2f s, score mean %.4f median %.4f, recovery mean %.4f median %.4f",
+            mode,
+            sum(row["time"] for row in rows),
+            score.mean(),
+            np.median(score),
+            recovery.mean(),
+            np.median(recovery),
+        )
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    argparser.add_argument(
+        "--jsonl_path", type=str, help="Path to the parsed PDBs to design"
+    )
+    argparser.add_argument(
+        "--checkpoint", type=str, help="Path to the model weights, e.g. v_48_020.pt"
+    )
+    argparser.add_argument(
+        "--ca_only", action="store_true", default=False, help="CA-only model weights"
+    )
+    argparser.add_argument(
+        "--num_samples", type=int, default=32, help="Sequences per target and mode"
+    )
+    argparser.add_argument(
+        "--batch_size", type=int, default=8, help="Sequences sampled at once"
+    )
+    argparser.add_argument(
+        "--sampling_temp", type=float, default=0.1, help="Sampling temperature"
+    )
+    argparser.add_argument(
+        "--max_length", type=int, default=200000, help="Max sequence length"
+    )
+    argparser.add_argument("--seed", type=int, default=37, help="Random seed")
+
+    args = argparser.parse_args()
+    main(args)
@@ -0,0 +1,43 @@
+import argparse
+
+
+def main(args):
+    import json
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils import StructureStoreWriter
+
+    with (
+        open(args.input_path) as json_file,
+        StructureStoreWriter(args.output_path, ca_only=args.ca_only) as writer,
+    ):
+        for json_str in json_file:
+            writer.add(json.loads(json_str))
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    argparser.add_argument(
+        "--input_path",
+        type=str,
+        help="Path to the parsed PDBs in .jsonl format",
+    )
+    argparser.add_argument(
+        "--output_path",
+        type=str,
+        help="Directory where to save the binary structure store",
+    )
+    argparser.add_argument(
+        "--ca_only",
+        action="store_true",
+        default=False,
+        help="the parsed PDBs are backbone-only structures (default: false)",
+    )
+
+    args = argparser.parse_args()
+    main(args)
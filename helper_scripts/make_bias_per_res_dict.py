@@ -3,9 +3,14 @@ import argparse
 
 def main(args):
     import json
+    import os
+    import sys
 
     import numpy as np
 
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils import read_parsed_pdbs
+
     mpnn_alphabet = "ACDEFGHIKLMNPQRSTVWYX"
 
     mpnn_alphabet_dict = {
@@ -32,12 +37,8 @@ def main(args):
         "X": 20,
     }
 
-    with open(args.input_path) as json_file:
-        json_list = list(json_file)
-
     my_dict = {}
-    for json_str in json_list:
-        result = json.loads(json_str)
+    for result in read_parsed_pdbs(args.input_path):
         all_chain_list = [
             item[-1:] for item in list(result) if item[:10] == "seq_chain_"
         ]
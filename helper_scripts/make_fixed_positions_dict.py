@@ -3,11 +3,13 @@ import argparse
 
 def main(args):
     import json
+    import os
+    import sys
 
     import numpy as np
 
-    with open(args.input_path) as json_file:
-        json_list = list(json_file)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils import read_parsed_pdbs
 
     fixed_list = [
         [int(item) for item in one.split()] for one in args.position_list.split(",")
@@ -16,8 +18,7 @@ def main(args):
     my_dict = {}
 
     if not args.specify_non_fixed:
-        for json_str in json_list:
-            result = json.loads(json_str)
+        for result in read_parsed_pdbs(args.input_path):
             all_chain_list = [
                 item[-1:] for item in list(result) if item[:9] == "seq_chain"
             ]
@@ -29,8 +30,7 @@ def main(args):
                     fixed_position_dict[chain] = []
             my_dict[result["name"]] = fixed_position_dict
     else:
-        for json_str in json_list:
-            result = json.loads(json_str)
+        for result in read_parsed_pdbs(args.input_path):
             all_chain_list = [
                 item[-1:] for item in list(result) if item[:9] == "seq_chain"
             ]
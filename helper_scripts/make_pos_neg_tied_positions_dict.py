@@ -3,9 +3,11 @@ import argparse
 
 def main(args):
     import json
+    import os
+    import sys
 
-    with open(args.input_path) as json_file:
-        json_list = list(json_file)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils import read_parsed_pdbs
 
     homooligomeric_state = args.homooligomer
 
@@ -15,8 +17,7 @@ def main(args):
         ]
         global_designed_chain_list = [str(item) for item in args.chain_list.split()]
         my_dict = {}
-        for json_str in json_list:
-            result = json.loads(json_str)
+        for result in read_parsed_pdbs(args.input_path):
             all_chain_list = sorted(
                 [item[-1:] for item in list(result) if item[:9] == "seq_chain"]
             )  # A, B, C, ...
@@ -45,8 +46,7 @@ def main(args):
                 zip(chain_list_flat, chain_betas_flat, strict=False)
             )
         my_dict = {}
-        for json_str in json_list:
-            result = json.loads(json_str)
+        for result in read_parsed_pdbs(args.input_path):
             all_chain_list = sorted(
                 [item[-1:] for item in list(result) if item[:9] == "seq_chain"]
             )  # A, B, C, ...
@@ -3,15 +3,16 @@ import argparse
 
 def main(args):
     import json
+    import os
+    import sys
 
     import numpy as np
 
-    with open(args.jsonl_input_path) as json_file:
-        json_list = list(json_file)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils import read_parsed_pdbs
 
     my_dict = {}
-    for json_str in json_list:
-        result = json.loads(json_str)
+    for result in read_parsed_pdbs(args.jsonl_input_path):
         all_chain_list = [item[-1:] for item in list(result) if item[:9] == "seq_chain"]
         path_to_PSSM = args.PSSM_input_path + "/" + result["name"] + ".npz"
         print(path_to_PSSM)
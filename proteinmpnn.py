@@ -1,5 +1,5 @@
 import argparse
-import copy
+import contextlib
 import json
 import logging
 import os
@@ -11,11 +11,17 @@ import numpy as np
 import torch
 
 from utils import (
+    EncoderCache,
     ProteinMPNN,
+    ResultCache,
     StructureDataset,
     StructureDatasetPDB,
+    StructureLoader,
     _S_to_seq,
     _scores,
+    distinct_rows,
+    iter_fasta,
+    mutational_scan,
     parse_fasta,
     parse_PDB,
     tied_featurize,
@@ -23,6 +29,156 @@ from utils import (
 
 logger = logging.getLogger(__name__)
 
+# Paths whose contents, rather than names, determine the outputs of a run
+INPUT_PATH_ARGS = [
+    "jsonl_path",
+    "pdb_path",
+    "chain_id_jsonl",
+    "fixed_positions_jsonl",
+    "pssm_jsonl",
+    "omit_AA_jsonl",
+    "bias_AA_jsonl",
+    "bias_by_res_jsonl",
+    "tied_positions_jsonl",
+    "constraint_variants_jsonl",
+    "path_to_fasta",
+]
+
+# Options that do not change the output files
+NON_OUTPUT_ARGS = [
+    "out_folder",
+    "suppress_print",
+    "lazy_jsonl",
+    "path_to_model_weights",
+    "encoder_cache_dir",
+    "encoder_cache_size",
+    "result_cache_dir",
+    "result_cache_size",
+]
+
+
+def result_cache_inputs(args, checkpoint_path):
+    """
+    Everything that determines the output files of a run with a fixed seed.
+
+    Input files and the checkpoint are represented by digests of their contents,
+    so renamed or copied inputs map to the same cache entry.
+    """
+    inputs = {k: v for k, v in vars(args).items() if k not in NON_OUTPUT_ARGS}
+    for k in INPUT_PATH_ARGS:
+        inputs[k] = ResultCache.path_digest(inputs[k])
+    inputs["checkpoint"] = ResultCache.path_digest(checkpoint_path)
+    inputs["torch_version"] = torch.__version__
+    inputs["device"] = "cuda" if torch.cuda.is_available() else "cpu"
+    return inputs
+
+
+def score_only_sequences(S, path_to_fasta, alphabet_dict, names):
+    """
+    Yields the structure sequence ``S`` and then the sequences of a FASTA file,
+    appending each FASTA header to ``names`` when its sequence is read.
+    """
+    yield S
+    if path_to_fasta:
+        for header, seq in iter_fasta(path_to_fasta, omit=["/"]):
+            names.append(header)
+            yield [alphabet_dict[AA] for AA in seq]
+
+
+def sample_batch(
+    model,
+    args,
+    inputs,
+    temperature,
+    omit_AAs_np,
+    bias_AAs_np,
+    randn,
+    num_stacked=1,
+):
+    """
+    Samples sequences for a featurized batch and scores them.
+
+    ``inputs`` holds the featurized tensors and the encoding, plus ``tied_pos``
+    and ``tied_beta`` for tied positions. With ``num_stacked > 1`` every row is
+    repeated that many times, e.g. to sample one temperature per copy in a single
+    call. Returns the sequences, the sampling probabilities and the log
+    probabilities the sequences are scored with.
+    """
+
+    def rows(x):
+        if num_stacked == 1 or x is None:
+            return x
+        return x.repeat(num_stacked, *[1] * (x.dim() - 1))
+
+    encoding = inputs["encoding"]
+    if encoding is not None:
+        encoding = {k: rows(v) for k, v in encoding.items()}
+    X, S, mask, chain_M, chain_M_pos, chain_encoding_all, residue_idx = (
+        rows(inputs[k])
+        for k in (
+            "X",
+            "S",
+            "mask",
+            "chain_M",
+            "chain_M_pos",
+            "chain_encoding_all",
+            "residue_idx",
+        )
+    )
+    common = {
+        "mask": mask,
+        "temperature": temperature,
+        "omit_AAs_np": omit_AAs_np,
+        "bias_AAs_np": bias_AAs_np,
+        "chain_M_pos": chain_M_pos,
+        "omit_AA_mask": rows(inputs["omit_AA_mask"]),
+        "pssm_coef": rows(inputs["pssm_coef"]),
+        "pssm_bias": rows(inputs["pssm_bias"]),
+        "pssm_multi": args.pssm_multi,
+        "pssm_log_odds_flag": bool(args.pssm_log_odds_flag),
+        "pssm_log_odds_mask": rows(inputs["pssm_log_odds_mask"]),
+        "pssm_bias_flag": bool(args.pssm_bias_flag),
+        "bias_by_res": rows(inputs["bias_by_res"]),
+        "encoding": encoding,
+        "context_chunk_size": args.context_chunk_size or None,
+    }
+    sample_args = (X, randn, S, chain_M, chain_encoding_all, residue_idx)
+    # Tied designs, and designs on a noised backbone, are scored by another
+    # forward pass, which draws new backbone noise
+    rescore = "tied_pos" in inputs or args.backbone_noise > 0
+    if "tied_pos" not in inputs:
+        sample_dict = model.sample(
+            *sample_args,
+            **common,
+            parallel_decoding=bool(args.parallel_decoding),
+            return_log_probs=not rescore,
+        )
+    else:
+        sample_dict = model.tied_sample(
+            *sample_args,
+            **common,
+            tied_pos=inputs["tied_pos"],
+            tied_beta=inputs["tied_beta"],
+        )
+    if not rescore:
+        # Scored under the decoding order it was sampled with
+        log_probs = sample_dict["log_probs"]
+    else:
+        log_probs = model(
+            X,
+            sample_dict["S"],
+            mask,
+            chain_M * chain_M_pos,
+            residue_idx,
+            chain_encoding_all,
+            randn,
+            use_input_decoding_order=True,
+            decoding_order=sample_dict["decoding_order"],
+            encoding=encoding,
+            context_chunk_size=args.context_chunk_size or None,
+        )
+    return sample_dict["S"], sample_dict["probs"], log_probs
+
 
 def main(args):
     """ """
@@ -41,6 +197,50 @@ def main(args):
     random.seed(seed)
     np.random.seed(seed)
 
+    if args.local_design and (
+        args.ca_only
+        or args.backbone_noise > 0
+        or args.tied_positions_jsonl
+        or args.score_only
+        or args.conditional_probs_only
+        or args.unconditional_probs_only
+        or args.mutational_scan
+    ):
+        logger.error(
+            "--local-design only supports sequence design with a full backbone "
+            "model, no backbone noise and no tied positions"
+        )
+        sys.exit(1)
+    if args.pack_targets and (
+        args.score_only
+        or args.conditional_probs_only
+        or args.unconditional_probs_only
+        or args.mutational_scan
+        or args.local_design
+    ):
+        logger.error(
+            "--pack-targets only supports sequence design without --local-design"
+        )
+        sys.exit(1)
+    if args.constraint_variants_jsonl and (
+        args.score_only
+        or args.conditional_probs_only
+        or args.unconditional_probs_only
+        or args.mutational_scan
+        or args.local_design
+    ):
+        logger.error(
+            "--constraint-variants-jsonl only supports sequence design without "
+            "--local-design"
+        )
+        sys.exit(1)
+    if args.constraint_variants_jsonl and args.tied_positions_jsonl:
+        logger.error("--constraint-variants-jsonl does not support tied positions")
+        sys.exit(1)
+    if args.parallel_decoding and args.tied_positions_jsonl:
+        logger.error("--parallel-decoding does not support tied positions")
+        sys.exit(1)
+
     hidden_dim = 128
     num_layers = 3
 
@@ -74,6 +274,23 @@ def main(args):
     checkpoint_path = os.path.join(model_folder_path, f"{args.model_name}.pt")
     folder_for_outputs = args.out_folder
 
+    # With a fixed seed an identical run is answered from the result cache
+    # before any input is parsed or the model is loaded
+    result_cache = None
+    if args.result_cache_dir:
+        if args.seed:
+            result_cache = ResultCache(
+                args.result_cache_dir,
+                max_bytes=int(args.result_cache_size * 2**30),
+            )
+            result_key = result_cache.key(result_cache_inputs(args, checkpoint_path))
+            if result_cache.restore(result_key, folder_for_outputs):
+                logger.info("Outputs restored from the result cache")
+                return
+            outputs_before = result_cache.snapshot(folder_for_outputs)
+        else:
+            logger.warning("--result-cache-dir is ignored without a fixed --seed")
+
     NUM_BATCHES = args.num_seq_per_target // args.batch_size
     BATCH_COPIES = args.batch_size
 
@@ -152,6 +369,18 @@ def main(args):
         logger.debug("bias by residue dictionary is not loaded, or not provided")
         bias_by_res_dict = None
 
+    if os.path.isfile(args.constraint_variants_jsonl):
+        with open(args.constraint_variants_jsonl) as json_file:
+            json_list = list(json_file)
+
+        for json_str in json_list:
+            constraint_variants_dict = json.loads(json_str)
+
+        logger.debug("constraint variants dictionary is loaded")
+    else:
+        logger.debug("constraint variants dictionary is not loaded, or not provided")
+        constraint_variants_dict = None
+
     bias_AAs_np = np.zeros(len(alphabet))
 
     if bias_AA_dict:
@@ -185,6 +414,7 @@ def main(args):
             truncate=None,
             max_length=args.max_length,
             verbose=True,
+            lazy=bool(args.lazy_jsonl),
         )
 
     checkpoint = torch.load(checkpoint_path, map_location=device)
@@ -200,12 +430,27 @@ def main(args):
         num_decoder_layers=num_layers,
         augment_eps=args.backbone_noise,
         k_neighbors=checkpoint["num_edges"],
+        knn_block_size=args.knn_block_size or None,
+        factorized=bool(args.factorized_layers),
     )
 
     model.to(device)
     model.load_state_dict(checkpoint["model_state_dict"])
     model.eval()
 
+    encoder_cache = None
+    if args.encoder_cache_dir:
+        if args.backbone_noise == 0 and not args.local_design:
+            encoder_cache = EncoderCache(
+                args.encoder_cache_dir,
+                model,
+                max_bytes=int(args.encoder_cache_size * 2**30),
+            )
+        else:
+            logger.warning(
+                "--encoder-cache-dir is ignored with backbone noise or local design"
+            )
+
     logger.warning("Number of edges: %s", checkpoint["num_edges"])
     logger.warning("Training noise level: %sA", noise_level_print)
 
@@ -236,19 +481,116 @@ def main(args):
         if not os.path.exists(base_folder + "unconditional_probs_only"):
             os.makedirs(base_folder + "unconditional_probs_only")
 
+    if args.mutational_scan:
+        if not os.path.exists(base_folder + "mutational_scan"):
+            os.makedirs(base_folder + "mutational_scan")
+
     if args.save_probs:
         if not os.path.exists(base_folder + "probs"):
             os.makedirs(base_folder + "probs")
 
+    if constraint_variants_dict:
+        # Every constraint variant becomes a target of its own, <name>_<variant>,
+        # with its own chain and fixed position entries. The variants of a
+        # structure are batched together, one block of BATCH_COPIES rows each.
+        new_chain_id_dict = chain_id_dict is None
+        new_fixed_positions_dict = fixed_positions_dict is None
+        if new_chain_id_dict:
+            chain_id_dict = {}
+        if new_fixed_positions_dict:
+            fixed_positions_dict = {}
+        variant_groups = []
+        for protein in dataset_valid:
+            name = protein["name"]
+            all_chains = [item[-1:] for item in protein if item[:10] == "seq_chain_"]
+            if new_chain_id_dict:
+                chain_id_dict[name] = (all_chains, [])
+            if new_fixed_positions_dict:
+                fixed_positions_dict[name] = {letter: [] for letter in all_chains}
+            variants = constraint_variants_dict.get(name)
+            if not variants:
+                variant_groups.append([protein])
+                continue
+            designed_chains, fixed_chains = chain_id_dict[name]
+            group = []
+            for variant, constraints in variants.items():
+                variant_name = f"{name}_{variant}"
+                designed = list(constraints.get("designed_chains", designed_chains))
+                fixed = list(
+                    constraints.get(
+                        "fixed_chains",
+                        [
+                            letter
+                            for letter in designed_chains + fixed_chains
+                            if letter not in designed
+                        ],
+                    )
+                )
+                fixed_positions = constraints.get(
+                    "fixed_positions", fixed_positions_dict.get(name, {})
+                )
+                chain_id_dict[variant_name] = (designed, fixed)
+                fixed_positions_dict[variant_name] = {
+                    letter: fixed_positions.get(letter, []) for letter in designed
+                }
+                for constraint_dict in (omit_AA_dict, pssm_dict, bias_by_res_dict):
+                    if constraint_dict is not None and name in constraint_dict:
+                        constraint_dict[variant_name] = constraint_dict[name]
+                group.append(dict(protein, name=variant_name))
+            variant_groups.append(group)
+        dataset_valid = [protein for group in variant_groups for protein in group]
+
+    if args.pack_targets:
+        # Targets of similar length share a batch with BATCH_COPIES rows each.
+        # Only tied_sample handles tied positions, and it decodes every row in
+        # the order of the first one, so targets with tied positions keep a
+        # batch of their own.
+        proteins = list(dataset_valid)
+        is_tied = [
+            bool(tied_positions_dict and tied_positions_dict.get(protein["name"]))
+            for protein in proteins
+        ]
+        loader = StructureLoader(
+            [
+                protein
+                for protein, tied in zip(proteins, is_tied, strict=False)
+                if not tied
+            ],
+            batch_size=max(1, args.max_batch_residues // BATCH_COPIES),
+            shuffle=False,
+        )
+        target_batches = [
+            [protein] for protein, tied in zip(proteins, is_tied, strict=False) if tied
+        ] + list(loader)
+        logger.info(
+            "Packed %s targets into %s batches", len(proteins), len(target_batches)
+        )
+    elif constraint_variants_dict:
+        target_batches = [
+            batch
+            for group in variant_groups
+            for batch in StructureLoader(
+                group,
+                batch_size=max(1, args.max_batch_residues // BATCH_COPIES),
+                shuffle=False,
+            )
+        ]
+        logger.info(
+            "Batched %s constraint variants into %s batches",
+            len(dataset_valid),
+            len(target_batches),
+        )
+    else:
+        target_batches = ([protein] for protein in dataset_valid)
+
     # Validation epoch
     with torch.no_grad():
-        for ix, protein in enumerate(dataset_valid):
-            score_list = []
-            global_score_list = []
-            all_probs_list = []
-            all_log_probs_list = []
-            S_sample_list = []
-            batch_clones = [copy.deepcopy(protein) for i in range(BATCH_COPIES)]
+        for ix, targets in enumerate(target_batches):
+            score_list = [[] for _ in targets]
+            global_score_list = [[] for _ in targets]
+            all_probs_list = [[] for _ in targets]
+            all_log_probs_list = [[] for _ in targets]
+            S_sample_list = [[] for _ in targets]
             (
                 X,
                 S,
@@ -271,7 +613,7 @@ def main(args):
                 bias_by_res_all,
                 tied_beta,
             ) = tied_featurize(
-                batch_clones,
+                targets,
                 device,
                 chain_id_dict,
                 fixed_positions_dict,
@@ -280,13 +622,76 @@ def main(args):
                 pssm_dict,
                 bias_by_res_dict,
                 ca_only=args.ca_only,
+                num_copies=BATCH_COPIES,
             )
-            pssm_log_odds_mask = (
-                pssm_log_odds_all > args.pssm_threshold
-            ).float()  # 1.0 for true, 0.0 for false
-            name_ = batch_clones[0]["name"]
+            if args.pssm_log_odds_flag:
+                pssm_log_odds_mask = (
+                    pssm_log_odds_all > args.pssm_threshold
+                ).float()  # 1.0 for true, 0.0 for false
+            else:
+                pssm_log_odds_mask = None
+            name_ = targets[0]["name"]
+
+            # Without backbone noise every call below sees the same backbone, so
+            # the encoder runs once per target instead of once per call.
+            if args.backbone_noise == 0 and not args.local_design:
+                if encoder_cache is not None:
+                    encoding = encoder_cache.encode(
+                        X, mask, residue_idx, chain_encoding_all
+                    )
+                else:
+                    # Copies and constraint variants of a structure share their
+                    # backbone, so only the distinct rows are encoded
+                    inputs = (X, mask, residue_idx, chain_encoding_all)
+                    first, inverse = distinct_rows(*inputs)
+                    encoding = model.encode(*(x[first] for x in inputs))
+                    encoding = {k: v[inverse] for k, v in encoding.items()}
+                    encoding["mask"] = mask
+            else:
+                encoding = None
 
-            if args.score_only:
+            if args.score_only and args.score_only_batch_rows:
+                score_only_file = base_folder + "/score_only/" + targets[0]["name"]
+                seq_names = [targets[0]["name"]]
+                t0 = time.time()
+                score_list, global_score_list = [], []
+                for native_score, global_native_score in model.score_sequences(
+                    X[:1],
+                    S[:1],
+                    mask[:1],
+                    (chain_M * chain_M_pos)[:1],
+                    residue_idx[:1],
+                    chain_encoding_all[:1],
+                    score_only_sequences(
+                        S[0], args.path_to_fasta, alphabet_dict, seq_names
+                    ),
+                    num_orders=NUM_BATCHES * BATCH_COPIES,
+                    batch_rows=args.score_only_batch_rows,
+                    encoding=(
+                        None
+                        if encoding is None
+                        else {k: v[:1] for k, v in encoding.items()}
+                    ),
+                ):
+                    score_list.append(native_score)
+                    global_score_list.append(global_native_score)
+                np.savez(
+                    score_only_file,
+                    names=np.array(seq_names),
+                    score=np.stack(score_list),
+                    global_score=np.stack(global_score_list),
+                )
+                logger.info(
+                    "Scored %d sequences on %s in %s seconds, mean score from PDB: %s",
+                    len(score_list),
+                    name_,
+                    round(float(time.time() - t0), 4),
+                    np.format_float_positional(
+                        np.float32(score_list[0].mean()), unique=False, precision=4
+                    ),
+                )
+            elif args.score_only:
+                S = S.clone()  # the FASTA sequences are written into S below
                 loop_c = 0
                 if args.path_to_fasta:
                     fasta_names, fasta_seqs = parse_fasta(
@@ -296,16 +701,13 @@ def main(args):
                 for fc in range(1 + loop_c):
                     if fc == 0:
                         structure_sequence_score_file = (
-                            base_folder
-                            + "/score_only/"
-                            + batch_clones[0]["name"]
-                            + "_pdb"
+                            base_folder + "/score_only/" + targets[0]["name"] + "_pdb"
                         )
                     else:
                         structure_sequence_score_file = (
                             base_folder
                             + "/score_only/"
-                            + batch_clones[0]["name"]
+                            + targets[0]["name"]
                             + f"_fasta_{fc}"
                         )
                     native_score_list = []
@@ -329,6 +731,7 @@ def main(args):
                             residue_idx,
                             chain_encoding_all,
                             randn_1,
+                            encoding=encoding,
                         )
                         mask_for_loss = mask * chain_M * chain_M_pos
                         scores = _scores(S, log_probs, mask_for_loss)
@@ -377,11 +780,14 @@ def main(args):
             elif args.conditional_probs_only:
                 logger.info("Calculating conditional probabilities for %s.", name_)
                 conditional_probs_only_file = (
-                    base_folder + "/conditional_probs_only/" + batch_clones[0]["name"]
+                    base_folder + "/conditional_probs_only/" + targets[0]["name"]
                 )
                 log_conditional_probs_list = []
-
-                for j in range(NUM_BATCHES):
+                # p(s_i given backbone) does not depend on the decoding order
+                num_passes = NUM_BATCHES
+                if args.conditional_probs_only_backbone and encoding is not None:
+                    num_passes = min(NUM_BATCHES, 1)
+                for j in range(num_passes):
                     randn_1 = torch.randn(chain_M.shape, device=X.device)
                     log_conditional_probs = model.conditional_probs(
                         X,
@@ -392,10 +798,13 @@ def main(args):
                         chain_encoding_all,
                         randn_1,
                         args.conditional_probs_only_backbone,
+                        encoding=encoding,
                     )
                     log_conditional_probs_list.append(
                         log_conditional_probs.cpu().numpy()
                     )
+                if num_passes < NUM_BATCHES:
+                    log_conditional_probs_list *= NUM_BATCHES
                 concat_log_p = np.concatenate(
                     log_conditional_probs_list, 0
                 )  # [B, L, 21]
@@ -407,20 +816,60 @@ def main(args):
                     mask=mask[0,].cpu().numpy(),
                     design_mask=mask_out,
                 )
+            elif args.mutational_scan:
+                logger.info("Scoring all single mutants of %s.", name_)
+                mutational_scan_file = (
+                    base_folder + "/mutational_scan/" + targets[0]["name"]
+                )
+                log_conditional_probs_list = []
+                for j in range(NUM_BATCHES):
+                    randn_1 = torch.randn(chain_M.shape, device=X.device)
+                    log_conditional_probs = model.conditional_probs(
+                        X,
+                        S,
+                        mask,
+                        chain_M * chain_M_pos,
+                        residue_idx,
+                        chain_encoding_all,
+                        randn_1,
+                        encoding=encoding,
+                    )
+                    log_conditional_probs_list.append(
+                        log_conditional_probs.cpu().numpy()
+                    )
+                mask_out = (chain_M * chain_M_pos * mask)[0,].cpu().numpy()
+                log_p, delta, pll = mutational_scan(
+                    np.concatenate(log_conditional_probs_list, 0),
+                    S[0,].cpu().numpy(),
+                    mask_out,
+                )
+                np.savez(
+                    mutational_scan_file,
+                    log_p=log_p,
+                    delta=delta,
+                    pll=pll,
+                    S=S[0,].cpu().numpy(),
+                    mask=mask[0,].cpu().numpy(),
+                    design_mask=mask_out,
+                )
             elif args.unconditional_probs_only:
                 logger.info(f"Calculating unconditional probabilities for {name_}")
 
                 unconditional_probs_only_file = (
-                    base_folder + "/unconditional_probs_only/" + batch_clones[0]["name"]
+                    base_folder + "/unconditional_probs_only/" + targets[0]["name"]
                 )
                 log_unconditional_probs_list = []
-                for j in range(NUM_BATCHES):
+                # the pass is deterministic unless the backbone is noised
+                num_passes = NUM_BATCHES if encoding is None else min(NUM_BATCHES, 1)
+                for j in range(num_passes):
                     log_unconditional_probs = model.unconditional_probs(
-                        X, mask, residue_idx, chain_encoding_all
+                        X, mask, residue_idx, chain_encoding_all, encoding=encoding
                     )
                     log_unconditional_probs_list.append(
                         log_unconditional_probs.cpu().numpy()
                     )
+                if num_passes < NUM_BATCHES:
+                    log_unconditional_probs_list *= NUM_BATCHES
                 concat_log_p = np.concatenate(
                     log_unconditional_probs_list, 0
                 )  # [B, L, 21]
@@ -433,7 +882,68 @@ def main(args):
                     design_mask=mask_out,
                 )
             else:
-                randn_1 = torch.randn(chain_M.shape, device=X.device)
+                # Outputs are written for the whole structure
+                full_shape = chain_M.shape
+                S_full, chain_M_full, mask_full, chain_M_pos_full = (
+                    S,
+                    chain_M,
+                    mask,
+                    chain_M_pos,
+                )
+                local_idx = None
+                if args.local_design:
+                    # The designable residues only see a bounded number of kNN
+                    # hops, so the model runs on that subgraph alone.
+                    subgraph = model.local_subgraph(X, mask, chain_M * chain_M_pos)
+                    local_idx = subgraph["idx"]
+                    (
+                        X,
+                        S,
+                        mask,
+                        chain_M,
+                        chain_M_pos,
+                        chain_encoding_all,
+                        residue_idx,
+                        omit_AA_mask,
+                        pssm_coef,
+                        pssm_bias,
+                        pssm_log_odds_mask,
+                        bias_by_res_all,
+                    ) = (
+                        None if tensor is None else tensor[:, local_idx]
+                        for tensor in (
+                            X,
+                            S,
+                            mask,
+                            chain_M,
+                            chain_M_pos,
+                            chain_encoding_all,
+                            residue_idx,
+                            omit_AA_mask,
+                            pssm_coef,
+                            pssm_bias,
+                            pssm_log_odds_mask,
+                            bias_by_res_all,
+                        )
+                    )
+                    encoding = model.encode(
+                        X,
+                        mask,
+                        residue_idx,
+                        chain_encoding_all,
+                        neighbors=subgraph["neighbors"],
+                    )
+                    logger.info(
+                        "Local design of %s on %d of %d residues",
+                        name_,
+                        local_idx.shape[0],
+                        full_shape[1],
+                    )
+
+                # Noise is drawn for the whole structure to keep the seed stream
+                randn_1 = torch.randn(full_shape, device=X.device)
+                if local_idx is not None:
+                    randn_1 = randn_1[:, local_idx]
                 log_probs = model(
                     X,
                     S,
@@ -442,6 +952,8 @@ def main(args):
                     residue_idx,
                     chain_encoding_all,
                     randn_1,
+                    encoding=encoding,
+                    context_chunk_size=args.context_chunk_size or None,
                 )
                 mask_for_loss = mask * chain_M * chain_M_pos
 
@@ -454,79 +966,86 @@ def main(args):
                 global_native_score = global_scores.cpu().data.numpy()
 
                 # Generate some sequences
-                ali_file = base_folder + "/seqs/" + batch_clones[0]["name"] + ".fa"
-                score_file = base_folder + "/scores/" + batch_clones[0]["name"] + ".npz"
-                probs_file = base_folder + "/probs/" + batch_clones[0]["name"] + ".npz"
+                names = [protein["name"] for protein in targets]
+                target_lengths = lengths[::BATCH_COPIES]
+                ali_files = [base_folder + "/seqs/" + name + ".fa" for name in names]
 
-                logger.info("Generating sequences for: %s", name_)
+                logger.info("Generating sequences for: %s", ", ".join(names))
 
                 t0 = time.time()
 
-                with open(ali_file, "w") as f:
-                    for temp in temperatures:
+                sample_inputs = {
+                    "X": X,
+                    "S": S,
+                    "mask": mask,
+                    "chain_M": chain_M,
+                    "chain_M_pos": chain_M_pos,
+                    "chain_encoding_all": chain_encoding_all,
+                    "residue_idx": residue_idx,
+                    "omit_AA_mask": omit_AA_mask,
+                    "pssm_coef": pssm_coef,
+                    "pssm_bias": pssm_bias,
+                    "pssm_log_odds_mask": pssm_log_odds_mask,
+                    "bias_by_res": bias_by_res_all,
+                    "encoding": encoding,
+                }
+                # tied_sample decodes every row in the order of the first one, so
+                # batches of several targets, which never have tied positions,
+                # are sampled with their own orders
+                if tied_positions_dict is not None and len(targets) == 1:
+                    sample_inputs["tied_pos"] = tied_pos_list_of_lists_list[0]
+                    sample_inputs["tied_beta"] = tied_beta
+
+                with contextlib.ExitStack() as stack:
+                    ali_f = [stack.enter_context(open(file, "w")) for file in ali_files]
+                    stacked_samples = []
+                    for temp_ix, temp in enumerate(temperatures):
                         for j in range(NUM_BATCHES):
-                            randn_2 = torch.randn(chain_M.shape, device=X.device)
-                            if tied_positions_dict is None:
-                                sample_dict = model.sample(
-                                    X,
+                            if not args.stack_temperatures:
+                                randn_2 = torch.randn(full_shape, device=X.device)
+                                if local_idx is not None:
+                                    randn_2 = randn_2[:, local_idx]
+                                S_sample, probs, log_probs = sample_batch(
+                                    model,
+                                    args,
+                                    sample_inputs,
+                                    temp,
+                                    omit_AAs_np,
+                                    bias_AAs_np,
                                     randn_2,
-                                    S,
-                                    chain_M,
-                                    chain_encoding_all,
-                                    residue_idx,
-                                    mask=mask,
-                                    temperature=temp,
-                                    omit_AAs_np=omit_AAs_np,
-                                    bias_AAs_np=bias_AAs_np,
-                                    chain_M_pos=chain_M_pos,
-                                    omit_AA_mask=omit_AA_mask,
-                                    pssm_coef=pssm_coef,
-                                    pssm_bias=pssm_bias,
-                                    pssm_multi=args.pssm_multi,
-                                    pssm_log_odds_flag=bool(args.pssm_log_odds_flag),
-                                    pssm_log_odds_mask=pssm_log_odds_mask,
-                                    pssm_bias_flag=bool(args.pssm_bias_flag),
-                                    bias_by_res=bias_by_res_all,
                                 )
-                                S_sample = sample_dict["S"]
                             else:
-                                sample_dict = model.tied_sample(
-                                    X,
-                                    randn_2,
-                                    S,
-                                    chain_M,
-                                    chain_encoding_all,
-                                    residue_idx,
-                                    mask=mask,
-                                    temperature=temp,
-                                    omit_AAs_np=omit_AAs_np,
-                                    bias_AAs_np=bias_AAs_np,
-                                    chain_M_pos=chain_M_pos,
-                                    omit_AA_mask=omit_AA_mask,
-                                    pssm_coef=pssm_coef,
-                                    pssm_bias=pssm_bias,
-                                    pssm_multi=args.pssm_multi,
-                                    pssm_log_odds_flag=bool(args.pssm_log_odds_flag),
-                                    pssm_log_odds_mask=pssm_log_odds_mask,
-                                    pssm_bias_flag=bool(args.pssm_bias_flag),
-                                    tied_pos=tied_pos_list_of_lists_list[0],
-                                    tied_beta=tied_beta,
-                                    bias_by_res=bias_by_res_all,
+                                if temp_ix == 0:
+                                    # Batch j of every temperature in one call.
+                                    # The noise and the sampled residues come
+                                    # from the RNG in another order than in the
+                                    # loop above, so seeded runs differ from it
+                                    randn_2 = torch.randn(
+                                        (len(temperatures), *full_shape),
+                                        device=X.device,
+                                    ).flatten(0, 1)
+                                    if local_idx is not None:
+                                        randn_2 = randn_2[:, local_idx]
+                                    stacked_samples.append(
+                                        sample_batch(
+                                            model,
+                                            args,
+                                            sample_inputs,
+                                            torch.tensor(
+                                                temperatures, device=X.device
+                                            ).repeat_interleave(X.shape[0]),
+                                            omit_AAs_np,
+                                            bias_AAs_np,
+                                            randn_2,
+                                            num_stacked=len(temperatures),
+                                        )
+                                    )
+                                temp_rows = slice(
+                                    temp_ix * X.shape[0], (temp_ix + 1) * X.shape[0]
+                                )
+                                S_sample, probs, log_probs = (
+                                    x[temp_rows] for x in stacked_samples[j]
                                 )
-                                # Compute scores
-                                S_sample = sample_dict["S"]
-
-                            log_probs = model(
-                                X,
-                                S_sample,
-                                mask,
-                                chain_M * chain_M_pos,
-                                residue_idx,
-                                chain_encoding_all,
-                                randn_2,
-                                use_input_decoding_order=True,
-                                decoding_order=sample_dict["decoding_order"],
-                            )
 
                             mask_for_loss = mask * chain_M * chain_M_pos
                             scores = _scores(S_sample, log_probs, mask_for_loss)
@@ -536,20 +1055,41 @@ def main(args):
                             global_scores = _scores(S_sample, log_probs, mask)
                             global_scores = global_scores.cpu().data.numpy()
 
-                            all_probs_list.append(
-                                sample_dict["probs"].cpu().data.numpy()
-                            )
-                            all_log_probs_list.append(log_probs.cpu().data.numpy())
-                            S_sample_list.append(S_sample.cpu().data.numpy())
+                            if local_idx is not None:
+                                S_sample = S_full.index_copy(1, local_idx, S_sample)
+                                probs = probs.new_zeros(full_shape + (21,)).index_copy(
+                                    1, local_idx, probs
+                                )
+                                log_probs = log_probs.new_zeros(
+                                    full_shape + (21,)
+                                ).index_copy(1, local_idx, log_probs)
+                                mask_for_loss = (
+                                    mask_full * chain_M_full * chain_M_pos_full
+                                )
 
-                            for b_ix in range(BATCH_COPIES):
+                            # Each target keeps its own rows without the padding
+                            for k, length in enumerate(target_lengths):
+                                rows = slice(k * BATCH_COPIES, (k + 1) * BATCH_COPIES)
+                                all_probs_list[k].append(
+                                    probs[rows, :length].cpu().data.numpy()
+                                )
+                                all_log_probs_list[k].append(
+                                    log_probs[rows, :length].cpu().data.numpy()
+                                )
+                                S_sample_list[k].append(
+                                    S_sample[rows, :length].cpu().data.numpy()
+                                )
+
+                            for b_ix in range(S_sample.shape[0]):
+                                k, copy_ix = divmod(b_ix, BATCH_COPIES)
+                                f = ali_f[k]
                                 masked_chain_length_list = (
                                     masked_chain_length_list_list[b_ix]
                                 )
                                 masked_list = masked_list_list[b_ix]
                                 seq_recovery_rate = torch.sum(
                                     torch.sum(
-                                        torch.nn.functional.one_hot(S[b_ix], 21)
+                                        torch.nn.functional.one_hot(S_full[b_ix], 21)
                                         * torch.nn.functional.one_hot(
                                             S_sample[b_ix], 21
                                         ),
@@ -557,14 +1097,14 @@ def main(args):
                                     )
                                     * mask_for_loss[b_ix]
                                 ) / torch.sum(mask_for_loss[b_ix])
-                                seq = _S_to_seq(S_sample[b_ix], chain_M[b_ix])
+                                seq = _S_to_seq(S_sample[b_ix], chain_M_full[b_ix])
                                 score = scores[b_ix]
-                                score_list.append(score)
+                                score_list[k].append(score)
                                 global_score = global_scores[b_ix]
-                                global_score_list.append(global_score)
-                                native_seq = _S_to_seq(S[b_ix], chain_M[b_ix])
+                                global_score_list[k].append(global_score)
+                                native_seq = _S_to_seq(S_full[b_ix], chain_M_full[b_ix])
 
-                                if b_ix == 0 and j == 0 and temp == temperatures[0]:
+                                if copy_ix == 0 and j == 0 and temp == temperatures[0]:
                                     start = 0
                                     end = 0
                                     list_of_AAs = []
@@ -592,27 +1132,35 @@ def main(args):
                                         )
                                         l0 += 1
                                     sorted_masked_chain_letters = np.argsort(
-                                        masked_list_list[0]
+                                        masked_list_list[b_ix]
                                     )
                                     print_masked_chains = [
-                                        masked_list_list[0][i]
+                                        masked_list_list[b_ix][i]
                                         for i in sorted_masked_chain_letters
                                     ]
                                     sorted_visible_chain_letters = np.argsort(
-                                        visible_list_list[0]
+                                        visible_list_list[b_ix]
                                     )
                                     print_visible_chains = [
-                                        visible_list_list[0][i]
+                                        visible_list_list[b_ix][i]
                                         for i in sorted_visible_chain_letters
                                     ]
                                     native_score_print = np.format_float_positional(
-                                        np.float32(native_score.mean()),
+                                        np.float32(
+                                            native_score[
+                                                b_ix : b_ix + BATCH_COPIES
+                                            ].mean()
+                                        ),
                                         unique=False,
                                         precision=4,
                                     )
                                     global_native_score_print = (
                                         np.format_float_positional(
-                                            np.float32(global_native_score.mean()),
+                                            np.float32(
+                                                global_native_score[
+                                                    b_ix : b_ix + BATCH_COPIES
+                                                ].mean()
+                                            ),
                                             unique=False,
                                             precision=4,
                                         )
@@ -624,7 +1172,7 @@ def main(args):
                                         print_model_name = "model_name"
 
                                     f.write(
-                                        f">{name_}, score={native_score_print}, global_score={global_native_score_print}, fixed_chains={print_visible_chains}, designed_chains={print_masked_chains}, {print_model_name}={args.model_name}, seed={seed}\n{native_seq}\n"
+                                        f">{names[k]}, score={native_score_print}, global_score={global_native_score_print}, fixed_chains={print_visible_chains}, designed_chains={print_masked_chains}, {print_model_name}={args.model_name}, seed={seed}\n{native_seq}\n"
                                     )  # write the native sequence
                                 start = 0
                                 end = 0
@@ -659,39 +1207,62 @@ def main(args):
                                     unique=False,
                                     precision=4,
                                 )
-                                sample_number = j * BATCH_COPIES + b_ix + 1
+                                sample_number = j * BATCH_COPIES + copy_ix + 1
                                 f.write(
                                     f">T={temp}, sample={sample_number}, score={score_print}, global_score={global_score_print}, seq_recovery={seq_rec_print}\n{seq}\n"
                                 )  # write generated sequence
-                if args.save_score:
-                    np.savez(
-                        score_file,
-                        score=np.array(score_list, np.float32),
-                        global_score=np.array(global_score_list, np.float32),
-                    )
-                if args.save_probs:
-                    all_probs_concat = np.concatenate(all_probs_list)
-                    all_log_probs_concat = np.concatenate(all_log_probs_list)
-                    S_sample_concat = np.concatenate(S_sample_list)
-                    np.savez(
-                        probs_file,
-                        probs=np.array(all_probs_concat, np.float32),
-                        log_probs=np.array(all_log_probs_concat, np.float32),
-                        S=np.array(S_sample_concat, np.int32),
-                        mask=mask_for_loss.cpu().data.numpy(),
-                        chain_order=chain_list_list,
-                    )
+                for k, (name, length) in enumerate(
+                    zip(names, target_lengths, strict=False)
+                ):
+                    rows = slice(k * BATCH_COPIES, (k + 1) * BATCH_COPIES)
+                    if args.save_score:
+                        np.savez(
+                            base_folder + "/scores/" + name + ".npz",
+                            score=np.array(score_list[k], np.float32),
+                            global_score=np.array(global_score_list[k], np.float32),
+                        )
+                    if args.save_probs:
+                        all_probs_concat = np.concatenate(all_probs_list[k])
+                        all_log_probs_concat = np.concatenate(all_log_probs_list[k])
+                        S_sample_concat = np.concatenate(S_sample_list[k])
+                        np.savez(
+                            base_folder + "/probs/" + name + ".npz",
+                            probs=np.array(all_probs_concat, np.float32),
+                            log_probs=np.array(all_log_probs_concat, np.float32),
+                            S=np.array(S_sample_concat, np.int32),
+                            mask=mask_for_loss[rows, :length].cpu().data.numpy(),
+                            chain_order=chain_list_list[rows],
+                        )
                 t1 = time.time()
                 dt = round(float(t1 - t0), 4)
                 num_seqs = len(temperatures) * NUM_BATCHES * BATCH_COPIES
-                total_length = X.shape[1]
+                total_length = full_shape[1]
+
+                if len(targets) == 1:
+                    logger.info(
+                        "%s sequences of length %s generated in %s seconds",
+                        num_seqs,
+                        total_length,
+                        dt,
+                    )
+                else:
+                    logger.info(
+                        "%s sequences for each of %s targets of up to %s residues "
+                        "generated in %s seconds",
+                        num_seqs,
+                        len(targets),
+                        total_length,
+                        dt,
+                    )
 
-                logger.info(
-                    "%s sequences of length %s generated in %s seconds",
-                    num_seqs,
-                    total_length,
-                    dt,
-                )
+    if encoder_cache is not None:
+        logger.info(
+            "Encoder cache: %d hits, %d misses",
+            encoder_cache.hits,
+            encoder_cache.misses,
+        )
+    if result_cache is not None:
+        result_cache.store(result_key, folder_for_outputs, outputs_before)
 
 
 if __name__ == "__main__":
@@ -758,6 +1329,16 @@ if __name__ == "__main__":
         default=0,
         help="0 for False, 1 for True; score input backbone-sequence pairs",
     )
+    argparser.add_argument(
+        "--score-only-batch-rows",
+        type=int,
+        default=0,
+        help="With --score-only, score the PDB sequence and the --path-to-fasta "
+        "sequences this many decoder rows at a time, reading the FASTA file as a "
+        "stream, and save names and scores of all sequences of a target to "
+        "score_only/<name>.npz; memory grows with rows times length, e.g. 64 rows "
+        "need about 2 GB for 100 residues; 0 saves one file per sequence",
+    )
     argparser.add_argument(
         "--path-to-fasta",
         type=str,
@@ -780,6 +1361,16 @@ if __name__ == "__main__":
         help="0 for False, 1 for True; if true output conditional probabilities p(s_i "
         "given backbone)",
     )
+    argparser.add_argument(
+        "--mutational-scan",
+        type=int,
+        default=0,
+        help="0 for False, 1 for True; score all single mutants of the designed "
+        "chains from conditional probabilities p(s_i given the rest of the sequence "
+        "and backbone), averaged over --num-seq-per-target decoding orders, and save "
+        "the log likelihood changes delta [L, 21] and the pseudo-log-likelihood pll "
+        "to mutational_scan/<name>.npz",
+    )
     argparser.add_argument(
         "--unconditional-probs-only",
         type=int,
@@ -788,6 +1379,47 @@ if __name__ == "__main__":
         "backbone) in one forward pass",
     )
 
+    argparser.add_argument(
+        "--local-design",
+        type=int,
+        default=0,
+        help="0 for False, 1 for True; run the model only on the residues that can "
+        "affect the designable positions. Gives the same sequences and scores as a "
+        "full run, global_score covers only those residues. Needs a full backbone "
+        "model, no backbone noise and no tied positions",
+    )
+    argparser.add_argument(
+        "--parallel-decoding",
+        type=int,
+        default=0,
+        help="0 for False, 1 for True; sample residues that are not kNN neighbours "
+        "of each other in the same decoding step. Not available with tied positions",
+    )
+    argparser.add_argument(
+        "--context-chunk-size",
+        type=int,
+        default=0,
+        help="0 to build the encoder context of all edges before sampling; "
+        "otherwise build it on demand for at most this many positions at a time, "
+        "e.g. 64, which keeps the memory of sampling and scoring designs close to "
+        "the size of the encoder outputs on long proteins",
+    )
+    argparser.add_argument(
+        "--pack-targets",
+        type=int,
+        default=0,
+        help="0 for False, 1 for True; sample different targets of similar length "
+        "in the same batch, each with batch_size rows. Outputs are still written "
+        "per target. Targets with tied positions run on their own",
+    )
+    argparser.add_argument(
+        "--max-batch-residues",
+        type=int,
+        default=10000,
+        help="Residue budget of a packed batch, i.e. its number of rows times the "
+        "length of its longest target, used with --pack-targets and "
+        "--constraint-variants-jsonl",
+    )
     argparser.add_argument(
         "--backbone-noise",
         type=float,
@@ -810,6 +1442,60 @@ if __name__ == "__main__":
     argparser.add_argument(
         "--max-length", type=int, default=200000, help="Max sequence length"
     )
+    argparser.add_argument(
+        "--lazy-jsonl",
+        type=int,
+        default=0,
+        help="0 for False, 1 for True; read --jsonl-path entries only when they are "
+        "designed, using a byte-offset index cached next to the file as "
+        "<jsonl-path>.idx.npz",
+    )
+    argparser.add_argument(
+        "--encoder-cache-dir",
+        type=str,
+        default="",
+        help="Directory of encoder outputs cached by backbone, model weights and "
+        "chain layout, reused across runs when --backbone-noise is 0",
+    )
+    argparser.add_argument(
+        "--encoder-cache-size",
+        type=float,
+        default=10.0,
+        help="Size limit of --encoder-cache-dir in GB; the least recently used "
+        "entries are deleted beyond it",
+    )
+    argparser.add_argument(
+        "--result-cache-dir",
+        type=str,
+        default="",
+        help="Directory of output files cached by all options, input file contents "
+        "and model weights; a repeated run with the same nonzero --seed copies "
+        "its outputs from there without loading the model",
+    )
+    argparser.add_argument(
+        "--result-cache-size",
+        type=float,
+        default=10.0,
+        help="Size limit of --result-cache-dir in GB; the least recently used "
+        "entries are deleted beyond it",
+    )
+    argparser.add_argument(
+        "--knn-block-size",
+        type=int,
+        default=0,
+        help="Search nearest neighbours for this many residues at a time so that "
+        "featurization memory grows linearly with length, e.g. 1024 for large "
+        "assemblies; 0 searches all residues at once",
+    )
+    argparser.add_argument(
+        "--factorized-layers",
+        type=int,
+        default=0,
+        help="0 for False, 1 for True; apply the node parts of the first message "
+        "layer once per node instead of once per edge, which needs fewer FLOPs "
+        "and less memory in the encoder and decoder. Same weights, outputs equal "
+        "up to floating point rounding",
+    )
     argparser.add_argument(
         "--sampling-temp",
         type=str,
@@ -818,6 +1504,16 @@ if __name__ == "__main__":
         "acids. Suggested values 0.1, 0.15, 0.2, 0.25, 0.3. Higher values will "
         "lead to more diversity.",
     )
+    argparser.add_argument(
+        "--stack-temperatures",
+        type=int,
+        default=0,
+        help="0 for False, 1 for True; sample every --sampling-temp at once in "
+        "batches of len(temperatures) * batch-size rows with per-row temperatures, "
+        "instead of one temperature after the other. The random numbers are drawn "
+        "in a different order, so with the same --seed the sequences differ from "
+        "those sampled one temperature after the other",
+    )
 
     argparser.add_argument(
         "--out-folder",
@@ -834,7 +1530,10 @@ if __name__ == "__main__":
         help="Define which chains need to be designed for a single PDB ",
     )
     argparser.add_argument(
-        "--jsonl-path", type=str, help="Path to a folder with parsed pdb into jsonl"
+        "--jsonl-path",
+        type=str,
+        help="Path to a folder with parsed pdb into jsonl, or to a binary structure "
+        "store written by helper_scripts/convert_jsonl_to_store.py",
     )
     argparser.add_argument(
         "--chain-id-jsonl",
@@ -849,6 +1548,17 @@ if __name__ == "__main__":
         default="",
         help="Path to a dictionary with fixed positions",
     )
+    argparser.add_argument(
+        "--constraint-variants-jsonl",
+        type=str,
+        default="",
+        help="Path to a dictionary of constraint variants per structure, "
+        "{name: {variant: {'designed_chains': [...], 'fixed_chains': [...], "
+        "'fixed_positions': {chain: [...]}}}}. All variants of a structure are "
+        "sampled in one batch and written as <name>_<variant>; missing keys fall "
+        "back to --chain-id-jsonl and --fixed-positions-jsonl. Not supported "
+        "with --tied-positions-jsonl",
+    )
     argparser.add_argument(
         "--omit-AAs",
         type=list,
@@ -4,38 +4,76 @@ https://github.com/jingraham/neurips19-graph-protein-design
 
 """
 
+import hashlib
 import itertools
 import json
+import logging
+import os
+import re
+import shutil
+import tempfile
 import time
 
 import numpy as np
 import torch
-import torch.nn as nn
 import torch.nn.functional as F
+from torch import nn
 
+logger = logging.getLogger(__name__)
 
-def parse_fasta(filename, limit=-1, omit=[]) -> np.ndarray:
-    """ """
-    header = []
+
+def iter_fasta(filename, omit=()):
+    """
+    Reads a FASTA file one record at a time.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the FASTA file.
+    omit : sequence of str, optional
+        Characters removed from the sequences, e.g. the "/" chain separators.
+
+    Yields
+    ------
+    tuple of str
+        Header without the leading ">" and the sequence of every record.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile("w", suffix=".fa", delete=False) as f:
+    ...     _ = f.write(">a, score=1.0\\nGAW/\\nKL\\n\\n>b\\nMV\\n")
+    >>> list(iter_fasta(f.name, omit=["/"]))
+    [('a, score=1.0', 'GAWKL'), ('b', 'MV')]
+    """
+    header = None
     sequence = []
-    lines = open(filename)
-
-    for line in lines:
-        line = line.rstrip()
-        if line[0] == ">":
-            if len(header) == limit:
-                break
-            header.append(line[1:])
-            sequence.append([])
-        else:
-            if omit:
-                line = [item for item in line if item not in omit]
-                line = "".join(line)
-            line = "".join(line)
-            sequence[-1].append(line)
-    lines.close()
-    sequence = ["".join(seq) for seq in sequence]
+    with open(filename) as lines:
+        for line in lines:
+            line = line.rstrip()
+            if not line:
+                continue
+            if line[0] == ">":
+                if header is not None:
+                    yield header, "".join(sequence)
+                header = line[1:]
+                sequence = []
+            else:
+                if omit:
+                    line = "".join(item for item in line if item not in omit)
+                sequence.append(line)
+    if header is not None:
+        yield header, "".join(sequence)
+
 
+def parse_fasta(filename, limit=-1, omit=()) -> np.ndarray:
+    """ """
+    records = iter_fasta(filename, omit=omit)
+    if limit >= 0:
+        records = itertools.islice(records, limit)
+    records = list(records)
+    header = [name for name, _ in records]
+    sequence = [seq for _, seq in records]
     return np.array(header), np.array(sequence)
 
 
@@ -50,6 +88,49 @@ def _scores(S, log_probs, mask):
     return scores
 
 
+def mutational_scan(log_probs, S, mask):
+    """
+    Log-likelihood changes of all single mutants from conditional probabilities.
+
+    Parameters
+    ----------
+    log_probs : np.ndarray
+        Output of `ProteinMPNN.conditional_probs` with shape (N, L, 21), one row
+        per random decoding order.
+    S : np.ndarray
+        Amino acid indices of the scanned sequence with shape (L,).
+    mask : np.ndarray
+        1.0 for the scanned positions with shape (L,).
+
+    Returns
+    -------
+    log_p : np.ndarray
+        Log probabilities averaged over the decoding orders with shape (L, 21).
+    delta : np.ndarray
+        ``log_p[i, a] - log_p[i, S[i]]``, the change in log likelihood when
+        position i is mutated to amino acid a, with shape (L, 21) and zeros
+        outside ``mask``.
+    pll : np.ndarray
+        Pseudo-log-likelihood, the sum of ``log p(S[i] | rest)`` over the scanned
+        positions, for every decoding order with shape (N,).
+
+    Examples
+    --------
+    >>> log_probs = np.log(np.full((2, 3, 21), 0.01))
+    >>> log_probs[:, 1, 4] = np.log(0.8)
+    >>> log_p, delta, pll = mutational_scan(
+    ...     log_probs, np.array([0, 0, 2]), np.array([1.0, 1.0, 0.0])
+    ... )
+    >>> delta[1, [0, 4]].round(3), delta[2].any(), pll.round(3)
+    (array([0.   , 4.382]), False, array([-9.21, -9.21]))
+    """
+    log_p = log_probs.mean(0)
+    positions = np.arange(S.shape[0])
+    delta = (log_p - log_p[positions, S][:, None]) * mask[:, None]
+    pll = (log_probs[:, positions, S] * mask).sum(-1)
+    return log_p, delta, pll
+
+
 def _S_to_seq(S: torch.tensor, mask: torch.tensor) -> str:
     """
     Converts a tensor of one-hot encoded amino acids to a sequence string.
@@ -91,15 +172,37 @@ def _S_to_seq(S: torch.tensor, mask: torch.tensor) -> str:
     return seq
 
 
-def parse_PDB_biounits(x, atoms=["N", "CA", "C"], chain=None):
+def _read_PDB_atoms(path_to_pdb):
     """
-    input:  x = PDB filename
-            atoms = atoms to extract (optional)
-    output: (length, atoms, coords=(x,y,z)), sequence
+    Reads the ATOM records of a PDB file in one pass, with selenomethionine
+    HETATM records read as methionine ATOM records.
     """
+    atom_lines = []
+    with open(path_to_pdb, "rb") as f:
+        for line in f:
+            line = line.decode("utf-8", "ignore").rstrip()
 
+            if line[:6] == "HETATM" and line[17 : 17 + 3] == "MSE":
+                line = line.replace("HETATM", "ATOM  ")
+                line = line.replace("MSE", "MET")
+
+            if line[:4] == "ATOM":
+                atom_lines.append(line)
+    return atom_lines
+
+
+def _chain_arrays(atom_lines, atoms):
+    """
+    input:  atom_lines = ATOM records of one chain in file order
+            atoms = atoms to extract
+    output: (length, atoms, coords=(x,y,z)), sequence
+
+    Residue numbers missing between the first and the last residue become gaps
+    ("-" with NaN coordinates) and insertion codes follow their residue number.
+    The first record of a residue sets its name and the first record of an atom
+    its coordinates.
+    """
     alpha_1 = list("ARNDCQEGHILKMFPSTWYV-")
-    states = len(alpha_1)
     alpha_3 = [
         "ALA",
         "ARG",
@@ -123,87 +226,68 @@ def parse_PDB_biounits(x, atoms=["N", "CA", "C"], chain=None):
         "VAL",
         "GAP",
     ]
-
-    aa_1_N = {a: n for n, a in enumerate(alpha_1)}
     aa_3_N = {a: n for n, a in enumerate(alpha_3)}
-    aa_N_1 = {n: a for n, a in enumerate(alpha_1)}
-    aa_1_3 = {a: b for a, b in zip(alpha_1, alpha_3, strict=False)}
-    aa_3_1 = {b: a for a, b in zip(alpha_1, alpha_3, strict=False)}
-
-    def AA_to_N(x):
-        # ["ARND"] -> [[0,1,2,3]]
-        x = np.array(x)
-        if x.ndim == 0:
-            x = x[None]
-        return [[aa_1_N.get(a, states - 1) for a in y] for y in x]
-
-    def N_to_AA(x):
-        # [[0,1,2,3]] -> ["ARND"]
-        x = np.array(x)
-        if x.ndim == 1:
-            x = x[None]
-        return ["".join([aa_N_1.get(a, "-") for a in y]) for y in x]
-
-    xyz, seq, min_resn, max_resn = {}, {}, 1e6, -1e6
-    for line in open(x, "rb"):
-        line = line.decode("utf-8", "ignore").rstrip()
-
-        if line[:6] == "HETATM" and line[17 : 17 + 3] == "MSE":
-            line = line.replace("HETATM", "ATOM  ")
-            line = line.replace("MSE", "MET")
-
-        if line[:4] == "ATOM":
-            ch = line[21:22]
-            if ch == chain or chain is None:
-                atom = line[12 : 12 + 4].strip()
-                resi = line[17 : 17 + 3]
-                resn = line[22 : 22 + 5].strip()
-                x, y, z = (float(line[i : (i + 8)]) for i in [30, 38, 46])
-
-                if resn[-1].isalpha():
-                    resa, resn = resn[-1], int(resn[:-1]) - 1
-                else:
-                    resa, resn = "", int(resn) - 1
-                #         resn = int(resn)
-                if resn < min_resn:
-                    min_resn = resn
-                if resn > max_resn:
-                    max_resn = resn
-                if resn not in xyz:
-                    xyz[resn] = {}
-                if resa not in xyz[resn]:
-                    xyz[resn][resa] = {}
-                if resn not in seq:
-                    seq[resn] = {}
-                if resa not in seq[resn]:
-                    seq[resn][resa] = resi
-
-                if atom not in xyz[resn][resa]:
-                    xyz[resn][resa][atom] = np.array([x, y, z])
-
-    # convert to numpy arrays, fill in missing values
-    seq_, xyz_ = [], []
-    try:
-        for resn in range(min_resn, max_resn + 1):
-            if resn in seq:
-                for k in sorted(seq[resn]):
-                    seq_.append(aa_3_N.get(seq[resn][k], 20))
-            else:
-                seq_.append(20)
-            if resn in xyz:
-                for k in sorted(xyz[resn]):
-                    for atom in atoms:
-                        if atom in xyz[resn][k]:
-                            xyz_.append(xyz[resn][k][atom])
-                        else:
-                            xyz_.append(np.full(3, np.nan))
-            else:
-                for atom in atoms:
-                    xyz_.append(np.full(3, np.nan))
-        return np.array(xyz_).reshape(-1, len(atoms), 3), N_to_AA(np.array(seq_))
-    except TypeError:
+    atom_N = {a: n for n, a in enumerate(atoms)}
+
+    if not atom_lines:
         return "no_chain", "no_chain"
 
+    residues = []
+    for line in atom_lines:
+        resn = line[22 : 22 + 5].strip()
+        if resn[-1].isalpha():
+            residues.append((int(resn[:-1]) - 1, resn[-1]))
+        else:
+            residues.append((int(resn) - 1, ""))
+    coords = np.array(
+        [[float(line[i : (i + 8)]) for i in [30, 38, 46]] for line in atom_lines]
+    )
+
+    first_record = {}
+    for n, residue in enumerate(residues):
+        first_record.setdefault(residue, n)
+    numbers = {resn for resn, _ in first_record}
+    slots = sorted(
+        list(first_record)
+        + [
+            (resn, "")
+            for resn in range(min(numbers), max(numbers) + 1)
+            if resn not in numbers
+        ]
+    )
+    slot_N = {residue: n for n, residue in enumerate(slots)}
+    seq = "".join(
+        alpha_1[aa_3_N.get(atom_lines[first_record[residue]][17 : 17 + 3], 20)]
+        if residue in first_record
+        else "-"
+        for residue in slots
+    )
+
+    # One row per (residue, atom), filled from the first record of each
+    record_slot = np.array([slot_N[residue] for residue in residues])
+    record_atom = np.array(
+        [atom_N.get(line[12 : 12 + 4].strip(), -1) for line in atom_lines]
+    )
+    keep = record_atom >= 0
+    rows, first = np.unique(
+        record_slot[keep] * len(atoms) + record_atom[keep], return_index=True
+    )
+    xyz = np.full((len(slots) * len(atoms), 3), np.nan)
+    xyz[rows] = coords[keep][first]
+    return xyz.reshape(-1, len(atoms), 3), [seq]
+
+
+def parse_PDB_biounits(x, atoms=["N", "CA", "C"], chain=None):
+    """
+    input:  x = PDB filename
+            atoms = atoms to extract (optional)
+    output: (length, atoms, coords=(x,y,z)), sequence
+    """
+    atom_lines = _read_PDB_atoms(x)
+    if chain is not None:
+        atom_lines = [line for line in atom_lines if line[21:22] == chain]
+    return _chain_arrays(atom_lines, atoms)
+
 
 def parse_PDB(path_to_pdb, input_chain_list=None, ca_only=False):
     c = 0
@@ -270,6 +354,10 @@ def parse_PDB(path_to_pdb, input_chain_list=None, ca_only=False):
 
     biounit_names = [path_to_pdb]
     for biounit in biounit_names:
+        # The file is read once and split by chain ID
+        chain_lines = {}
+        for line in _read_PDB_atoms(biounit):
+            chain_lines.setdefault(line[21:22], []).append(line)
         my_dict = {}
         s = 0
         concat_seq = ""
@@ -284,7 +372,7 @@ def parse_PDB(path_to_pdb, input_chain_list=None, ca_only=False):
                 sidechain_atoms = ["CA"]
             else:
                 sidechain_atoms = ["N", "CA", "C", "O"]
-            xyz, seq = parse_PDB_biounits(biounit, atoms=sidechain_atoms, chain=letter)
+            xyz, seq = _chain_arrays(chain_lines.get(letter, []), sidechain_atoms)
             if type(xyz) != str:
                 concat_seq += seq[0]
                 my_dict["seq_chain_" + letter] = seq[0]
@@ -318,41 +406,57 @@ def tied_featurize(
     pssm_dict=None,
     bias_by_res_dict=None,
     ca_only=False,
+    num_copies=1,
 ):
-    """Pack and pad batch into torch tensors"""
+    """Pack and pad batch into torch tensors
+
+    Every entry of ``batch`` is featurized once and given ``num_copies``
+    consecutive rows. With a single entry the copies are broadcast views that
+    share its memory, so clone a tensor before writing into it. The PSSM, bias
+    and omit tensors of constraints that are not given are broadcast views of a
+    single residue as well.
+    """
     alphabet = "ACDEFGHIKLMNPQRSTVWYX"
     B = len(batch)
     lengths = np.array(
         [len(b["seq"]) for b in batch], dtype=np.int32
     )  # sum of chain seq lengths
     L_max = max([len(b["seq"]) for b in batch])
+    # NaN coordinates mark missing residues and the padding
     if ca_only:
-        X = np.zeros([B, L_max, 1, 3])
+        X = np.full([B, L_max, 1, 3], np.nan)
     else:
-        X = np.zeros([B, L_max, 4, 3])
+        X = np.full([B, L_max, 4, 3], np.nan)
     residue_idx = -100 * np.ones([B, L_max], dtype=np.int32)
     chain_M = np.zeros(
         [B, L_max], dtype=np.int32
     )  # 1.0 for the bits that need to be predicted
+    # Constraint arrays are only allocated for the constraints that are given
     pssm_coef_all = np.zeros(
         [B, L_max], dtype=np.float32
     )  # 1.0 for the bits that need to be predicted
-    pssm_bias_all = np.zeros(
-        [B, L_max, 21], dtype=np.float32
-    )  # 1.0 for the bits that need to be predicted
-    pssm_log_odds_all = 10000.0 * np.ones(
-        [B, L_max, 21], dtype=np.float32
-    )  # 1.0 for the bits that need to be predicted
+    if pssm_dict:
+        pssm_bias_all = np.zeros([B, L_max, 21], dtype=np.float32)
+        pssm_log_odds_all = np.zeros(
+            [B, L_max, 21], dtype=np.float32
+        )  # 10000.0 for residues without PSSM, 0.0 for the padding
     chain_M_pos = np.zeros(
         [B, L_max], dtype=np.int32
     )  # 1.0 for the bits that need to be predicted
-    bias_by_res_all = np.zeros([B, L_max, 21], dtype=np.float32)
+    if bias_by_res_dict:
+        bias_by_res_all = np.zeros([B, L_max, 21], dtype=np.float32)
     chain_encoding_all = np.zeros(
         [B, L_max], dtype=np.int32
     )  # 1.0 for the bits that need to be predicted
     S = np.zeros([B, L_max], dtype=np.int32)
-    omit_AA_mask = np.zeros([B, L_max, len(alphabet)], dtype=np.int32)
+    if omit_AA_dict != None:
+        omit_AA_mask = np.zeros([B, L_max, len(alphabet)], dtype=np.int32)
     # Build the batch
+    aa_lookup = np.full(256, -1, dtype=np.int32)
+    aa_lookup[np.frombuffer(alphabet.encode(), dtype=np.uint8)] = np.arange(
+        len(alphabet)
+    )
+    aa_lookup[ord("-")] = alphabet.index("X")
     letter_list_list = []
     visible_list_list = []
     masked_list_list = []
@@ -369,85 +473,35 @@ def tied_featurize(
         masked_chains.sort()  # sort masked_chains
         visible_chains.sort()  # sort visible_chains
         all_chains = masked_chains + visible_chains
-    for i, b in enumerate(batch):
-        mask_dict = {}
-        a = 0
-        x_chain_list = []
-        chain_mask_list = []
-        chain_seq_list = []
-        chain_encoding_list = []
         c = 1
         letter_list = []
         global_idx_start_list = [0]
         visible_list = []
         masked_list = []
         masked_chain_length_list = []
-        fixed_position_mask_list = []
-        omit_AA_mask_list = []
-        pssm_coef_list = []
-        pssm_bias_list = []
-        pssm_log_odds_list = []
-        bias_by_res_list = []
         l0 = 0
-        l1 = 0
-        for step, letter in enumerate(all_chains):
-            if letter in visible_chains:
+        for letter in all_chains:
+            # Chains are written into the padded arrays one after another; a
+            # chain that is both visible and masked is written twice
+            for masked in [False] * (letter in visible_chains) + [True] * (
+                letter in masked_chains
+            ):
                 letter_list.append(letter)
-                visible_list.append(letter)
-                chain_seq = b[f"seq_chain_{letter}"]
-                chain_seq = "".join([a if a != "-" else "X" for a in chain_seq])
-                chain_length = len(chain_seq)
-                global_idx_start_list.append(global_idx_start_list[-1] + chain_length)
-                chain_coords = b[f"coords_chain_{letter}"]  # this is a dictionary
-                chain_mask = np.zeros(chain_length)  # 0.0 for visible chains
-                if ca_only:
-                    x_chain = np.array(
-                        chain_coords[f"CA_chain_{letter}"]
-                    )  # [chain_lenght,1,3] #CA_diff
-                    if len(x_chain.shape) == 2:
-                        x_chain = x_chain[:, None, :]
+                if masked:
+                    masked_list.append(letter)
                 else:
-                    x_chain = np.stack(
-                        [
-                            chain_coords[c]
-                            for c in [
-                                f"N_chain_{letter}",
-                                f"CA_chain_{letter}",
-                                f"C_chain_{letter}",
-                                f"O_chain_{letter}",
-                            ]
-                        ],
-                        1,
-                    )  # [chain_lenght,4,3]
-                x_chain_list.append(x_chain)
-                chain_mask_list.append(chain_mask)
-                chain_seq_list.append(chain_seq)
-                chain_encoding_list.append(c * np.ones(np.array(chain_mask).shape[0]))
-                l1 += chain_length
-                residue_idx[i, l0:l1] = 100 * (c - 1) + np.arange(l0, l1)
-                l0 += chain_length
-                c += 1
-                fixed_position_mask = np.ones(chain_length)
-                fixed_position_mask_list.append(fixed_position_mask)
-                omit_AA_mask_temp = np.zeros([chain_length, len(alphabet)], np.int32)
-                omit_AA_mask_list.append(omit_AA_mask_temp)
-                pssm_coef = np.zeros(chain_length)
-                pssm_bias = np.zeros([chain_length, 21])
-                pssm_log_odds = 10000.0 * np.ones([chain_length, 21])
-                pssm_coef_list.append(pssm_coef)
-                pssm_bias_list.append(pssm_bias)
-                pssm_log_odds_list.append(pssm_log_odds)
-                bias_by_res_list.append(np.zeros([chain_length, 21]))
-            if letter in masked_chains:
-                masked_list.append(letter)
-                letter_list.append(letter)
-                chain_seq = b[f"seq_chain_{letter}"]
-                chain_seq = "".join([a if a != "-" else "X" for a in chain_seq])
+                    visible_list.append(letter)
+                chain_seq = aa_lookup[
+                    np.frombuffer(b[f"seq_chain_{letter}"].encode(), dtype=np.uint8)
+                ]
+                if (chain_seq < 0).any():
+                    raise ValueError(
+                        f"chain {letter} of {b['name']} has unknown residues"
+                    )
                 chain_length = len(chain_seq)
-                global_idx_start_list.append(global_idx_start_list[-1] + chain_length)
-                masked_chain_length_list.append(chain_length)
+                l1 = l0 + chain_length
+                global_idx_start_list.append(l1)
                 chain_coords = b[f"coords_chain_{letter}"]  # this is a dictionary
-                chain_mask = np.ones(chain_length)  # 1.0 for masked
                 if ca_only:
                     x_chain = np.array(
                         chain_coords[f"CA_chain_{letter}"]
@@ -467,48 +521,36 @@ def tied_featurize(
                         ],
                         1,
                     )  # [chain_lenght,4,3]
-                x_chain_list.append(x_chain)
-                chain_mask_list.append(chain_mask)
-                chain_seq_list.append(chain_seq)
-                chain_encoding_list.append(c * np.ones(np.array(chain_mask).shape[0]))
-                l1 += chain_length
+                X[i, l0:l1] = x_chain
+                S[i, l0:l1] = chain_seq
                 residue_idx[i, l0:l1] = 100 * (c - 1) + np.arange(l0, l1)
-                l0 += chain_length
-                c += 1
-                fixed_position_mask = np.ones(chain_length)
-                if fixed_position_dict != None:
-                    fixed_pos_list = fixed_position_dict[b["name"]][letter]
-                    if fixed_pos_list:
-                        fixed_position_mask[np.array(fixed_pos_list) - 1] = 0.0
-                fixed_position_mask_list.append(fixed_position_mask)
-                omit_AA_mask_temp = np.zeros([chain_length, len(alphabet)], np.int32)
-                if omit_AA_dict != None:
-                    for item in omit_AA_dict[b["name"]][letter]:
-                        idx_AA = np.array(item[0]) - 1
-                        AA_idx = np.array(
-                            [
-                                np.argwhere(np.array(list(alphabet)) == AA)[0][0]
-                                for AA in item[1]
-                            ]
-                        ).repeat(idx_AA.shape[0])
-                        idx_ = np.array([[a, b] for a in idx_AA for b in AA_idx])
-                        omit_AA_mask_temp[idx_[:, 0], idx_[:, 1]] = 1
-                omit_AA_mask_list.append(omit_AA_mask_temp)
-                pssm_coef = np.zeros(chain_length)
-                pssm_bias = np.zeros([chain_length, 21])
-                pssm_log_odds = 10000.0 * np.ones([chain_length, 21])
+                chain_encoding_all[i, l0:l1] = c
+                chain_M_pos[i, l0:l1] = 1
                 if pssm_dict:
-                    if pssm_dict[b["name"]][letter]:
-                        pssm_coef = pssm_dict[b["name"]][letter]["pssm_coef"]
-                        pssm_bias = pssm_dict[b["name"]][letter]["pssm_bias"]
-                        pssm_log_odds = pssm_dict[b["name"]][letter]["pssm_log_odds"]
-                pssm_coef_list.append(pssm_coef)
-                pssm_bias_list.append(pssm_bias)
-                pssm_log_odds_list.append(pssm_log_odds)
-                if bias_by_res_dict:
-                    bias_by_res_list.append(bias_by_res_dict[b["name"]][letter])
-                else:
-                    bias_by_res_list.append(np.zeros([chain_length, 21]))
+                    pssm_log_odds_all[i, l0:l1] = 10000.0
+                if masked:
+                    masked_chain_length_list.append(chain_length)
+                    chain_M[i, l0:l1] = 1  # 1.0 for masked
+                    # Positions index into the chain, negative ones from its end
+                    if fixed_position_dict != None:
+                        fixed_pos_list = fixed_position_dict[b["name"]][letter]
+                        if fixed_pos_list:
+                            chain_M_pos[i, l0:l1][np.array(fixed_pos_list) - 1] = 0
+                    if omit_AA_dict != None:
+                        for item in omit_AA_dict[b["name"]][letter]:
+                            idx_AA = np.array(item[0]) - 1
+                            AA_idx = np.array([alphabet.index(AA) for AA in item[1]])
+                            omit_AA_mask[i, l0:l1][np.ix_(idx_AA, AA_idx)] = 1
+                    if pssm_dict:
+                        if pssm_dict[b["name"]][letter]:
+                            pssm_chain = pssm_dict[b["name"]][letter]
+                            pssm_coef_all[i, l0:l1] = pssm_chain["pssm_coef"]
+                            pssm_bias_all[i, l0:l1] = pssm_chain["pssm_bias"]
+                            pssm_log_odds_all[i, l0:l1] = pssm_chain["pssm_log_odds"]
+                    if bias_by_res_dict:
+                        bias_by_res_all[i, l0:l1] = bias_by_res_dict[b["name"]][letter]
+                l0 = l1
+                c += 1
 
         letter_list_np = np.array(letter_list)
         tied_pos_list_of_lists = []
@@ -539,75 +581,6 @@ def tied_featurize(
                     tied_pos_list_of_lists.append(one_list)
         tied_pos_list_of_lists_list.append(tied_pos_list_of_lists)
 
-        x = np.concatenate(x_chain_list, 0)  # [L, 4, 3]
-        all_sequence = "".join(chain_seq_list)
-        m = np.concatenate(
-            chain_mask_list, 0
-        )  # [L,], 1.0 for places that need to be predicted
-        chain_encoding = np.concatenate(chain_encoding_list, 0)
-        m_pos = np.concatenate(
-            fixed_position_mask_list, 0
-        )  # [L,], 1.0 for places that need to be predicted
-
-        pssm_coef_ = np.concatenate(
-            pssm_coef_list, 0
-        )  # [L,], 1.0 for places that need to be predicted
-        pssm_bias_ = np.concatenate(
-            pssm_bias_list, 0
-        )  # [L,], 1.0 for places that need to be predicted
-        pssm_log_odds_ = np.concatenate(
-            pssm_log_odds_list, 0
-        )  # [L,], 1.0 for places that need to be predicted
-
-        bias_by_res_ = np.concatenate(
-            bias_by_res_list, 0
-        )  # [L,21], 0.0 for places where AA frequencies don't need to be tweaked
-
-        l = len(all_sequence)
-        x_pad = np.pad(
-            x, [[0, L_max - l], [0, 0], [0, 0]], "constant", constant_values=(np.nan,)
-        )
-        X[i, :, :, :] = x_pad
-
-        m_pad = np.pad(m, [[0, L_max - l]], "constant", constant_values=(0.0,))
-        m_pos_pad = np.pad(m_pos, [[0, L_max - l]], "constant", constant_values=(0.0,))
-        omit_AA_mask_pad = np.pad(
-            np.concatenate(omit_AA_mask_list, 0),
-            [[0, L_max - l]],
-            "constant",
-            constant_values=(0.0,),
-        )
-        chain_M[i, :] = m_pad
-        chain_M_pos[i, :] = m_pos_pad
-        omit_AA_mask[i,] = omit_AA_mask_pad
-
-        chain_encoding_pad = np.pad(
-            chain_encoding, [[0, L_max - l]], "constant", constant_values=(0.0,)
-        )
-        chain_encoding_all[i, :] = chain_encoding_pad
-
-        pssm_coef_pad = np.pad(
-            pssm_coef_, [[0, L_max - l]], "constant", constant_values=(0.0,)
-        )
-        pssm_bias_pad = np.pad(
-            pssm_bias_, [[0, L_max - l], [0, 0]], "constant", constant_values=(0.0,)
-        )
-        pssm_log_odds_pad = np.pad(
-            pssm_log_odds_, [[0, L_max - l], [0, 0]], "constant", constant_values=(0.0,)
-        )
-
-        pssm_coef_all[i, :] = pssm_coef_pad
-        pssm_bias_all[i, :] = pssm_bias_pad
-        pssm_log_odds_all[i, :] = pssm_log_odds_pad
-
-        bias_by_res_pad = np.pad(
-            bias_by_res_, [[0, L_max - l], [0, 0]], "constant", constant_values=(0.0,)
-        )
-        bias_by_res_all[i, :] = bias_by_res_pad
-
-        # Convert to labels
-        indices = np.asarray([alphabet.index(a) for a in all_sequence], dtype=np.int32)
-        S[i, :l] = indices
         letter_list_list.append(letter_list)
         visible_list_list.append(visible_list)
         masked_list_list.append(masked_list)
@@ -621,25 +594,37 @@ def tied_featurize(
     pssm_coef_all = torch.from_numpy(pssm_coef_all).to(
         dtype=torch.float32, device=device
     )
-    pssm_bias_all = torch.from_numpy(pssm_bias_all).to(
-        dtype=torch.float32, device=device
-    )
-    pssm_log_odds_all = torch.from_numpy(pssm_log_odds_all).to(
-        dtype=torch.float32, device=device
-    )
+    if pssm_dict:
+        pssm_bias_all = torch.from_numpy(pssm_bias_all).to(
+            dtype=torch.float32, device=device
+        )
+        pssm_log_odds_all = torch.from_numpy(pssm_log_odds_all).to(
+            dtype=torch.float32, device=device
+        )
+    else:
+        pssm_bias_all = torch.zeros(
+            (1, 1, 21), dtype=torch.float32, device=device
+        ).expand(B, L_max, 21)
+        # Expanded to the alphabet after the copies below
+        pssm_log_odds_all = (
+            10000.0 * torch.from_numpy(residue_idx != -100).to(device)
+        )[:, :, None]
 
     tied_beta = torch.from_numpy(tied_beta).to(dtype=torch.float32, device=device)
 
     jumps = ((residue_idx[:, 1:] - residue_idx[:, :-1]) == 1).astype(np.float32)
-    bias_by_res_all = torch.from_numpy(bias_by_res_all).to(
-        dtype=torch.float32, device=device
-    )
-    phi_mask = np.pad(jumps, [[0, 0], [1, 0]])
-    psi_mask = np.pad(jumps, [[0, 0], [0, 1]])
-    omega_mask = np.pad(jumps, [[0, 0], [0, 1]])
-    dihedral_mask = np.concatenate(
-        [phi_mask[:, :, None], psi_mask[:, :, None], omega_mask[:, :, None]], -1
-    )  # [B,L,3]
+    if bias_by_res_dict:
+        bias_by_res_all = torch.from_numpy(bias_by_res_all).to(
+            dtype=torch.float32, device=device
+        )
+    else:
+        bias_by_res_all = torch.zeros(
+            (1, 1, 21), dtype=torch.float32, device=device
+        ).expand(B, L_max, 21)
+    dihedral_mask = np.zeros([B, L_max, 3], dtype=np.float32)  # [B,L,3]
+    dihedral_mask[:, 1:, 0] = jumps  # phi
+    dihedral_mask[:, :-1, 1] = jumps  # psi
+    dihedral_mask[:, :-1, 2] = jumps  # omega
     dihedral_mask = torch.from_numpy(dihedral_mask).to(
         dtype=torch.float32, device=device
     )
@@ -649,7 +634,14 @@ def tied_featurize(
     mask = torch.from_numpy(mask).to(dtype=torch.float32, device=device)
     chain_M = torch.from_numpy(chain_M).to(dtype=torch.float32, device=device)
     chain_M_pos = torch.from_numpy(chain_M_pos).to(dtype=torch.float32, device=device)
-    omit_AA_mask = torch.from_numpy(omit_AA_mask).to(dtype=torch.float32, device=device)
+    if omit_AA_dict != None:
+        omit_AA_mask = torch.from_numpy(omit_AA_mask).to(
+            dtype=torch.float32, device=device
+        )
+    else:
+        omit_AA_mask = torch.zeros(
+            (1, 1, len(alphabet)), dtype=torch.float32, device=device
+        ).expand(B, L_max, len(alphabet))
     chain_encoding_all = torch.from_numpy(chain_encoding_all).to(
         dtype=torch.long, device=device
     )
@@ -657,6 +649,64 @@ def tied_featurize(
         X_out = X[:, :, 0]
     else:
         X_out = X
+    if num_copies > 1:
+
+        def copies(tensor):
+            if B == 1 or tensor.stride(0) == 0:
+                return tensor[:1].expand(B * num_copies, *tensor.shape[1:])
+            return tensor.repeat_interleave(num_copies, 0)
+
+        (
+            X_out,
+            S,
+            mask,
+            chain_M,
+            chain_encoding_all,
+            chain_M_pos,
+            omit_AA_mask,
+            residue_idx,
+            dihedral_mask,
+            pssm_coef_all,
+            pssm_bias_all,
+            pssm_log_odds_all,
+            bias_by_res_all,
+        ) = (
+            copies(tensor)
+            for tensor in (
+                X_out,
+                S,
+                mask,
+                chain_M,
+                chain_encoding_all,
+                chain_M_pos,
+                omit_AA_mask,
+                residue_idx,
+                dihedral_mask,
+                pssm_coef_all,
+                pssm_bias_all,
+                pssm_log_odds_all,
+                bias_by_res_all,
+            )
+        )
+        lengths = np.repeat(lengths, num_copies)
+        (
+            letter_list_list,
+            visible_list_list,
+            masked_list_list,
+            masked_chain_length_list_list,
+            tied_pos_list_of_lists_list,
+        ) = (
+            [item for item in list_ for _ in range(num_copies)]
+            for list_ in (
+                letter_list_list,
+                visible_list_list,
+                masked_list_list,
+                masked_chain_length_list_list,
+                tied_pos_list_of_lists_list,
+            )
+        )
+    if not pssm_dict:
+        pssm_log_odds_all = pssm_log_odds_all.expand(-1, -1, 21)
     return (
         X_out,
         S,
@@ -681,6 +731,46 @@ def tied_featurize(
     )
 
 
+def distinct_rows(*tensors):
+    """
+    First occurrence of every distinct batch row and the map back to the batch.
+
+    ``tied_featurize`` repeats each structure ``num_copies`` times, and
+    constraint variants of one structure share the same backbone, so a batch
+    usually holds far fewer distinct rows than rows.
+
+    Parameters
+    ----------
+    *tensors : torch.tensor
+        Tensors with the batch in their first dimension; two rows are the same
+        when they are equal in every tensor.
+
+    Returns
+    -------
+    first : torch.tensor
+        Index of the first row of each distinct row, in batch order.
+    inverse : torch.tensor
+        Position of every batch row in ``first``, so that
+        ``x[first][inverse]`` equals ``x``.
+
+    Examples
+    --------
+    >>> X = torch.tensor([[1.0, 2.0], [3.0, 4.0], [1.0, 2.0], [1.0, 2.0]])
+    >>> chain = torch.tensor([[1, 1], [1, 1], [1, 1], [1, 2]])
+    >>> distinct_rows(X, chain)
+    (tensor([0, 1, 3]), tensor([0, 1, 0, 2]))
+    """
+    rows = [
+        b"".join(x[b].cpu().numpy().tobytes() for x in tensors)
+        for b in range(tensors[0].shape[0])
+    ]
+    position = {}
+    inverse = [position.setdefault(row, len(position)) for row in rows]
+    first = [rows.index(row) for row in position]
+    device = tensors[0].device
+    return torch.tensor(first, device=device), torch.tensor(inverse, device=device)
+
+
 def loss_nll(S, log_probs, mask):
     """Negative log probabilities"""
     criterion = torch.nn.NLLLoss(reduction="none")
@@ -712,10 +802,43 @@ class StructureDataset:
         truncate=None,
         max_length=100,
         alphabet="ACDEFGHIKLMNPQRSTVWYX-",
+        lazy=False,
     ):
         alphabet_set = set([a for a in alphabet])
         discard_count = {"bad_chars": 0, "too_long": 0, "bad_seq_length": 0}
 
+        self.store = None
+        if os.path.isdir(jsonl_file) or lazy:
+            # Filter on an index and decode entries on access
+            if os.path.isdir(jsonl_file):
+                self.store = StructureStore(jsonl_file)
+                allowed = np.zeros(256, dtype=bool)
+                allowed[np.frombuffer(alphabet.encode(), dtype=np.uint8)] = True
+                residue_start = self.store.chain_residues[self.store.entry_chains]
+                bad_residues = np.flatnonzero(~allowed[self.store.seq])
+                bad = np.zeros(len(self.store), dtype=bool)
+                bad[np.searchsorted(residue_start, bad_residues, side="right") - 1] = (
+                    True
+                )
+            else:
+                self.store = JSONLIndex(jsonl_file, alphabet=alphabet)
+                bad = self.store.bad_chars.copy()
+            too_long = ~bad & (self.store.lengths > max_length)
+            self.indices = np.flatnonzero(~bad & ~too_long)
+            if truncate and len(self.indices) > truncate:
+                self.indices = self.indices[:truncate]
+                bad[self.indices[-1] :] = False
+                too_long[self.indices[-1] :] = False
+            discard_count["bad_chars"] = int(bad.sum())
+            discard_count["too_long"] = int(too_long.sum())
+            if verbose:
+                for i in np.flatnonzero(bad):
+                    entry = self.store[i]
+                    bad_chars = set(entry["seq"]).difference(alphabet_set)
+                    logger.info("%s %s %s", entry["name"], bad_chars, entry["seq"])
+                logger.info("discarded %s", discard_count)
+            return
+
         with open(jsonl_file) as f:
             self.data = []
 
@@ -756,12 +879,278 @@ class StructureDataset:
                 print("discarded", discard_count)
 
     def __len__(self):
+        if self.store is not None:
+            return len(self.indices)
         return len(self.data)
 
     def __getitem__(self, idx):
+        if self.store is not None:
+            return self.store[self.indices[idx]]
         return self.data[idx]
 
 
+class StructureStore:
+    """
+    Parsed PDBs stored as flat binary arrays in a directory.
+
+    ``coords.bin`` holds float32 backbone coordinates with shape (residues, atoms,
+    3), ``seq.bin`` one byte per residue and ``index.npz`` the entry names, chain
+    IDs and the offsets of every entry's chains and every chain's residues. Both
+    binary files are memory-mapped, so an entry is only read when it is accessed
+    and then has the same keys as a line of ``parse_multiple_chains.py`` JSONL,
+    with NumPy arrays in place of coordinate lists.
+
+    Parameters
+    ----------
+    path : str
+        Directory written by ``StructureStoreWriter``.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> entry = {
+    ...     "seq_chain_A": "GA",
+    ...     "coords_chain_A": {
+    ...         f"{atom}_chain_A": [[0.0, 1.0, 2.0], [3.0, 4.0, 5.0]]
+    ...         for atom in ["N", "CA", "C", "O"]
+    ...     },
+    ...     "seq_chain_B": "W",
+    ...     "coords_chain_B": {
+    ...         f"{atom}_chain_B": [[6.0, 7.0, float("nan")]]
+    ...         for atom in ["N", "CA", "C", "O"]
+    ...     },
+    ...     "name": "toy",
+    ...     "num_of_chains": 2,
+    ...     "seq": "GAW",
+    ... }
+    >>> path = tempfile.mkdtemp()
+    >>> with StructureStoreWriter(path) as writer:
+    ...     writer.add(entry)
+    >>> store = StructureStore(path)
+    >>> len(store), store.lengths.tolist()
+    (1, [3])
+    >>> toy = store[0]
+    >>> list(toy) == list(entry), toy["seq"], toy["coords_chain_B"]["CA_chain_B"]
+    (True, 'GAW', array([[ 6.,  7., nan]], dtype=float32))
+    """
+
+    def __init__(self, path):
+        index = np.load(os.path.join(path, "index.npz"))
+        self.names = index["names"]
+        self.chain_ids = index["chain_ids"]
+        self.entry_chains = index["entry_chains"]
+        self.chain_residues = index["chain_residues"]
+        self.atoms = index["atoms"].tolist()
+        num_residues = int(self.chain_residues[-1])
+        if num_residues > 0:
+            self.seq = np.memmap(
+                os.path.join(path, "seq.bin"), dtype=np.uint8, mode="r"
+            )
+            self.coords = np.memmap(
+                os.path.join(path, "coords.bin"),
+                dtype=np.float32,
+                mode="r",
+                shape=(num_residues, len(self.atoms), 3),
+            )
+        else:
+            self.seq = np.zeros(0, dtype=np.uint8)
+            self.coords = np.zeros((0, len(self.atoms), 3), dtype=np.float32)
+        residue_start = self.chain_residues[self.entry_chains]
+        self.lengths = residue_start[1:] - residue_start[:-1]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, idx):
+        entry = {}
+        chain_seqs = []
+        for c in range(self.entry_chains[idx], self.entry_chains[idx + 1]):
+            letter = str(self.chain_ids[c])
+            start, end = self.chain_residues[c], self.chain_residues[c + 1]
+            chain_seq = self.seq[start:end].tobytes().decode("ascii")
+            xyz = np.array(self.coords[start:end])
+            if self.atoms == ["CA"]:
+                coords = {f"CA_chain_{letter}": xyz}
+            else:
+                coords = {
+                    f"{atom}_chain_{letter}": xyz[:, a]
+                    for a, atom in enumerate(self.atoms)
+                }
+            entry["seq_chain_" + letter] = chain_seq
+            entry["coords_chain_" + letter] = coords
+            chain_seqs.append(chain_seq)
+        entry["name"] = str(self.names[idx])
+        entry["num_of_chains"] = len(chain_seqs)
+        entry["seq"] = "".join(chain_seqs)
+        return entry
+
+
+class StructureStoreWriter:
+    """
+    Writes parsed PDBs to a ``StructureStore`` directory one entry at a time.
+
+    Parameters
+    ----------
+    path : str
+        Output directory, created if needed.
+    ca_only : bool
+        Store CA coordinates only, as parsed for the CA models.
+    """
+
+    def __init__(self, path, ca_only=False):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.atoms = ["CA"] if ca_only else ["N", "CA", "C", "O"]
+        self.coords_file = open(os.path.join(path, "coords.bin"), "wb")
+        self.seq_file = open(os.path.join(path, "seq.bin"), "wb")
+        self.names = []
+        self.chain_ids = []
+        self.entry_chains = [0]
+        self.chain_residues = [0]
+
+    def add(self, entry):
+        for key in entry:
+            if key[:10] != "seq_chain_":
+                continue
+            letter = key[10:]
+            chain_seq = entry[key]
+            chain_coords = entry["coords_chain_" + letter]
+            xyz = np.stack(
+                [
+                    np.asarray(
+                        chain_coords[f"{atom}_chain_{letter}"], np.float32
+                    ).reshape(len(chain_seq), 3)
+                    for atom in self.atoms
+                ],
+                1,
+            )
+            self.coords_file.write(xyz.tobytes())
+            self.seq_file.write(chain_seq.encode("ascii"))
+            self.chain_ids.append(letter)
+            self.chain_residues.append(self.chain_residues[-1] + len(chain_seq))
+        self.names.append(entry["name"])
+        self.entry_chains.append(len(self.chain_ids))
+
+    def close(self):
+        self.coords_file.close()
+        self.seq_file.close()
+        np.savez(
+            os.path.join(self.path, "index.npz"),
+            names=np.array(self.names, dtype=str),
+            chain_ids=np.array(self.chain_ids, dtype=str),
+            entry_chains=np.array(self.entry_chains, dtype=np.int64),
+            chain_residues=np.array(self.chain_residues, dtype=np.int64),
+            atoms=np.array(self.atoms, dtype=str),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class JSONLIndex:
+    """
+    Byte offsets of the entries of a JSONL file of parsed PDBs.
+
+    The index is built in one pass on first use and cached next to the file as
+    ``<jsonl_file>.idx.npz``; it is rebuilt when the file's size or modification
+    time change. Next to the offsets it keeps every entry's sequence length and
+    whether its sequence has letters outside ``alphabet``, so entries can be
+    filtered without decoding them. An entry is only read and decoded when it is
+    accessed.
+
+    Parameters
+    ----------
+    jsonl_file : str
+        Path to the JSONL file.
+    alphabet : str
+        Letters allowed in the sequences.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp() + "/parsed_pdbs.jsonl"
+    >>> with open(path, "w") as f:
+    ...     for name, seq in [("a", "GA"), ("b", "GZW")]:
+    ...         _ = f.write(json.dumps({"name": name, "seq": seq}) + "\\n")
+    >>> index = JSONLIndex(path)
+    >>> len(index), index.lengths.tolist(), index.bad_chars.tolist()
+    (2, [2, 3], [False, True])
+    >>> index[1]
+    {'name': 'b', 'seq': 'GZW'}
+    >>> os.path.exists(path + ".idx.npz")
+    True
+    """
+
+    def __init__(self, jsonl_file, alphabet="ACDEFGHIKLMNPQRSTVWYX-"):
+        self.jsonl_file = jsonl_file
+        index_file = jsonl_file + ".idx.npz"
+        stat = os.stat(jsonl_file)
+        key = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        if os.path.isfile(index_file):
+            index = np.load(index_file)
+            if np.array_equal(index["key"], key) and str(index["alphabet"]) == alphabet:
+                self.offsets = index["offsets"]
+                self.lengths = index["lengths"]
+                self.bad_chars = index["bad_chars"]
+                return
+
+        seq_pattern = re.compile(rb'"seq"\s*:\s*"([^"]*)"')
+        allowed = set(alphabet.encode())
+        offsets, lengths, bad_chars = [0], [], []
+        with open(jsonl_file, "rb") as f:
+            for line in f:
+                offsets.append(offsets[-1] + len(line))
+                if not line.strip():
+                    offsets.pop(-2)
+                    continue
+                match = seq_pattern.search(line)
+                if match is not None:
+                    seq = match.group(1)
+                else:
+                    seq = json.loads(line)["seq"].encode()
+                lengths.append(len(seq))
+                bad_chars.append(not allowed.issuperset(seq))
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.bad_chars = np.array(bad_chars, dtype=bool)
+        try:
+            np.savez(
+                index_file,
+                key=key,
+                alphabet=alphabet,
+                offsets=self.offsets,
+                lengths=self.lengths,
+                bad_chars=self.bad_chars,
+            )
+        except OSError:
+            pass  # read-only location, the index is rebuilt next time
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx):
+        with open(self.jsonl_file, "rb") as f:
+            f.seek(self.offsets[idx])
+            return json.loads(f.read(self.offsets[idx + 1] - self.offsets[idx]))
+
+
+def read_parsed_pdbs(path):
+    """
+    Yields the parsed PDBs saved as JSONL or as a ``StructureStore`` directory.
+    """
+    if os.path.isdir(path):
+        store = StructureStore(path)
+        for idx in range(len(store)):
+            yield store[idx]
+    else:
+        with open(path) as f:
+            for line in f:
+                yield json.loads(line)
+
+
 class StructureDatasetPDB:
     def __init__(
         self,
@@ -807,6 +1196,19 @@ class StructureDatasetPDB:
 
 
 class StructureLoader:
+    """
+    Batches entries of similar length under a residue budget.
+
+    Entries are sorted by length and a batch takes entries while its size times
+    its longest entry stays within ``batch_size`` residues.
+
+    Examples
+    --------
+    >>> dataset = [{"seq": "A" * n} for n in (30, 10, 60, 20, 200)]
+    >>> StructureLoader(dataset, batch_size=90, shuffle=False).clusters
+    [[1, 3, 0], [2], [4]]
+    """
+
     def __init__(
         self,
         dataset,
@@ -819,7 +1221,8 @@ class StructureLoader:
         self.size = len(dataset)
         self.lengths = [len(dataset[i]["seq"]) for i in range(self.size)]
         self.batch_size = batch_size
-        sorted_ix = np.argsort(self.lengths)
+        self.shuffle = shuffle
+        sorted_ix = np.argsort(self.lengths, kind="stable")
 
         # Cluster into batches of similar sizes
         clusters, batch = [], []
@@ -830,8 +1233,10 @@ class StructureLoader:
                 batch.append(ix)
                 batch_max = size
             else:
-                clusters.append(batch)
-                batch, batch_max = [], 0
+                # Entries longer than the budget get a batch of their own
+                if len(batch) > 0:
+                    clusters.append(batch)
+                batch, batch_max = [ix], size
         if len(batch) > 0:
             clusters.append(batch)
         self.clusters = clusters
@@ -840,7 +1245,8 @@ class StructureLoader:
         return len(self.clusters)
 
     def __iter__(self):
-        np.random.shuffle(self.clusters)
+        if self.shuffle:
+            np.random.shuffle(self.clusters)
         for b_idx in self.clusters:
             batch = [self.dataset[i] for i in b_idx]
             yield batch
@@ -878,57 +1284,521 @@ def cat_neighbors_nodes(h_nodes, h_neighbors, E_idx):
     return h_nn
 
 
-class EncLayer(nn.Module):
-    def __init__(self, num_hidden, num_in, dropout=0.1, num_heads=None, scale=30):
-        super(EncLayer, self).__init__()
-        self.num_hidden = num_hidden
-        self.num_in = num_in
-        self.scale = scale
-        self.dropout1 = nn.Dropout(dropout)
-        self.dropout2 = nn.Dropout(dropout)
-        self.dropout3 = nn.Dropout(dropout)
-        self.norm1 = nn.LayerNorm(num_hidden)
-        self.norm2 = nn.LayerNorm(num_hidden)
-        self.norm3 = nn.LayerNorm(num_hidden)
+def nearest_neighbors(X, mask, top_k, block_size=None, eps=1e-6):
+    """
+    k nearest neighbours by euclidean distance, searched in blocks of query rows.
 
-        self.W1 = nn.Linear(num_hidden + num_in, num_hidden, bias=True)
-        self.W2 = nn.Linear(num_hidden, num_hidden, bias=True)
-        self.W3 = nn.Linear(num_hidden, num_hidden, bias=True)
-        self.W11 = nn.Linear(num_hidden + num_in, num_hidden, bias=True)
-        self.W12 = nn.Linear(num_hidden, num_hidden, bias=True)
-        self.W13 = nn.Linear(num_hidden, num_hidden, bias=True)
-        self.act = torch.nn.GELU()
-        self.dense = PositionWiseFeedForward(num_hidden, num_hidden * 4)
+    Only a (B, block_size, L) slab of the distance matrix exists at any time, so
+    peak memory grows linearly with L for a fixed ``block_size``. Every block
+    holds complete rows, so the neighbours match a search over the full (B, L, L)
+    matrix, which is what ``block_size=None`` does.
 
-    def forward(self, h_V, h_E, E_idx, mask_V=None, mask_attend=None):
-        """Parallel computation of full transformer layer"""
+    Parameters
+    ----------
+    X : torch.tensor
+        Coordinates with shape (B, L, 3).
+    mask : torch.tensor
+        1.0 for residues with coordinates, with shape (B, L).
+    top_k : int
+        Number of neighbours, capped at L.
+    block_size : int, optional
+        Number of query residues per block, all of them at once if None.
 
-        h_EV = cat_neighbors_nodes(h_V, h_E, E_idx)
-        h_V_expand = h_V.unsqueeze(-2).expand(-1, -1, h_EV.size(-2), -1)
-        h_EV = torch.cat([h_V_expand, h_EV], -1)
-        h_message = self.W3(self.act(self.W2(self.act(self.W1(h_EV)))))
-        if mask_attend is not None:
-            h_message = mask_attend.unsqueeze(-1) * h_message
-        dh = torch.sum(h_message, -2) / self.scale
-        h_V = self.norm1(h_V + self.dropout1(dh))
+    Returns
+    -------
+    tuple of torch.tensor
+        Neighbour distances and indices, both with shape (B, L, min(top_k, L)).
 
-        dh = self.dense(h_V)
-        h_V = self.norm2(h_V + self.dropout2(dh))
-        if mask_V is not None:
-            mask_V = mask_V.unsqueeze(-1)
-            h_V = mask_V * h_V
+    Examples
+    --------
+    >>> X = 10 * torch.randn(2, 50, 3)
+    >>> mask = torch.ones(2, 50)
+    >>> D_full, E_full = nearest_neighbors(X, mask, 16)
+    >>> D_block, E_block = nearest_neighbors(X, mask, 16, block_size=7)
+    >>> torch.equal(E_full, E_block), torch.equal(D_full, D_block)
+    (True, True)
+    """
+    L = X.shape[1]
+    k = int(np.minimum(top_k, L))
+    block_size = block_size or L
+    D_neighbors, E_idx = [], []
+    for start in range(0, L, block_size):
+        end = min(start + block_size, L)
+        mask_2D = torch.unsqueeze(mask, 1) * torch.unsqueeze(mask[:, start:end], 2)
+        dX = torch.unsqueeze(X, 1) - torch.unsqueeze(X[:, start:end], 2)
+        D = mask_2D * torch.sqrt(torch.sum(dX**2, 3) + eps)
+        D_max, _ = torch.max(D, -1, keepdim=True)
+        # Strictly beyond the farthest residue with coordinates, so missing or
+        # padded residues never tie with it and only fill up rows with fewer
+        # than top_k residues
+        D_adjust = D + (1.0 - mask_2D) * (D_max + 1.0)
+        D_block, E_block = torch.topk(D_adjust, k, dim=-1, largest=False)
+        D_neighbors.append(D_block)
+        E_idx.append(E_block)
+    return torch.cat(D_neighbors, 1), torch.cat(E_idx, 1)
 
-        h_EV = cat_neighbors_nodes(h_V, h_E, E_idx)
-        h_V_expand = h_V.unsqueeze(-2).expand(-1, -1, h_EV.size(-2), -1)
-        h_EV = torch.cat([h_V_expand, h_EV], -1)
-        h_message = self.W13(self.act(self.W12(self.act(self.W11(h_EV)))))
-        h_E = self.norm3(h_E + self.dropout3(h_message))
+
+def _sampling_parameters(temperature, omit_AAs_np, bias_AAs_np, device):
+    """
+    Shapes the temperature and the amino acid omit and bias vectors to broadcast
+    over logits with shape (B, T, 21).
+
+    Each may be shared by all rows, i.e. a scalar temperature and vectors with
+    shape (21,), or given per row with shapes (B,) and (B, 21). A scalar
+    temperature is returned as is.
+    """
+    if not np.isscalar(temperature):
+        temperature = torch.as_tensor(
+            temperature, dtype=torch.float32, device=device
+        ).view(-1, 1, 1)
+    constant = torch.tensor(omit_AAs_np, device=device).view(-1, 1, 21)
+    constant_bias = torch.tensor(bias_AAs_np, device=device).view(-1, 1, 21)
+    return temperature, constant, constant_bias
+
+
+def compile_constraints(
+    temperature,
+    omit_AAs_np,
+    bias_AAs_np,
+    device,
+    omit_AA_mask=None,
+    pssm_coef=None,
+    pssm_bias=None,
+    pssm_multi=0.0,
+    pssm_log_odds_flag=False,
+    pssm_log_odds_mask=None,
+    pssm_bias_flag=False,
+    bias_by_res=None,
+):
+    """
+    Compiles the sampling constraints of a batch once, into what each decoding
+    step applies to its positions.
+
+    A step takes ``softmax(logits / temperature + logit_bias)``, mixes in the
+    PSSM as ``(1 - coef) * probs + bias`` and multiplies by ``weights`` before
+    renormalising once. Constraints that are absent, all zero or the same for
+    every amino acid of a position are left out, and tensors that do not depend
+    on the position have length 1 in that dimension.
+
+    Returns
+    -------
+    temperature : float or torch.tensor
+        As returned by `_sampling_parameters`.
+    logit_bias : torch.tensor
+        Omitted amino acids, amino acid biases and biases by residue, with shape
+        (B or 1, L or 1, 21).
+    pssm_mix : tuple of torch.tensor or None
+        ``coef`` with shape (B, L, 1) and ``bias`` with shape (B, L, 21).
+    weights : torch.tensor or None
+        PSSM log odds and omit masks with shape (B, L, 21).
+
+    Examples
+    --------
+    >>> omit_AA_mask = torch.zeros((1, 3, 21))
+    >>> omit_AA_mask[0, 1, :4] = 1.0
+    >>> _, logit_bias, pssm_mix, weights = compile_constraints(
+    ...     1.0, np.zeros(21), np.zeros(21), "cpu", omit_AA_mask=omit_AA_mask
+    ... )
+    >>> logit_bias.shape, pssm_mix, weights[0, :, 0].tolist()
+    (torch.Size([1, 1, 21]), None, [1.0, 0.0, 1.0])
+    """
+    temperature, constant, constant_bias = _sampling_parameters(
+        temperature, omit_AAs_np, bias_AAs_np, device
+    )
+    logit_bias = constant_bias / temperature - constant * 1e8
+    if bias_by_res is not None and bool(bias_by_res.any()):
+        logit_bias = logit_bias + bias_by_res / temperature
+
+    pssm_mix = None
+    if pssm_bias_flag and bool(pssm_coef.any()):
+        coef = pssm_multi * pssm_coef[:, :, None]
+        pssm_mix = (coef, coef * pssm_bias)
+
+    weights = None
+    if pssm_log_odds_flag:
+        weights = pssm_log_odds_mask + 0.001
+    if omit_AA_mask is not None and bool(omit_AA_mask.any()):
+        keep = 1.0 - omit_AA_mask
+        weights = keep if weights is None else weights * keep
+    if weights is not None and bool((weights == weights[:, :, :1]).all()):
+        # Renormalising cancels weights shared by all amino acids
+        weights = None
+    return temperature, logit_bias, pssm_mix, weights
+
+
+def _constraint_rows(x, t):
+    """Rows of a compiled constraint at positions ``t`` with shape (B, T)."""
+    if x.shape[1] == 1:
+        return x
+    return torch.gather(x, 1, t[:, :, None].expand(-1, -1, x.shape[-1]))
+
+
+def neighbor_order_mask(decoding_order, E_idx):
+    """
+    Marks the neighbours that are decoded before each node.
+
+    Equivalent to gathering the ``E_idx`` columns of the dense
+    ``einsum("ij, biq, bjp->bqp", ...)`` order mask over one-hot permutation
+    matrices, but computed from decoding ranks in O(B * L * K).
+
+    Parameters
+    ----------
+    decoding_order : torch.tensor
+        Node indices in the order they are decoded, with shape (B, L).
+    E_idx : torch.tensor
+        Neighbour indices with shape (B, L, K).
+
+    Returns
+    -------
+    torch.tensor
+        1.0 where neighbour ``E_idx[b, i, k]`` is decoded before node ``i``,
+        0.0 otherwise, with shape (B, L, K).
+
+    Examples
+    --------
+    >>> import glob, os
+    >>> features = ProteinFeatures(128, 128, top_k=48)
+    >>> def einsum_mask(decoding_order, E_idx):
+    ...     L = E_idx.shape[1]
+    ...     P = torch.nn.functional.one_hot(decoding_order, num_classes=L).float()
+    ...     lower = 1 - torch.triu(torch.ones(L, L))
+    ...     dense = torch.einsum("ij, biq, bjp->bqp", lower, P, P)
+    ...     return torch.gather(dense, 2, E_idx)
+    >>> same = []
+    >>> root = os.path.join(os.path.dirname(__file__), "data", "outputs")
+    >>> for path in ("example_1_outputs", "example_2_outputs", "example_6_outputs"):
+    ...     jsonl = os.path.join(root, path, "parsed_pdbs.jsonl")
+    ...     for entry in StructureDataset(jsonl, verbose=False, max_length=5000):
+    ...         X, S, mask = tied_featurize([entry] * 2, "cpu", None)[:3]
+    ...         _, E_idx = features._dist(X[:, :, 1, :], mask)
+    ...         decoding_order = torch.argsort(torch.randn(mask.shape))
+    ...         same.append(
+    ...             torch.equal(
+    ...                 neighbor_order_mask(decoding_order, E_idx),
+    ...                 einsum_mask(decoding_order, E_idx),
+    ...             )
+    ...         )
+    >>> same
+    [True, True, True, True, True, True]
+    """
+    B, L = decoding_order.shape
+    rank = torch.empty_like(decoding_order)
+    rank.scatter_(
+        1,
+        decoding_order,
+        torch.arange(L, device=decoding_order.device).expand(B, L),
+    )
+    rank_neighbors = torch.gather(rank, 1, E_idx.reshape(B, -1)).view(E_idx.shape)
+    return (rank_neighbors < rank.unsqueeze(-1)).float()
+
+
+def neighbor_mask(mask, E_idx):
+    """
+    Marks the neighbours with coordinates, ``mask`` gathered at ``E_idx``.
+
+    Targets shorter than ``top_k`` have padded or missing residues among their
+    neighbours whenever they share a batch with longer ones. Masking the decoder
+    messages of those edges keeps their outputs the same as in a batch of their
+    own.
+
+    Parameters
+    ----------
+    mask : torch.tensor
+        1.0 for residues with coordinates, with shape (B, L).
+    E_idx : torch.tensor
+        Neighbour indices with shape (B, T, K).
+
+    Returns
+    -------
+    torch.tensor
+        ``mask[b, E_idx[b, i, k]]`` with shape (B, T, K).
+
+    Examples
+    --------
+    A 6 residue target gives the same log probabilities alone and packed with a
+    20 residue one, although it has 8 neighbours instead of 6 in the batch:
+
+    >>> model = ProteinMPNN(21, 16, 16, 16, k_neighbors=8, augment_eps=0.0).eval()
+    >>> X, S = 3 * torch.randn(2, 20, 4, 3), torch.randint(0, 21, (2, 20))
+    >>> mask, randn = torch.ones(2, 20), torch.randn(2, 20)
+    >>> mask[0, 6:] = 0
+    >>> residue_idx = torch.arange(20).repeat(2, 1)
+    >>> with torch.no_grad():
+    ...     packed = model(X, S, mask, mask, residue_idx, mask.long(), randn)
+    ...     alone = model(
+    ...         *(x[:1, :6] for x in (X, S, mask, mask, residue_idx)),
+    ...         mask[:1, :6].long(),
+    ...         randn[:1, :6],
+    ...     )
+    >>> torch.allclose(packed[:1, :6], alone, atol=1e-6)
+    True
+    """
+    return gather_nodes(mask.unsqueeze(-1), E_idx).squeeze(-1)
+
+
+def receptive_field(E_idx, seeds, num_hops):
+    """
+    Residues whose features can reach the seeds within ``num_hops`` message passes.
+
+    Node ``i`` reads from its neighbours ``E_idx[:, i]``, so every hop adds the
+    neighbours of the residues found so far.
+
+    Parameters
+    ----------
+    E_idx : torch.tensor
+        Neighbour indices with shape (B, L, K).
+    seeds : torch.tensor
+        True for the residues of interest, with shape (B, L).
+    num_hops : int
+        Number of message passing steps.
+
+    Returns
+    -------
+    torch.tensor
+        True for the seeds and every residue within ``num_hops`` hops of them,
+        with shape (B, L).
+
+    Examples
+    --------
+    >>> E_idx = torch.tensor([[[0, 1], [1, 2], [2, 3], [3, 4], [4, 5], [5, 5]]])
+    >>> seeds = torch.tensor([[True, False, False, False, False, False]])
+    >>> receptive_field(E_idx, seeds, 2)
+    tensor([[ True,  True,  True, False, False, False]])
+    """
+    B, L, K = E_idx.shape
+    reached = seeds.bool()
+    for _ in range(num_hops):
+        hits = torch.zeros((B, L), device=E_idx.device)
+        hits.scatter_add_(
+            1,
+            E_idx.reshape(B, -1),
+            reached.float().unsqueeze(-1).expand(B, L, K).reshape(B, -1),
+        )
+        reached = reached | (hits > 0)
+    return reached
+
+
+def independent_set_order(E_idx, design_mask, randn):
+    """
+    Decoding order whose designable part is a sequence of independent sets.
+
+    The decoder only reads the neighbours in ``E_idx``, so residues that are not
+    neighbours of each other in either direction can be decoded in the same step
+    without changing their conditional distributions. The designable residues are
+    coloured on the symmetrised kNN graph with random priorities taken from
+    ``randn`` (Jones-Plassmann: every round takes the residues that outrank all of
+    their uncoloured neighbours), and each colour becomes one step. Residues that
+    are not designable in any row come first, in the same ``|randn|`` order as the
+    standard decoding order.
+
+    Parameters
+    ----------
+    E_idx : torch.tensor
+        Neighbour indices with shape (B, L, K).
+    design_mask : torch.tensor
+        1.0 for designable residues, with shape (B, L).
+    randn : torch.tensor
+        Gaussian noise with shape (B, L).
+
+    Returns
+    -------
+    decoding_order : torch.tensor
+        Residue indices in decoding order with shape (B, L).
+    step_sizes : list of int
+        Number of residues per step after the non-designable ones. The steps are
+        shared by all rows, so the colouring uses the union of the rows' graphs
+        and designable residues and the priorities of the first row.
+
+    Examples
+    --------
+    >>> X = 10 * torch.randn(2, 60, 3)
+    >>> _, E_idx = nearest_neighbors(X, torch.ones(2, 60), 8)
+    >>> design_mask = torch.ones(2, 60)
+    >>> design_mask[:, :10] = 0
+    >>> randn = torch.randn(2, 60)
+    >>> order, step_sizes = independent_set_order(E_idx, design_mask, randn)
+    >>> sum(step_sizes), len(step_sizes) < 50
+    (50, True)
+    >>> start, independent = 10, []
+    >>> for size in step_sizes:
+    ...     t = order[:, start : start + size]
+    ...     in_step = torch.zeros(2, 60, dtype=torch.bool).scatter_(1, t, True)
+    ...     out_edges = torch.gather(in_step, 1, E_idx[:, :, 1:].flatten(1))
+    ...     out_edges = out_edges.view(2, 60, 7)
+    ...     independent.append(not (in_step[:, :, None] & out_edges).any())
+    ...     start += size
+    >>> all(independent)
+    True
+    """
+    B, L, K = E_idx.shape
+    device = E_idx.device
+    designable = (design_mask > 0).any(0)
+    priority = randn[0]
+    src = torch.arange(L, device=device)[None, :, None].expand(B, L, K).flatten()
+    dst = E_idx.flatten()
+    colour = torch.full((L,), -1, dtype=torch.long, device=device)
+    uncoloured = designable.clone()
+    num_colours = 0
+    while uncoloured.any():
+        edge = uncoloured[src] & uncoloured[dst] & (src != dst)
+        outranked = torch.zeros(L, device=device)
+        outranked.scatter_add_(0, src, (edge & (priority[dst] > priority[src])).float())
+        outranked.scatter_add_(0, dst, (edge & (priority[src] > priority[dst])).float())
+        chosen = uncoloured & (outranked == 0)
+        colour[chosen] = num_colours
+        uncoloured &= ~chosen
+        num_colours += 1
+
+    # Non-designable residues sort below 1 by |randn|, each colour c at c + 1
+    fixed_key = torch.abs(randn) / (1.0 + torch.abs(randn))
+    key = torch.where(designable, colour.float() + 1.0, fixed_key)
+    decoding_order = torch.argsort(key)
+    step_sizes = torch.bincount(colour[designable], minlength=num_colours).tolist()
+    return decoding_order, step_sizes
+
+
+def tied_decoding_order(decoding_order, tied_pos):
+    """
+    Groups a decoding order so that tied positions are decoded together.
+
+    Every group takes the place of its earliest member in ``decoding_order`` and
+    keeps the member order of ``tied_pos``. A position listed in several groups
+    belongs to the first one, as do positions that are not tied in singleton
+    groups.
+
+    Parameters
+    ----------
+    decoding_order : torch.tensor
+        Residue indices in decoding order with shape (L,).
+    tied_pos : list of list of int
+        Groups of tied residue indices.
+
+    Returns
+    -------
+    list of list of int
+        Groups in decoding order.
+
+    Examples
+    --------
+    >>> tied_decoding_order(torch.tensor([4, 0, 3, 2, 1]), [[1, 3], [0, 2]])
+    [[4], [0, 2], [1, 3]]
+    """
+    decoding_order = decoding_order.cpu().numpy()
+    L = decoding_order.shape[0]
+    members = [p for group in tied_pos for p in group]
+    member_group = np.repeat(np.arange(len(tied_pos)), [len(g) for g in tied_pos])
+    # Untied positions p form their own group len(tied_pos) + p
+    group_of = len(tied_pos) + np.arange(L)
+    if members:
+        positions, first = np.unique(members, return_index=True)
+        group_of[positions] = member_group[first]
+    rank = np.empty(L, dtype=np.int64)
+    rank[decoding_order] = np.arange(L)
+    first_rank = np.full(len(tied_pos) + L, L)
+    np.minimum.at(first_rank, group_of, rank)
+    groups = [g for g in np.argsort(first_rank, kind="stable") if first_rank[g] < L]
+    return [
+        list(tied_pos[g]) if g < len(tied_pos) else [g - len(tied_pos)] for g in groups
+    ]
+
+
+class EncLayer(nn.Module):
+    """
+    Encoder layer updating the node and edge states from the messages of every
+    edge, ``W([h_V_i, h_E_ij, h_V_j])`` for ``W1`` and ``W11``.
+
+    With ``factorized`` the node blocks of ``W1`` and ``W11`` are applied once
+    per node and gathered to the edges, so only the edge block is applied per
+    edge and the concatenated (B, L, K, 3H) inputs are never built. The
+    parameters are the same, so both variants load the same checkpoints.
+
+    Examples
+    --------
+    >>> layer = EncLayer(8, 16, dropout=0.0).eval()
+    >>> factorized = EncLayer(8, 16, dropout=0.0, factorized=True).eval()
+    >>> _ = factorized.load_state_dict(layer.state_dict())
+    >>> h_V, h_E = torch.randn(2, 5, 8), torch.randn(2, 5, 3, 8)
+    >>> E_idx = torch.randint(0, 5, (2, 5, 3))
+    >>> all(
+    ...     torch.allclose(a, b, atol=1e-5)
+    ...     for a, b in zip(layer(h_V, h_E, E_idx), factorized(h_V, h_E, E_idx))
+    ... )
+    True
+    """
+
+    def __init__(
+        self,
+        num_hidden,
+        num_in,
+        dropout=0.1,
+        num_heads=None,
+        scale=30,
+        factorized=False,
+    ):
+        super().__init__()
+        self.num_hidden = num_hidden
+        self.num_in = num_in
+        self.scale = scale
+        self.factorized = factorized
+        self.dropout1 = nn.Dropout(dropout)
+        self.dropout2 = nn.Dropout(dropout)
+        self.dropout3 = nn.Dropout(dropout)
+        self.norm1 = nn.LayerNorm(num_hidden)
+        self.norm2 = nn.LayerNorm(num_hidden)
+        self.norm3 = nn.LayerNorm(num_hidden)
+
+        self.W1 = nn.Linear(num_hidden + num_in, num_hidden, bias=True)
+        self.W2 = nn.Linear(num_hidden, num_hidden, bias=True)
+        self.W3 = nn.Linear(num_hidden, num_hidden, bias=True)
+        self.W11 = nn.Linear(num_hidden + num_in, num_hidden, bias=True)
+        self.W12 = nn.Linear(num_hidden, num_hidden, bias=True)
+        self.W13 = nn.Linear(num_hidden, num_hidden, bias=True)
+        self.act = torch.nn.GELU()
+        self.dense = PositionWiseFeedForward(num_hidden, num_hidden * 4)
+
+    def _messages(self, W, h_V, h_E, E_idx):
+        """First linear layer ``W`` of the messages, with shape (B, L, K, H)."""
+        if self.factorized:
+            W_i, W_E, W_j = W.weight.split(
+                [self.num_hidden, self.num_in - self.num_hidden, self.num_hidden], 1
+            )
+            return (
+                F.linear(h_V, W_i, W.bias).unsqueeze(-2)
+                + F.linear(h_E, W_E)
+                + gather_nodes(F.linear(h_V, W_j), E_idx)
+            )
+        h_EV = cat_neighbors_nodes(h_V, h_E, E_idx)
+        h_V_expand = h_V.unsqueeze(-2).expand(-1, -1, h_EV.size(-2), -1)
+        h_EV = torch.cat([h_V_expand, h_EV], -1)
+        return W(h_EV)
+
+    def forward(self, h_V, h_E, E_idx, mask_V=None, mask_attend=None):
+        """Parallel computation of full transformer layer"""
+
+        h_message = self.W3(
+            self.act(self.W2(self.act(self._messages(self.W1, h_V, h_E, E_idx))))
+        )
+        if mask_attend is not None:
+            h_message = mask_attend.unsqueeze(-1) * h_message
+        dh = torch.sum(h_message, -2) / self.scale
+        h_V = self.norm1(h_V + self.dropout1(dh))
+
+        dh = self.dense(h_V)
+        h_V = self.norm2(h_V + self.dropout2(dh))
+        if mask_V is not None:
+            mask_V = mask_V.unsqueeze(-1)
+            h_V = mask_V * h_V
+
+        h_message = self.W13(
+            self.act(self.W12(self.act(self._messages(self.W11, h_V, h_E, E_idx))))
+        )
+        h_E = self.norm3(h_E + self.dropout3(h_message))
         return h_V, h_E
 
 
 class DecLayer(nn.Module):
     def __init__(self, num_hidden, num_in, dropout=0.1, num_heads=None, scale=30):
-        super(DecLayer, self).__init__()
+        super().__init__()
         self.num_hidden = num_hidden
         self.num_in = num_in
         self.scale = scale
@@ -949,8 +1819,20 @@ class DecLayer(nn.Module):
         # Concatenate h_V_i to h_E_ij
         h_V_expand = h_V.unsqueeze(-2).expand(-1, -1, h_E.size(-2), -1)
         h_EV = torch.cat([h_V_expand, h_E], -1)
+        return self._update(h_V, self.W1(h_EV), mask_V, mask_attend)
+
+    def _W1_blocks(self):
+        """
+        Column blocks of ``W1`` for ``h_V_i``, ``h_E_ij``, ``h_S_j`` and ``h_V_j``.
+
+        ``W1`` is linear, so callers that know the parts of ``h_E`` can apply the
+        node blocks once per node and gather them, see `ProteinMPNN`.
+        """
+        return self.W1.weight.split(self.num_hidden, 1)
 
-        h_message = self.W3(self.act(self.W2(self.act(self.W1(h_EV)))))
+    def _update(self, h_V, h_W1, mask_V=None, mask_attend=None):
+        """The layer from the first linear layer of its messages, ``h_W1``, on."""
+        h_message = self.W3(self.act(self.W2(self.act(h_W1))))
         if mask_attend is not None:
             h_message = mask_attend.unsqueeze(-1) * h_message
         dh = torch.sum(h_message, -2) / self.scale
@@ -969,7 +1851,7 @@ class DecLayer(nn.Module):
 
 class PositionWiseFeedForward(nn.Module):
     def __init__(self, num_hidden, num_ff):
-        super(PositionWiseFeedForward, self).__init__()
+        super().__init__()
         self.W_in = nn.Linear(num_hidden, num_ff, bias=True)
         self.W_out = nn.Linear(num_ff, num_hidden, bias=True)
         self.act = torch.nn.GELU()
@@ -982,7 +1864,7 @@ class PositionWiseFeedForward(nn.Module):
 
 class PositionalEncodings(nn.Module):
     def __init__(self, num_embeddings, max_relative_feature=32):
-        super(PositionalEncodings, self).__init__()
+        super().__init__()
         self.num_embeddings = num_embeddings
         self.max_relative_feature = max_relative_feature
         self.linear = nn.Linear(2 * max_relative_feature + 1 + 1, num_embeddings)
@@ -1006,12 +1888,14 @@ class CA_ProteinFeatures(nn.Module):
         top_k=30,
         augment_eps=0.0,
         num_chain_embeddings=16,
+        knn_block_size=None,
     ):
         """Extract protein features"""
-        super(CA_ProteinFeatures, self).__init__()
+        super().__init__()
         self.edge_features = edge_features
         self.node_features = node_features
         self.top_k = top_k
+        self.knn_block_size = knn_block_size
         self.augment_eps = augment_eps
         self.num_rbf = num_rbf
         self.num_positional_embeddings = num_positional_embeddings
@@ -1106,18 +1990,13 @@ class CA_ProteinFeatures(nn.Module):
 
     def _dist(self, X, mask, eps=1e-6):
         """Pairwise euclidean distances"""
-        # Convolutional network on NCHW
-        mask_2D = torch.unsqueeze(mask, 1) * torch.unsqueeze(mask, 2)
-        dX = torch.unsqueeze(X, 1) - torch.unsqueeze(X, 2)
-        D = mask_2D * torch.sqrt(torch.sum(dX**2, 3) + eps)
-
         # Identify k nearest neighbors (including self)
-        D_max, _ = torch.max(D, -1, keepdim=True)
-        D_adjust = D + (1.0 - mask_2D) * D_max
-        D_neighbors, E_idx = torch.topk(
-            D_adjust, np.minimum(self.top_k, X.shape[1]), dim=-1, largest=False
+        D_neighbors, E_idx = nearest_neighbors(
+            X, mask, self.top_k, block_size=self.knn_block_size, eps=eps
+        )
+        mask_neighbors = (
+            gather_nodes(mask.unsqueeze(-1), E_idx) * mask[:, :, None, None]
         )
-        mask_neighbors = gather_edges(mask_2D.unsqueeze(-1), E_idx)
         return D_neighbors, E_idx, mask_neighbors
 
     def _rbf(self, D):
@@ -1132,21 +2011,22 @@ class CA_ProteinFeatures(nn.Module):
         return RBF
 
     def _get_rbf(self, A, B, E_idx):
-        D_A_B = torch.sqrt(
-            torch.sum((A[:, :, None, :] - B[:, None, :, :]) ** 2, -1) + 1e-6
-        )  # [B, L, L]
-        D_A_B_neighbors = gather_edges(D_A_B[:, :, :, None], E_idx)[
-            :, :, :, 0
-        ]  # [B,L,K]
+        B_neighbors = gather_nodes(B, E_idx)  # [B, L, K, 3]
+        D_A_B_neighbors = torch.sqrt(
+            torch.sum((A[:, :, None, :] - B_neighbors) ** 2, -1) + 1e-6
+        )  # [B,L,K]
         RBF_A_B = self._rbf(D_A_B_neighbors)
         return RBF_A_B
 
-    def forward(self, Ca, mask, residue_idx, chain_labels):
+    def forward(self, Ca, mask, residue_idx, chain_labels, neighbors=None):
         """Featurize coordinates as an attributed graph"""
         if self.augment_eps > 0:
             Ca = Ca + self.augment_eps * torch.randn_like(Ca)
 
-        D_neighbors, E_idx, mask_neighbors = self._dist(Ca, mask)
+        if neighbors is None:
+            D_neighbors, E_idx, mask_neighbors = self._dist(Ca, mask)
+        else:
+            D_neighbors, E_idx = neighbors
 
         Ca_0 = torch.zeros(Ca.shape, device=Ca.device)
         Ca_2 = torch.zeros(Ca.shape, device=Ca.device)
@@ -1172,11 +2052,18 @@ class CA_ProteinFeatures(nn.Module):
 
         RBF_all = torch.cat(tuple(RBF_all), dim=-1)
 
-        offset = residue_idx[:, :, None] - residue_idx[:, None, :]
-        offset = gather_edges(offset[:, :, :, None], E_idx)[:, :, :, 0]  # [B, L, K]
+        offset = (
+            residue_idx[:, :, None]
+            - gather_nodes(residue_idx.unsqueeze(-1), E_idx)[:, :, :, 0]
+        )  # [B, L, K]
 
-        d_chains = ((chain_labels[:, :, None] - chain_labels[:, None, :]) == 0).long()
-        E_chains = gather_edges(d_chains[:, :, :, None], E_idx)[:, :, :, 0]
+        E_chains = (
+            (
+                chain_labels[:, :, None]
+                - gather_nodes(chain_labels.unsqueeze(-1), E_idx)[:, :, :, 0]
+            )
+            == 0
+        ).long()
         E_positional = self.embeddings(offset.long(), E_chains)
         E = torch.cat((E_positional, RBF_all, O_features), -1)
 
@@ -1196,12 +2083,14 @@ class ProteinFeatures(nn.Module):
         top_k=30,
         augment_eps=0.0,
         num_chain_embeddings=16,
+        knn_block_size=None,
     ):
         """Extract protein features"""
-        super(ProteinFeatures, self).__init__()
+        super().__init__()
         self.edge_features = edge_features
         self.node_features = node_features
         self.top_k = top_k
+        self.knn_block_size = knn_block_size
         self.augment_eps = augment_eps
         self.num_rbf = num_rbf
         self.num_positional_embeddings = num_positional_embeddings
@@ -1212,16 +2101,9 @@ class ProteinFeatures(nn.Module):
         self.norm_edges = nn.LayerNorm(edge_features)
 
     def _dist(self, X, mask, eps=1e-6):
-        mask_2D = torch.unsqueeze(mask, 1) * torch.unsqueeze(mask, 2)
-        dX = torch.unsqueeze(X, 1) - torch.unsqueeze(X, 2)
-        D = mask_2D * torch.sqrt(torch.sum(dX**2, 3) + eps)
-        D_max, _ = torch.max(D, -1, keepdim=True)
-        D_adjust = D + (1.0 - mask_2D) * D_max
-        sampled_top_k = self.top_k
-        D_neighbors, E_idx = torch.topk(
-            D_adjust, np.minimum(self.top_k, X.shape[1]), dim=-1, largest=False
+        return nearest_neighbors(
+            X, mask, self.top_k, block_size=self.knn_block_size, eps=eps
         )
-        return D_neighbors, E_idx
 
     def _rbf(self, D):
         device = D.device
@@ -1234,16 +2116,14 @@ class ProteinFeatures(nn.Module):
         return RBF
 
     def _get_rbf(self, A, B, E_idx):
-        D_A_B = torch.sqrt(
-            torch.sum((A[:, :, None, :] - B[:, None, :, :]) ** 2, -1) + 1e-6
-        )  # [B, L, L]
-        D_A_B_neighbors = gather_edges(D_A_B[:, :, :, None], E_idx)[
-            :, :, :, 0
-        ]  # [B,L,K]
+        B_neighbors = gather_nodes(B, E_idx)  # [B, L, K, 3]
+        D_A_B_neighbors = torch.sqrt(
+            torch.sum((A[:, :, None, :] - B_neighbors) ** 2, -1) + 1e-6
+        )  # [B,L,K]
         RBF_A_B = self._rbf(D_A_B_neighbors)
         return RBF_A_B
 
-    def forward(self, X, mask, residue_idx, chain_labels):
+    def forward(self, X, mask, residue_idx, chain_labels, neighbors=None):
         if self.augment_eps > 0:
             X = X + self.augment_eps * torch.randn_like(X)
 
@@ -1256,7 +2136,10 @@ class ProteinFeatures(nn.Module):
         C = X[:, :, 2, :]
         O = X[:, :, 3, :]
 
-        D_neighbors, E_idx = self._dist(Ca, mask)
+        if neighbors is None:
+            D_neighbors, E_idx = self._dist(Ca, mask)
+        else:
+            D_neighbors, E_idx = neighbors
 
         RBF_all = []
         RBF_all.append(self._rbf(D_neighbors))  # Ca-Ca
@@ -1286,13 +2169,18 @@ class ProteinFeatures(nn.Module):
         RBF_all.append(self._get_rbf(C, O, E_idx))  # C-O
         RBF_all = torch.cat(tuple(RBF_all), dim=-1)
 
-        offset = residue_idx[:, :, None] - residue_idx[:, None, :]
-        offset = gather_edges(offset[:, :, :, None], E_idx)[:, :, :, 0]  # [B, L, K]
+        offset = (
+            residue_idx[:, :, None]
+            - gather_nodes(residue_idx.unsqueeze(-1), E_idx)[:, :, :, 0]
+        )  # [B, L, K]
 
-        d_chains = (
-            (chain_labels[:, :, None] - chain_labels[:, None, :]) == 0
+        E_chains = (
+            (
+                chain_labels[:, :, None]
+                - gather_nodes(chain_labels.unsqueeze(-1), E_idx)[:, :, :, 0]
+            )
+            == 0
         ).long()  # find self vs non-self interaction
-        E_chains = gather_edges(d_chains[:, :, :, None], E_idx)[:, :, :, 0]
         E_positional = self.embeddings(offset.long(), E_chains)
         E = torch.cat((E_positional, RBF_all), -1)
         E = self.edge_embedding(E)
@@ -1314,23 +2202,35 @@ class ProteinMPNN(nn.Module):
         augment_eps=0.05,
         dropout=0.1,
         ca_only=False,
+        knn_block_size=None,
+        factorized=False,
     ):
-        super(ProteinMPNN, self).__init__()
+        super().__init__()
 
         # Hyperparameters
         self.node_features = node_features
         self.edge_features = edge_features
         self.hidden_dim = hidden_dim
+        # Apply the node blocks of W1 once per node, see EncLayer
+        self.factorized = factorized
 
         # Featurization layers
         if ca_only:
             self.features = CA_ProteinFeatures(
-                node_features, edge_features, top_k=k_neighbors, augment_eps=augment_eps
+                node_features,
+                edge_features,
+                top_k=k_neighbors,
+                augment_eps=augment_eps,
+                knn_block_size=knn_block_size,
             )
             self.W_v = nn.Linear(node_features, hidden_dim, bias=True)
         else:
             self.features = ProteinFeatures(
-                node_features, edge_features, top_k=k_neighbors, augment_eps=augment_eps
+                node_features,
+                edge_features,
+                top_k=k_neighbors,
+                augment_eps=augment_eps,
+                knn_block_size=knn_block_size,
             )
 
         self.W_e = nn.Linear(edge_features, hidden_dim, bias=True)
@@ -1339,7 +2239,9 @@ class ProteinMPNN(nn.Module):
         # Encoder layers
         self.encoder_layers = nn.ModuleList(
             [
-                EncLayer(hidden_dim, hidden_dim * 2, dropout=dropout)
+                EncLayer(
+                    hidden_dim, hidden_dim * 2, dropout=dropout, factorized=factorized
+                )
                 for _ in range(num_encoder_layers)
             ]
         )
@@ -1357,6 +2259,109 @@ class ProteinMPNN(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
+    def encode(self, X, mask, residue_idx, chain_encoding_all, neighbors=None):
+        """
+        Featurize a backbone and run the encoder layers once.
+
+        The structure embedding only depends on the backbone, so the returned
+        dictionary can be passed as ``encoding`` to `decode`, `sample`,
+        `tied_sample`, `conditional_probs` and `unconditional_probs` to share a
+        single encoder pass between sampling temperatures, batches and scoring.
+
+        Parameters
+        ----------
+        X : torch.tensor
+            Backbone coordinates with shape (B, L, 4, 3), or (B, L, 3) for CA-only
+            models.
+        mask : torch.tensor
+            1.0 for residues with coordinates, 0.0 for missing or padded ones, with
+            shape (B, L).
+        residue_idx : torch.tensor
+            Residue indices with shape (B, L).
+        chain_encoding_all : torch.tensor
+            Chain labels with shape (B, L).
+        neighbors : tuple of torch.tensor, optional
+            Precomputed neighbour distances and indices, both with shape
+            (B, L, K), used instead of a kNN search, e.g. from `local_subgraph`.
+
+        Returns
+        -------
+        dict
+            ``h_V`` node embeddings (B, L, H), ``h_E`` edge embeddings
+            (B, L, K, H), ``E_idx`` neighbour indices (B, L, K) and ``mask`` (B, L).
+
+        Notes
+        -----
+        With ``augment_eps > 0`` every featurization draws new backbone noise, so
+        an encoding should only be reused when the backbone is not perturbed.
+        """
+        E, E_idx = self.features(
+            X, mask, residue_idx, chain_encoding_all, neighbors=neighbors
+        )
+        h_V = torch.zeros((E.shape[0], E.shape[1], E.shape[-1]), device=E.device)
+        h_E = self.W_e(E)
+
+        # Encoder is unmasked self-attention
+        mask_attend = gather_nodes(mask.unsqueeze(-1), E_idx).squeeze(-1)
+        mask_attend = mask.unsqueeze(-1) * mask_attend
+        for layer in self.encoder_layers:
+            h_V, h_E = layer(h_V, h_E, E_idx, mask, mask_attend)
+
+        return {"h_V": h_V, "h_E": h_E, "E_idx": E_idx, "mask": mask}
+
+    def local_subgraph(self, X, mask, design_mask):
+        """
+        Smallest subgraph that determines the outputs at the designable residues.
+
+        Each encoder and decoder layer passes messages one kNN hop, so the
+        sequences, probabilities and scores of the designable residues only depend
+        on the residues within ``num_encoder_layers + num_decoder_layers`` hops,
+        and on the exact neighbour lists of the residues one hop closer. Running
+        `encode`, `sample` and `forward` on the residues ``idx`` with
+        ``neighbors`` from the full structure gives the same results at the
+        designable residues as the full structure does, for any decoding order
+        restricted to ``idx``.
+
+        Parameters
+        ----------
+        X : torch.tensor
+            Backbone coordinates with shape (B, L, 4, 3).
+        mask : torch.tensor
+            1.0 for residues with coordinates, with shape (B, L).
+        design_mask : torch.tensor
+            1.0 for designable residues, with shape (B, L).
+
+        Returns
+        -------
+        dict
+            ``idx`` residue indices of the subgraph (N,) shared by all rows and
+            ``neighbors``, the neighbour distances and subgraph indices with shape
+            (B, N, K) to pass to `encode`.
+
+        Notes
+        -----
+        CA-only models also read the sequence neighbours ``i - 1`` and ``i + 1``
+        of every residue, which a subgraph does not preserve, and backbone noise
+        would be drawn for different residues, so neither is supported.
+        """
+        if isinstance(self.features, CA_ProteinFeatures):
+            raise ValueError("local_subgraph needs a full backbone model")
+        if self.features.augment_eps > 0:
+            raise ValueError("local_subgraph needs a model without backbone noise")
+        D_neighbors, E_idx = self.features._dist(X[:, :, 1, :], mask)
+        num_hops = len(self.encoder_layers) + len(self.decoder_layers)
+        reached = receptive_field(E_idx, design_mask > 0, num_hops).any(0)
+        idx = torch.nonzero(reached)[:, 0]
+        remap = torch.full_like(reached, -1, dtype=torch.long)
+        remap[idx] = torch.arange(idx.shape[0], device=idx.device)
+        E_idx_local = remap[E_idx[:, idx]]
+        # Edges that leave the subgraph point back to their own residue
+        self_idx = torch.arange(idx.shape[0], device=idx.device)[None, :, None]
+        E_idx_local = torch.where(
+            E_idx_local < 0, self_idx.expand_as(E_idx_local), E_idx_local
+        )
+        return {"idx": idx, "neighbors": (D_neighbors[:, idx], E_idx_local)}
+
     def forward(
         self,
         X,
@@ -1368,19 +2373,127 @@ class ProteinMPNN(nn.Module):
         randn,
         use_input_decoding_order=False,
         decoding_order=None,
+        encoding=None,
+        context_chunk_size=None,
     ):
         """Graph-conditioned sequence model"""
-        device = X.device
-        # Prepare node and edge embeddings
-        E, E_idx = self.features(X, mask, residue_idx, chain_encoding_all)
-        h_V = torch.zeros((E.shape[0], E.shape[1], E.shape[-1]), device=E.device)
-        h_E = self.W_e(E)
+        if encoding is None:
+            encoding = self.encode(X, mask, residue_idx, chain_encoding_all)
+        return self.decode(
+            encoding,
+            S,
+            chain_M,
+            randn,
+            use_input_decoding_order=use_input_decoding_order,
+            decoding_order=decoding_order,
+            context_chunk_size=context_chunk_size,
+        )
 
-        # Encoder is unmasked self-attention
-        mask_attend = gather_nodes(mask.unsqueeze(-1), E_idx).squeeze(-1)
-        mask_attend = mask.unsqueeze(-1) * mask_attend
-        for layer in self.encoder_layers:
-            h_V, h_E = layer(h_V, h_E, E_idx, mask, mask_attend)
+    def decode(
+        self,
+        encoding,
+        S,
+        chain_M,
+        randn,
+        use_input_decoding_order=False,
+        decoding_order=None,
+        context_chunk_size=None,
+    ):
+        """
+        Teacher-forced decoder pass over the output of `encode`
+
+        With ``context_chunk_size`` the nodes are decoded in chunks of that many
+        in decoding order, building their encoder context on demand like `sample`.
+
+        Examples
+        --------
+        >>> model = ProteinMPNN(21, 16, 16, 16, k_neighbors=4, augment_eps=0.0).eval()
+        >>> X, S = torch.randn(2, 9, 4, 3), torch.randint(0, 21, (2, 9))
+        >>> mask, randn = torch.ones(2, 9), torch.randn(2, 9)
+        >>> residue_idx = torch.arange(9).repeat(2, 1)
+        >>> with torch.no_grad():
+        ...     encoding = model.encode(X, mask, residue_idx, mask.long())
+        ...     full = model.decode(encoding, S, mask, randn)
+        ...     chunked = model.decode(encoding, S, mask, randn, context_chunk_size=2)
+        >>> torch.allclose(full, chunked, atol=1e-6)
+        True
+
+        Factorized layers load the same weights and give the same outputs:
+
+        >>> factorized = ProteinMPNN(
+        ...     21, 16, 16, 16, k_neighbors=4, augment_eps=0.0, factorized=True
+        ... ).eval()
+        >>> _ = factorized.load_state_dict(model.state_dict())
+        >>> def sample(mpnn, encoding):
+        ...     torch.manual_seed(0)
+        ...     return mpnn.sample(
+        ...         X, randn, S, mask, mask.long(), residue_idx, mask=mask,
+        ...         omit_AAs_np=np.zeros(21), bias_AAs_np=np.zeros(21),
+        ...         chain_M_pos=mask, encoding=encoding, return_log_probs=True,
+        ...     )
+        >>> with torch.no_grad():
+        ...     encoding_f = factorized.encode(X, mask, residue_idx, mask.long())
+        ...     decoded = factorized.decode(encoding_f, S, mask, randn)
+        ...     sampled = sample(model, encoding)
+        ...     sampled_f = sample(factorized, encoding_f)
+        >>> torch.allclose(encoding["h_E"], encoding_f["h_E"], atol=1e-5)
+        True
+        >>> torch.allclose(full, decoded, atol=1e-5)
+        True
+        >>> torch.equal(sampled["S"], sampled_f["S"])
+        True
+        >>> torch.allclose(sampled["log_probs"], sampled_f["log_probs"], atol=1e-5)
+        True
+        """
+        # update chain_M to include missing regions
+        chain_M = chain_M * encoding["mask"]
+        if not use_input_decoding_order:
+            decoding_order = torch.argsort(
+                (chain_M + 0.0001) * (torch.abs(randn))
+            )  # [numbers will be smaller for places where chain_M = 0.0 and higher for places where chain_M = 1.0]
+        if context_chunk_size is None and self.factorized:
+            h_V_stack = self._factorized_decoder_states(encoding, S, decoding_order)
+        elif context_chunk_size is None:
+            h_V_stack, _, _ = self._decoder_states(encoding, S, decoding_order)
+        else:
+            h_V, h_E, E_idx, mask = (
+                encoding["h_V"],
+                encoding["h_E"],
+                encoding["E_idx"],
+                encoding["mask"],
+            )
+            mask_attend = neighbor_order_mask(decoding_order, E_idx).unsqueeze(-1)
+            mask_bw = mask.view([mask.size(0), mask.size(1), 1, 1]) * mask_attend
+            h_V_stack = [h_V] + [torch.zeros_like(h_V) for _ in self.decoder_layers]
+            self._decode_positions(
+                decoding_order,
+                h_V_stack,
+                self.W_s(S),
+                h_E,
+                E_idx,
+                None,
+                mask_bw,
+                mask,
+                chunk_size=context_chunk_size,
+            )
+        logits = self.W_out(h_V_stack[-1])
+        log_probs = F.log_softmax(logits, dim=-1)
+        return log_probs
+
+    def _decoder_states(self, encoding, S, decoding_order):
+        """
+        Teacher-forced decoder states of every layer.
+
+        Returns the list of node states from the encoder output to the last
+        decoder layer, and the encoder features and mask of the edges to residues
+        decoded later and earlier, as used by `_decode_positions`.
+        """
+        h_V, h_E, E_idx, mask = (
+            encoding["h_V"],
+            encoding["h_E"],
+            encoding["E_idx"],
+            encoding["mask"],
+        )
 
         # Concatenate sequence embeddings for autoregressive decoder
         h_S = self.W_s(S)
@@ -1390,36 +2503,267 @@ class ProteinMPNN(nn.Module):
         h_EX_encoder = cat_neighbors_nodes(torch.zeros_like(h_S), h_E, E_idx)
         h_EXV_encoder = cat_neighbors_nodes(h_V, h_EX_encoder, E_idx)
 
-        chain_M = chain_M * mask  # update chain_M to include missing regions
-        if not use_input_decoding_order:
-            decoding_order = torch.argsort(
-                (chain_M + 0.0001) * (torch.abs(randn))
-            )  # [numbers will be smaller for places where chain_M = 0.0 and higher for places where chain_M = 1.0]
-        mask_size = E_idx.shape[1]
-        permutation_matrix_reverse = torch.nn.functional.one_hot(
-            decoding_order, num_classes=mask_size
-        ).float()
-        order_mask_backward = torch.einsum(
-            "ij, biq, bjp->bqp",
-            (1 - torch.triu(torch.ones(mask_size, mask_size, device=device))),
-            permutation_matrix_reverse,
-            permutation_matrix_reverse,
-        )
-        mask_attend = torch.gather(order_mask_backward, 2, E_idx).unsqueeze(-1)
+        mask_attend = neighbor_order_mask(decoding_order, E_idx).unsqueeze(-1)
         mask_1D = mask.view([mask.size(0), mask.size(1), 1, 1])
         mask_bw = mask_1D * mask_attend
         mask_fw = mask_1D * (1.0 - mask_attend)
 
         h_EXV_encoder_fw = mask_fw * h_EXV_encoder
+        mask_neighbors = neighbor_mask(mask, E_idx)
+        h_V_stack = [h_V]
         for layer in self.decoder_layers:
             # Masked positions attend to encoder information, unmasked see.
-            h_ESV = cat_neighbors_nodes(h_V, h_ES, E_idx)
+            h_ESV = cat_neighbors_nodes(h_V_stack[-1], h_ES, E_idx)
             h_ESV = mask_bw * h_ESV + h_EXV_encoder_fw
-            h_V = layer(h_V, h_ESV, mask)
+            h_V_stack.append(layer(h_V_stack[-1], h_ESV, mask, mask_neighbors))
+        return h_V_stack, h_EXV_encoder_fw, mask_bw
 
-        logits = self.W_out(h_V)
-        log_probs = F.log_softmax(logits, dim=-1)
-        return log_probs
+    def _factorized_decoder_states(self, encoding, S, decoding_order):
+        """
+        Teacher-forced decoder states of every layer with factorized messages.
+
+        The decoder input of edge ``ij`` is ``[h_V_i, h_E_ij, h_S_j, h_V_j]`` with
+        the sequence and current states of ``j`` if it is decoded before ``i``,
+        and no sequence and the encoder states of ``j`` otherwise. Each block of
+        ``W1`` is applied to the nodes or edges it reads, so only ``h_E`` is
+        projected per edge.
+        """
+        h_V, h_E, E_idx, mask = (
+            encoding["h_V"],
+            encoding["h_E"],
+            encoding["E_idx"],
+            encoding["mask"],
+        )
+        h_S = self.W_s(S)
+        mask_attend = neighbor_order_mask(decoding_order, E_idx).unsqueeze(-1)
+        mask_1D = mask.view([mask.size(0), mask.size(1), 1, 1])
+        mask_bw = mask_1D * mask_attend
+        mask_fw = mask_1D * (1.0 - mask_attend)
+        mask_neighbors = neighbor_mask(mask, E_idx)
+
+        h_V_stack = [h_V]
+        for layer in self.decoder_layers:
+            W_V, W_E, W_S, W_N = layer._W1_blocks()
+            h_W1 = (
+                F.linear(h_V_stack[-1], W_V, layer.W1.bias).unsqueeze(-2)
+                + mask_1D * F.linear(h_E, W_E)
+                + mask_bw
+                * gather_nodes(F.linear(h_S, W_S) + F.linear(h_V_stack[-1], W_N), E_idx)
+                + mask_fw * gather_nodes(F.linear(h_V, W_N), E_idx)
+            )
+            h_V_stack.append(layer._update(h_V_stack[-1], h_W1, mask, mask_neighbors))
+        return h_V_stack
+
+    def _encoder_context(self, h_V, h_E, E_idx, mask_fw):
+        """
+        Encoder features of the edges to nodes decoded later, for `_decode_positions`.
+
+        These are the (B, L, K, 3H) decoder inputs of those edges, or with
+        factorized layers the encoder states projected by the ``h_V_j`` block of
+        every decoder layer's ``W1``, with shape (B, L, H) each.
+        """
+        if self.factorized:
+            return [
+                F.linear(h_V, layer._W1_blocks()[3]) for layer in self.decoder_layers
+            ]
+        h_EX_encoder = cat_neighbors_nodes(torch.zeros_like(h_V), h_E, E_idx)
+        h_EXV_encoder = cat_neighbors_nodes(h_V, h_EX_encoder, E_idx)
+        return mask_fw * h_EXV_encoder
+
+    def score_sequences(
+        self,
+        X,
+        S,
+        mask,
+        chain_M,
+        residue_idx,
+        chain_encoding_all,
+        sequences,
+        num_orders=1,
+        batch_rows=1024,
+        encoding=None,
+    ):
+        """
+        Scores many sequences on one backbone, ``batch_rows`` decoder rows at a time.
+
+        Every sequence is scored under ``num_orders`` random decoding orders like a
+        teacher-forced `forward` pass. The backbone is encoded once and shared by
+        all rows, and ``sequences`` is only read as far as the current batch, so it
+        can stream a FASTA library of any size.
+
+        Parameters
+        ----------
+        X, S, mask, chain_M, residue_idx, chain_encoding_all : torch.tensor
+            Featurized structure as for `forward`, with batch size 1. ``chain_M``
+            marks the scored positions.
+        sequences : iterable of sequence of int
+            Amino acid indices. Each sequence replaces the first positions of ``S``,
+            like FASTA records with the designed chains in alphabetical order.
+        num_orders : int, optional
+            Random decoding orders, i.e. scores, per sequence.
+        batch_rows : int, optional
+            Decoder rows per pass; a pass scores ``batch_rows // num_orders``
+            sequences.
+        encoding : dict, optional
+            Output of `encode` for the backbone with batch size 1. Without it the
+            backbone is encoded for every pass, which draws new backbone noise for
+            every row if ``augment_eps > 0``.
+
+        Yields
+        ------
+        tuple of np.ndarray
+            Average negative log probabilities over the positions in ``chain_M``
+            and over all positions, both with shape (num_orders,), per sequence.
+
+        Examples
+        --------
+        >>> model = ProteinMPNN(21, 16, 16, 16, k_neighbors=4, augment_eps=0.0).eval()
+        >>> X, S = torch.randn(1, 6, 4, 3), torch.zeros(1, 6, dtype=torch.long)
+        >>> ones = torch.ones(1, 6)
+        >>> with torch.no_grad():
+        ...     scores = list(
+        ...         model.score_sequences(
+        ...             X, S, ones, ones, torch.arange(6)[None], ones,
+        ...             [[1, 2, 3, 4, 5, 6], [7, 8]], num_orders=3, batch_rows=4,
+        ...         )
+        ...     )
+        >>> len(scores), scores[1][0].shape
+        (2, (3,))
+        """
+        num_seqs = max(1, batch_rows // num_orders)
+        design_mask = mask * chain_M
+        sequences = iter(sequences)
+        while True:
+            batch = list(itertools.islice(sequences, num_seqs))
+            if not batch:
+                return
+            num_rows = len(batch) * num_orders
+
+            def rows(x, num_rows=num_rows):
+                return x.expand(num_rows, *x.shape[1:])
+
+            S_batch = S.repeat(len(batch), 1)
+            for i, seq in enumerate(batch):
+                S_batch[i, : len(seq)] = torch.as_tensor(seq, device=S.device)
+            S_batch = S_batch.repeat_interleave(num_orders, dim=0)
+            randn = torch.cat(
+                [torch.randn((num_orders, S.shape[1]), device=S.device) for _ in batch]
+            )
+            if encoding is None:
+                batch_encoding = self.encode(
+                    rows(X), rows(mask), rows(residue_idx), rows(chain_encoding_all)
+                )
+            else:
+                batch_encoding = {k: rows(v) for k, v in encoding.items()}
+            log_probs = self.decode(batch_encoding, S_batch, rows(chain_M), randn)
+            scores = _scores(S_batch, log_probs, rows(design_mask))
+            global_scores = _scores(S_batch, log_probs, rows(mask))
+            yield from zip(
+                scores.view(len(batch), num_orders).cpu().numpy(),
+                global_scores.view(len(batch), num_orders).cpu().numpy(),
+                strict=False,
+            )
+
+    def _decode_positions(
+        self,
+        t,
+        h_V_stack,
+        h_S,
+        h_E,
+        E_idx,
+        encoder_context,
+        mask_bw,
+        mask,
+        chunk_size=None,
+    ):
+        """
+        Runs the decoder layers for the nodes ``t`` with shape (B, T).
+
+        The new states are written into ``h_V_stack`` layer by layer, so ``t`` may
+        hold several nodes as long as none of them attends to another one's state
+        from the same call in a way the decoding order forbids, e.g. a run of
+        consecutive decoding steps whose sequence is already known. Returns the
+        last layer states of ``t`` with shape (B, T, H).
+
+        ``encoder_context`` comes from `_encoder_context`. Without it the encoder
+        context of ``t`` is built on demand from ``h_V_stack[0]`` and ``h_E``,
+        for at most ``chunk_size`` nodes per row at a time. The chunks run one
+        after another in the order of ``t``, which gives the same states as long
+        as ``t`` follows the decoding order, since a node only attends to nodes
+        decoded before it.
+        """
+        if encoder_context is None and chunk_size and t.shape[1] > chunk_size:
+            return torch.cat(
+                [
+                    self._decode_positions(
+                        t_chunk, h_V_stack, h_S, h_E, E_idx, None, mask_bw, mask
+                    )
+                    for t_chunk in t.split(chunk_size, dim=1)
+                ],
+                dim=1,
+            )
+        H = h_V_stack[0].shape[-1]
+        t_nodes = t[:, :, None].expand(-1, -1, H)
+        E_idx_t = torch.gather(E_idx, 1, t[:, :, None].expand(-1, -1, E_idx.shape[-1]))
+        h_E_t = torch.gather(
+            h_E, 1, t[:, :, None, None].expand(-1, -1, h_E.shape[-2], h_E.shape[-1])
+        )
+        h_ES_t = cat_neighbors_nodes(h_S, h_E_t, E_idx_t)
+        mask_bw_t = torch.gather(
+            mask_bw,
+            1,
+            t[:, :, None, None].expand(-1, -1, mask_bw.shape[-2], mask_bw.shape[-1]),
+        )
+        mask_t = torch.gather(mask, 1, t)
+        mask_neighbors_t = neighbor_mask(mask, E_idx_t)
+        # Edges to nodes decoded later see the encoder states only
+        mask_fw_t = mask_t[:, :, None, None] - mask_bw_t
+        if self.factorized:
+            for ix, layer in enumerate(self.decoder_layers):
+                W_V, W_E, W_S, W_N = layer._W1_blocks()
+                h_V_t = torch.gather(h_V_stack[ix], 1, t_nodes)
+                if encoder_context is None:
+                    h_V_encoder_t = F.linear(gather_nodes(h_V_stack[0], E_idx_t), W_N)
+                else:
+                    h_V_encoder_t = gather_nodes(encoder_context[ix], E_idx_t)
+                h_SV_t = torch.cat(
+                    [gather_nodes(h_S, E_idx_t), gather_nodes(h_V_stack[ix], E_idx_t)],
+                    -1,
+                )
+                h_W1_t = (
+                    F.linear(h_V_t, W_V, layer.W1.bias).unsqueeze(-2)
+                    + mask_t[:, :, None, None] * F.linear(h_E_t, W_E)
+                    + mask_bw_t * F.linear(h_SV_t, torch.cat([W_S, W_N], 1))
+                    + mask_fw_t * h_V_encoder_t
+                )
+                h_V_stack[ix + 1].scatter_(
+                    1,
+                    t_nodes,
+                    layer._update(h_V_t, h_W1_t, mask_t, mask_neighbors_t),
+                )
+            return torch.gather(h_V_stack[-1], 1, t_nodes)
+        if encoder_context is None:
+            h_EXV_encoder_t = mask_fw_t * torch.cat(
+                [h_E_t, torch.zeros_like(h_E_t), gather_nodes(h_V_stack[0], E_idx_t)],
+                -1,
+            )
+        else:
+            h_EXV_encoder_t = torch.gather(
+                encoder_context,
+                1,
+                t[:, :, None, None].expand(
+                    -1, -1, encoder_context.shape[-2], encoder_context.shape[-1]
+                ),
+            )
+        for l, layer in enumerate(self.decoder_layers):
+            # Updated relational features for future states
+            h_ESV_decoder_t = cat_neighbors_nodes(h_V_stack[l], h_ES_t, E_idx_t)
+            h_V_t = torch.gather(h_V_stack[l], 1, t_nodes)
+            h_ESV_t = mask_bw_t * h_ESV_decoder_t + h_EXV_encoder_t
+            h_V_stack[l + 1].scatter_(
+                1, t_nodes, layer(h_V_t, h_ESV_t, mask_t, mask_neighbors_t)
+            )
+        return torch.gather(h_V_stack[-1], 1, t_nodes)
 
     def sample(
         self,
@@ -1442,43 +2786,45 @@ class ProteinMPNN(nn.Module):
         pssm_log_odds_mask=None,
         pssm_bias_flag=None,
         bias_by_res=None,
+        encoding=None,
+        parallel_decoding=False,
+        return_log_probs=False,
+        context_chunk_size=None,
     ):
-        device = X.device
-        # Prepare node and edge embeddings
-        E, E_idx = self.features(X, mask, residue_idx, chain_encoding_all)
-        h_V = torch.zeros((E.shape[0], E.shape[1], E.shape[-1]), device=device)
-        h_E = self.W_e(E)
+        """
+        Samples sequences residue by residue in a random decoding order.
 
-        # Encoder is unmasked self-attention
-        mask_attend = gather_nodes(mask.unsqueeze(-1), E_idx).squeeze(-1)
-        mask_attend = mask.unsqueeze(-1) * mask_attend
-        for layer in self.encoder_layers:
-            h_V, h_E = layer(h_V, h_E, E_idx, mask, mask_attend)
+        ``temperature`` is a scalar or a tensor with one temperature per row,
+        shape (B,), and ``omit_AAs_np`` and ``bias_AAs_np`` have shape (21,) or
+        (B, 21), so rows with different sampling parameters share one batch.
+
+        By default the encoder context of every edge, with shape
+        (B, L, K, 3 * hidden_dim), is built before the first step. With
+        ``context_chunk_size`` it is built on demand for the nodes of each step,
+        at most that many at a time, which bounds the memory of sampling by
+        about the size of the encoder outputs.
+        """
+        device = X.device
+        if encoding is None:
+            encoding = self.encode(X, mask, residue_idx, chain_encoding_all)
+        h_V, h_E, E_idx = encoding["h_V"], encoding["h_E"], encoding["E_idx"]
 
         # Decoder uses masked self-attention
         chain_mask = (
             chain_mask * chain_M_pos * mask
         )  # update chain_M to include missing regions
-        decoding_order = torch.argsort(
-            (chain_mask + 0.0001) * (torch.abs(randn))
-        )  # [numbers will be smaller for places where chain_M = 0.0 and higher for places where chain_M = 1.0]
-        mask_size = E_idx.shape[1]
-        permutation_matrix_reverse = torch.nn.functional.one_hot(
-            decoding_order, num_classes=mask_size
-        ).float()
-        order_mask_backward = torch.einsum(
-            "ij, biq, bjp->bqp",
-            (1 - torch.triu(torch.ones(mask_size, mask_size, device=device))),
-            permutation_matrix_reverse,
-            permutation_matrix_reverse,
-        )
-        mask_attend = torch.gather(order_mask_backward, 2, E_idx).unsqueeze(-1)
+        if parallel_decoding:
+            decoding_order, step_sizes = independent_set_order(E_idx, chain_mask, randn)
+        else:
+            decoding_order = torch.argsort(
+                (chain_mask + 0.0001) * (torch.abs(randn))
+            )  # [numbers will be smaller for places where chain_M = 0.0 and higher for places where chain_M = 1.0]
+        mask_attend = neighbor_order_mask(decoding_order, E_idx).unsqueeze(-1)
         mask_1D = mask.view([mask.size(0), mask.size(1), 1, 1])
         mask_bw = mask_1D * mask_attend
         mask_fw = mask_1D * (1.0 - mask_attend)
 
         N_batch, N_nodes = X.size(0), X.size(1)
-        log_probs = torch.zeros((N_batch, N_nodes, 21), device=device)
         all_probs = torch.zeros(
             (N_batch, N_nodes, 21), device=device, dtype=torch.float32
         )
@@ -1488,133 +2834,110 @@ class ProteinMPNN(nn.Module):
             torch.zeros_like(h_V, device=device)
             for _ in range(len(self.decoder_layers))
         ]
-        constant = torch.tensor(omit_AAs_np, device=device)
-        constant_bias = torch.tensor(bias_AAs_np, device=device)
-        # chain_mask_combined = chain_mask*chain_M_pos
-        omit_AA_mask_flag = omit_AA_mask != None
+        temperature, logit_bias, pssm_mix, weights = compile_constraints(
+            temperature,
+            omit_AAs_np,
+            bias_AAs_np,
+            device,
+            omit_AA_mask=omit_AA_mask,
+            pssm_coef=pssm_coef,
+            pssm_bias=pssm_bias,
+            pssm_multi=pssm_multi,
+            pssm_log_odds_flag=pssm_log_odds_flag,
+            pssm_log_odds_mask=pssm_log_odds_mask,
+            pssm_bias_flag=pssm_bias_flag,
+            bias_by_res=bias_by_res,
+        )
 
-        h_EX_encoder = cat_neighbors_nodes(torch.zeros_like(h_S), h_E, E_idx)
-        h_EXV_encoder = cat_neighbors_nodes(h_V, h_EX_encoder, E_idx)
-        h_EXV_encoder_fw = mask_fw * h_EXV_encoder
-        for t_ in range(N_nodes):
-            t = decoding_order[:, t_]  # [B]
-            chain_mask_gathered = torch.gather(chain_mask, 1, t[:, None])  # [B]
-            mask_gathered = torch.gather(mask, 1, t[:, None])  # [B]
-            bias_by_res_gathered = torch.gather(
-                bias_by_res, 1, t[:, None, None].repeat(1, 1, 21)
-            )[:, 0, :]  # [B, 21]
+        if context_chunk_size is None:
+            encoder_context = self._encoder_context(h_V, h_E, E_idx, mask_fw)
+        else:
+            encoder_context = None
+
+        # Fixed, missing and padded positions (chain_mask 0) come first in the
+        # decoding order and copy S_true, so the leading steps where no row has
+        # a designable position are decoded in one teacher-forced pass.
+        chain_mask_ordered = torch.gather(chain_mask, 1, decoding_order)
+        num_fixed = int((chain_mask_ordered.sum(0) == 0).long().cumprod(0).sum())
+        if num_fixed > 0:
+            t = decoding_order[:, :num_fixed]  # [B, num_fixed]
+            S_t = torch.gather(S_true, 1, t)
+            h_S.scatter_(1, t[:, :, None].expand(-1, -1, h_S.shape[-1]), self.W_s(S_t))
+            S.scatter_(1, t, S_t)
+            self._decode_positions(
+                t,
+                h_V_stack,
+                h_S,
+                h_E,
+                E_idx,
+                encoder_context,
+                mask_bw,
+                mask,
+                chunk_size=context_chunk_size,
+            )
+
+        if parallel_decoding:
+            steps = np.cumsum([num_fixed, *step_sizes]).tolist()
+        else:
+            steps = list(range(num_fixed, N_nodes + 1))
+        for start, end in itertools.pairwise(steps):
+            t = decoding_order[:, start:end]  # [B, T]
+            t_AA = t[:, :, None].expand(-1, -1, 21)
+            chain_mask_gathered = torch.gather(chain_mask, 1, t)  # [B, T]
+            mask_gathered = torch.gather(mask, 1, t)  # [B, T]
             if (mask_gathered == 0).all():  # for padded or missing regions only
-                S_t = torch.gather(S_true, 1, t[:, None])
+                S_t = torch.gather(S_true, 1, t)
             else:
                 # Hidden layers
-                E_idx_t = torch.gather(
-                    E_idx, 1, t[:, None, None].repeat(1, 1, E_idx.shape[-1])
-                )
-                h_E_t = torch.gather(
+                h_V_t = self._decode_positions(
+                    t,
+                    h_V_stack,
+                    h_S,
                     h_E,
-                    1,
-                    t[:, None, None, None].repeat(1, 1, h_E.shape[-2], h_E.shape[-1]),
-                )
-                h_ES_t = cat_neighbors_nodes(h_S, h_E_t, E_idx_t)
-                h_EXV_encoder_t = torch.gather(
-                    h_EXV_encoder_fw,
-                    1,
-                    t[:, None, None, None].repeat(
-                        1, 1, h_EXV_encoder_fw.shape[-2], h_EXV_encoder_fw.shape[-1]
-                    ),
+                    E_idx,
+                    encoder_context,
+                    mask_bw,
+                    mask,
+                    chunk_size=context_chunk_size,
                 )
-                mask_t = torch.gather(mask, 1, t[:, None])
-                for l, layer in enumerate(self.decoder_layers):
-                    # Updated relational features for future states
-                    h_ESV_decoder_t = cat_neighbors_nodes(h_V_stack[l], h_ES_t, E_idx_t)
-                    h_V_t = torch.gather(
-                        h_V_stack[l],
-                        1,
-                        t[:, None, None].repeat(1, 1, h_V_stack[l].shape[-1]),
-                    )
-                    h_ESV_t = (
-                        torch.gather(
-                            mask_bw,
-                            1,
-                            t[:, None, None, None].repeat(
-                                1, 1, mask_bw.shape[-2], mask_bw.shape[-1]
-                            ),
-                        )
-                        * h_ESV_decoder_t
-                        + h_EXV_encoder_t
-                    )
-                    h_V_stack[l + 1].scatter_(
+                if (chain_mask_gathered == 0).all():  # fixed in every row
+                    S_t = torch.gather(S_true, 1, t)
+                else:
+                    # Sampling step
+                    logits = self.W_out(h_V_t) / temperature
+                    probs = F.softmax(
+                        logits + _constraint_rows(logit_bias, t), dim=-1
+                    )  # [B, T, 21]
+                    if pssm_mix is not None:
+                        coef, bias = (_constraint_rows(x, t) for x in pssm_mix)
+                        probs = (1 - coef) * probs + bias
+                    if weights is not None:
+                        probs = probs * _constraint_rows(weights, t)
+                        probs = probs / torch.sum(probs, dim=-1, keepdim=True)
+                    S_t = torch.multinomial(probs.view(-1, 21), 1).view(t.shape)
+                    all_probs.scatter_(
                         1,
-                        t[:, None, None].repeat(1, 1, h_V.shape[-1]),
-                        layer(h_V_t, h_ESV_t, mask_V=mask_t),
+                        t_AA,
+                        (chain_mask_gathered[:, :, None] * probs).float(),
                     )
-                # Sampling step
-                h_V_t = torch.gather(
-                    h_V_stack[-1],
-                    1,
-                    t[:, None, None].repeat(1, 1, h_V_stack[-1].shape[-1]),
-                )[:, 0]
-                logits = self.W_out(h_V_t) / temperature
-                probs = F.softmax(
-                    logits
-                    - constant[None, :] * 1e8
-                    + constant_bias[None, :] / temperature
-                    + bias_by_res_gathered / temperature,
-                    dim=-1,
-                )
-                if pssm_bias_flag:
-                    pssm_coef_gathered = torch.gather(pssm_coef, 1, t[:, None])[:, 0]
-                    pssm_bias_gathered = torch.gather(
-                        pssm_bias, 1, t[:, None, None].repeat(1, 1, pssm_bias.shape[-1])
-                    )[:, 0]
-                    probs = (
-                        1 - pssm_multi * pssm_coef_gathered[:, None]
-                    ) * probs + pssm_multi * pssm_coef_gathered[
-                        :, None
-                    ] * pssm_bias_gathered
-                if pssm_log_odds_flag:
-                    pssm_log_odds_mask_gathered = torch.gather(
-                        pssm_log_odds_mask,
-                        1,
-                        t[:, None, None].repeat(1, 1, pssm_log_odds_mask.shape[-1]),
-                    )[:, 0]  # [B, 21]
-                    probs_masked = probs * pssm_log_odds_mask_gathered
-                    probs_masked += probs * 0.001
-                    probs = probs_masked / torch.sum(
-                        probs_masked, dim=-1, keepdim=True
-                    )  # [B, 21]
-                if omit_AA_mask_flag:
-                    omit_AA_mask_gathered = torch.gather(
-                        omit_AA_mask,
-                        1,
-                        t[:, None, None].repeat(1, 1, omit_AA_mask.shape[-1]),
-                    )[:, 0]  # [B, 21]
-                    probs_masked = probs * (1.0 - omit_AA_mask_gathered)
-                    probs = probs_masked / torch.sum(
-                        probs_masked, dim=-1, keepdim=True
-                    )  # [B, 21]
-                S_t = torch.multinomial(probs, 1)
-                all_probs.scatter_(
-                    1,
-                    t[:, None, None].repeat(1, 1, 21),
-                    (
-                        chain_mask_gathered[
-                            :,
-                            :,
-                            None,
-                        ]
-                        * probs[:, None, :]
-                    ).float(),
-                )
-            S_true_gathered = torch.gather(S_true, 1, t[:, None])
+            S_true_gathered = torch.gather(S_true, 1, t)
             S_t = (
                 S_t * chain_mask_gathered
                 + S_true_gathered * (1.0 - chain_mask_gathered)
             ).long()
             temp1 = self.W_s(S_t)
-            h_S.scatter_(1, t[:, None, None].repeat(1, 1, temp1.shape[-1]), temp1)
-            S.scatter_(1, t[:, None], S_t)
-        output_dict = {"S": S, "probs": all_probs, "decoding_order": decoding_order}
+            h_S.scatter_(1, t[:, :, None].expand(-1, -1, temp1.shape[-1]), temp1)
+            S.scatter_(1, t, S_t)
+        output_dict = {
+            "S": S,
+            "probs": all_probs,
+            "decoding_order": decoding_order,
+            "num_steps": int(num_fixed > 0) + len(steps) - 1,
+        }
+        if return_log_probs:
+            # Every position has its final decoder state under the decoding order,
+            # which is what forward(..., use_input_decoding_order=True) computes
+            output_dict["log_probs"] = F.log_softmax(self.W_out(h_V_stack[-1]), dim=-1)
         return output_dict
 
     def tied_sample(
@@ -1640,17 +2963,19 @@ class ProteinMPNN(nn.Module):
         tied_pos=None,
         tied_beta=None,
         bias_by_res=None,
+        encoding=None,
+        return_log_probs=False,
+        context_chunk_size=None,
     ):
+        """
+        Samples sequences with the residues of each ``tied_pos`` group sampled as one.
+
+        Takes per-row sampling parameters and ``context_chunk_size`` like `sample`.
+        """
         device = X.device
-        # Prepare node and edge embeddings
-        E, E_idx = self.features(X, mask, residue_idx, chain_encoding_all)
-        h_V = torch.zeros((E.shape[0], E.shape[1], E.shape[-1]), device=device)
-        h_E = self.W_e(E)
-        # Encoder is unmasked self-attention
-        mask_attend = gather_nodes(mask.unsqueeze(-1), E_idx).squeeze(-1)
-        mask_attend = mask.unsqueeze(-1) * mask_attend
-        for layer in self.encoder_layers:
-            h_V, h_E = layer(h_V, h_E, E_idx, mask, mask_attend)
+        if encoding is None:
+            encoding = self.encode(X, mask, residue_idx, chain_encoding_all)
+        h_V, h_E, E_idx = encoding["h_V"], encoding["h_E"], encoding["E_idx"]
 
         # Decoder uses masked self-attention
         chain_mask = (
@@ -1660,35 +2985,18 @@ class ProteinMPNN(nn.Module):
             (chain_mask + 0.0001) * (torch.abs(randn))
         )  # [numbers will be smaller for places where chain_M = 0.0 and higher for places where chain_M = 1.0]
 
-        new_decoding_order = []
-        for t_dec in list(decoding_order[0,].cpu().data.numpy()):
-            if t_dec not in list(itertools.chain(*new_decoding_order)):
-                list_a = [item for item in tied_pos if t_dec in item]
-                if list_a:
-                    new_decoding_order.append(list_a[0])
-                else:
-                    new_decoding_order.append([t_dec])
+        # Tie groups are decoded in the order of their first member in row 0
+        new_decoding_order = tied_decoding_order(decoding_order[0], tied_pos)
         decoding_order = torch.tensor(
-            list(itertools.chain(*new_decoding_order)), device=device
+            np.concatenate(new_decoding_order), device=device
         )[None,].repeat(X.shape[0], 1)
 
-        mask_size = E_idx.shape[1]
-        permutation_matrix_reverse = torch.nn.functional.one_hot(
-            decoding_order, num_classes=mask_size
-        ).float()
-        order_mask_backward = torch.einsum(
-            "ij, biq, bjp->bqp",
-            (1 - torch.triu(torch.ones(mask_size, mask_size, device=device))),
-            permutation_matrix_reverse,
-            permutation_matrix_reverse,
-        )
-        mask_attend = torch.gather(order_mask_backward, 2, E_idx).unsqueeze(-1)
+        mask_attend = neighbor_order_mask(decoding_order, E_idx).unsqueeze(-1)
         mask_1D = mask.view([mask.size(0), mask.size(1), 1, 1])
         mask_bw = mask_1D * mask_attend
         mask_fw = mask_1D * (1.0 - mask_attend)
 
         N_batch, N_nodes = X.size(0), X.size(1)
-        log_probs = torch.zeros((N_batch, N_nodes, 21), device=device)
         all_probs = torch.zeros(
             (N_batch, N_nodes, 21), device=device, dtype=torch.float32
         )
@@ -1698,90 +3006,80 @@ class ProteinMPNN(nn.Module):
             torch.zeros_like(h_V, device=device)
             for _ in range(len(self.decoder_layers))
         ]
-        constant = torch.tensor(omit_AAs_np, device=device)
-        constant_bias = torch.tensor(bias_AAs_np, device=device)
-        omit_AA_mask_flag = omit_AA_mask != None
+        temperature, logit_bias, pssm_mix, weights = compile_constraints(
+            temperature,
+            omit_AAs_np,
+            bias_AAs_np,
+            device,
+            omit_AA_mask=omit_AA_mask,
+            pssm_coef=pssm_coef,
+            pssm_bias=pssm_bias,
+            pssm_multi=pssm_multi,
+            pssm_log_odds_flag=pssm_log_odds_flag,
+            pssm_log_odds_mask=pssm_log_odds_mask,
+            pssm_bias_flag=pssm_bias_flag,
+            bias_by_res=bias_by_res,
+        )
 
-        h_EX_encoder = cat_neighbors_nodes(torch.zeros_like(h_S), h_E, E_idx)
-        h_EXV_encoder = cat_neighbors_nodes(h_V, h_EX_encoder, E_idx)
-        h_EXV_encoder_fw = mask_fw * h_EXV_encoder
+        if context_chunk_size is None:
+            encoder_context = self._encoder_context(h_V, h_E, E_idx, mask_fw)
+        else:
+            encoder_context = None
         for t_list in new_decoding_order:
-            logits = 0.0
-            logit_list = []
-            done_flag = False
-            for t in t_list:
-                if (mask[:, t] == 0).all():
-                    S_t = S_true[:, t]
-                    for t in t_list:
-                        h_S[:, t, :] = self.W_s(S_t)
-                        S[:, t] = S_t
-                    done_flag = True
-                    break
-                else:
-                    E_idx_t = E_idx[:, t : t + 1, :]
-                    h_E_t = h_E[:, t : t + 1, :, :]
-                    h_ES_t = cat_neighbors_nodes(h_S, h_E_t, E_idx_t)
-                    h_EXV_encoder_t = h_EXV_encoder_fw[:, t : t + 1, :, :]
-                    mask_t = mask[:, t : t + 1]
-                    for l, layer in enumerate(self.decoder_layers):
-                        h_ESV_decoder_t = cat_neighbors_nodes(
-                            h_V_stack[l], h_ES_t, E_idx_t
-                        )
-                        h_V_t = h_V_stack[l][:, t : t + 1, :]
-                        h_ESV_t = (
-                            mask_bw[:, t : t + 1, :, :] * h_ESV_decoder_t
-                            + h_EXV_encoder_t
-                        )
-                        h_V_stack[l + 1][:, t, :] = layer(
-                            h_V_t, h_ESV_t, mask_V=mask_t
-                        ).squeeze(1)
-                    h_V_t = h_V_stack[-1][:, t, :]
-                    logit_list.append((self.W_out(h_V_t) / temperature) / len(t_list))
-                    logits += (
-                        tied_beta[t] * (self.W_out(h_V_t) / temperature) / len(t_list)
-                    )
-            if done_flag:
-                pass
+            t_group = torch.as_tensor(t_list, device=device)[None].expand(N_batch, -1)
+            # The group stops at its first member that is missing in every row
+            missing = (mask[:, t_list] == 0).all(0)
+            num_decoded = int(missing.long().argmax()) if missing.any() else len(t_list)
+            if num_decoded > 0:
+                # Members see the states, not the residues, of earlier members
+                h_V_t = self._decode_positions(
+                    t_group[:, :num_decoded],
+                    h_V_stack,
+                    h_S,
+                    h_E,
+                    E_idx,
+                    encoder_context,
+                    mask_bw,
+                    mask,
+                    chunk_size=context_chunk_size,
+                )
+            if num_decoded < len(t_list):
+                S_t = S_true[:, t_list[num_decoded]]
+                h_S[:, t_list, :] = self.W_s(S_t)[:, None, :]
+                S[:, t_list] = S_t[:, None]
             else:
-                bias_by_res_gathered = bias_by_res[:, t, :]  # [B, 21]
-                probs = F.softmax(
-                    logits
-                    - constant[None, :] * 1e8
-                    + constant_bias[None, :] / temperature
-                    + bias_by_res_gathered / temperature,
-                    dim=-1,
+                beta = tied_beta[t_list][None, :, None]
+                logits = torch.sum(
+                    beta * (self.W_out(h_V_t) / temperature) / len(t_list),
+                    dim=1,
+                    keepdim=True,
                 )
-                if pssm_bias_flag:
-                    pssm_coef_gathered = pssm_coef[:, t]
-                    pssm_bias_gathered = pssm_bias[:, t]
-                    probs = (
-                        1 - pssm_multi * pssm_coef_gathered[:, None]
-                    ) * probs + pssm_multi * pssm_coef_gathered[
-                        :, None
-                    ] * pssm_bias_gathered
-                if pssm_log_odds_flag:
-                    pssm_log_odds_mask_gathered = pssm_log_odds_mask[:, t]
-                    probs_masked = probs * pssm_log_odds_mask_gathered
-                    probs_masked += probs * 0.001
-                    probs = probs_masked / torch.sum(
-                        probs_masked, dim=-1, keepdim=True
-                    )  # [B, 21]
-                if omit_AA_mask_flag:
-                    omit_AA_mask_gathered = omit_AA_mask[:, t]
-                    probs_masked = probs * (1.0 - omit_AA_mask_gathered)
-                    probs = probs_masked / torch.sum(
-                        probs_masked, dim=-1, keepdim=True
-                    )  # [B, 21]
+                # Biases, masks and fixed residues come from the last member
+                t = t_list[-1]
+                t_last = t_group[:, -1:]  # [B, 1]
+                probs = F.softmax(
+                    logits + _constraint_rows(logit_bias, t_last), dim=-1
+                )[:, 0]
+                if pssm_mix is not None:
+                    coef, bias = (_constraint_rows(x, t_last)[:, 0] for x in pssm_mix)
+                    probs = (1 - coef) * probs + bias
+                if weights is not None:
+                    probs = probs * _constraint_rows(weights, t_last)[:, 0]
+                    probs = probs / torch.sum(probs, dim=-1, keepdim=True)  # [B, 21]
                 S_t_repeat = torch.multinomial(probs, 1).squeeze(-1)
                 S_t_repeat = (
                     chain_mask[:, t] * S_t_repeat
                     + (1 - chain_mask[:, t]) * S_true[:, t]
                 ).long()  # hard pick fixed positions
-                for t in t_list:
-                    h_S[:, t, :] = self.W_s(S_t_repeat)
-                    S[:, t] = S_t_repeat
-                    all_probs[:, t, :] = probs.float()
+                h_S[:, t_list, :] = self.W_s(S_t_repeat)[:, None, :]
+                S[:, t_list] = S_t_repeat[:, None]
+                all_probs[:, t_list, :] = probs.float()[:, None, :]
         output_dict = {"S": S, "probs": all_probs, "decoding_order": decoding_order}
+        if return_log_probs:
+            # Tied positions are decoded without each other's sampled residues, so
+            # these are the sampler's distributions rather than the likelihood
+            # forward() gives for the returned decoding order
+            output_dict["log_probs"] = F.log_softmax(self.W_out(h_V_stack[-1]), dim=-1)
         return output_dict
 
     def conditional_probs(
@@ -1794,19 +3092,47 @@ class ProteinMPNN(nn.Module):
         chain_encoding_all,
         randn,
         backbone_only=False,
+        encoding=None,
+        chunk_size=None,
     ):
-        """Graph-conditioned sequence model"""
+        """
+        Log probabilities of every designable residue given the rest of the protein.
+
+        Position ``i`` is decoded last, after all other residues in ``|randn|``
+        order, so it sees the whole sequence except itself. With
+        ``backbone_only`` it is decoded first and sees no sequence at all, which
+        is `unconditional_probs`, so that case is computed in a single pass.
+
+        Otherwise every position needs its own decoding order. Decoder layer ``l``
+        of position ``i`` only depends on the residues within
+        ``num_decoder_layers - l`` hops of it, so each position is decoded on that
+        neighbourhood alone, with ``chunk_size`` positions times B rows stacked
+        into one batch. The default keeps chunks at about 2048 residues per layer.
+
+        Returns
+        -------
+        torch.tensor
+            Log probabilities with shape (B, L, 21) at the positions where the
+            first row of ``chain_M * mask`` is 1, zeros elsewhere.
+        """
         device = X.device
-        # Prepare node and edge embeddings
-        E, E_idx = self.features(X, mask, residue_idx, chain_encoding_all)
-        h_V_enc = torch.zeros((E.shape[0], E.shape[1], E.shape[-1]), device=E.device)
-        h_E = self.W_e(E)
+        if encoding is None:
+            encoding = self.encode(X, mask, residue_idx, chain_encoding_all)
+        h_V_enc, h_E, E_idx = encoding["h_V"], encoding["h_E"], encoding["E_idx"]
 
-        # Encoder is unmasked self-attention
-        mask_attend = gather_nodes(mask.unsqueeze(-1), E_idx).squeeze(-1)
-        mask_attend = mask.unsqueeze(-1) * mask_attend
-        for layer in self.encoder_layers:
-            h_V_enc, h_E = layer(h_V_enc, h_E, E_idx, mask, mask_attend)
+        chain_M = chain_M * mask  # update chain_M to include missing regions
+
+        chain_M_np = chain_M.cpu().numpy()
+        idx_to_loop = np.argwhere(chain_M_np[0, :] == 1)[:, 0]
+        log_conditional_probs = torch.zeros(
+            [X.shape[0], chain_M.shape[1], 21], device=device
+        ).float()
+        if backbone_only:
+            log_probs = self.unconditional_probs(
+                X, mask, residue_idx, chain_encoding_all, encoding=encoding
+            )
+            log_conditional_probs[:, idx_to_loop] = log_probs[:, idx_to_loop]
+            return log_conditional_probs
 
         # Concatenate sequence embeddings for autoregressive decoder
         h_S = self.W_s(S)
@@ -1816,83 +3142,583 @@ class ProteinMPNN(nn.Module):
         h_EX_encoder = cat_neighbors_nodes(torch.zeros_like(h_S), h_E, E_idx)
         h_EXV_encoder = cat_neighbors_nodes(h_V_enc, h_EX_encoder, E_idx)
 
-        chain_M = chain_M * mask  # update chain_M to include missing regions
+        N_batch, N_nodes = chain_M.shape
+        num_layers = len(self.decoder_layers)
+        if chunk_size is None:
+            chunk_size = max(1, 2048 // (N_batch * min(N_nodes, 256)))
+        for start in range(0, len(idx_to_loop), chunk_size):
+            idx = torch.as_tensor(
+                idx_to_loop[start : start + chunk_size], device=device
+            )
+            # Rows are (position, batch) pairs, position idx decoded last
+            b = torch.arange(N_batch, device=device).repeat(idx.shape[0])  # [R]
+            idx = idx.repeat_interleave(N_batch)  # [R]
+            R = idx.shape[0]
+            decoding_order = torch.argsort(
+                (F.one_hot(idx, N_nodes) + 0.0001) * torch.abs(randn[b])
+            )
+            rank = torch.empty_like(decoding_order)
+            rank.scatter_(
+                1, decoding_order, torch.arange(N_nodes, device=device).expand(R, -1)
+            )
 
-        chain_M_np = chain_M.cpu().numpy()
-        idx_to_loop = np.argwhere(chain_M_np[0, :] == 1)[:, 0]
-        log_conditional_probs = torch.zeros(
-            [X.shape[0], chain_M.shape[1], 21], device=device
-        ).float()
+            # nodes[h] holds the residues within h hops of idx, padded with others
+            nodes = [idx[:, None]]
+            reached = F.one_hot(idx, N_nodes).bool()
+            for _ in range(num_layers - 1):
+                neighbors = E_idx[b[:, None], nodes[-1]].flatten(1)
+                reached = reached.scatter(1, neighbors, True)
+                num_reached = int(reached.sum(1).max())
+                nodes.append(
+                    torch.sort((~reached).byte(), dim=1, stable=True)[1][
+                        :, :num_reached
+                    ]
+                )
 
-        for idx in idx_to_loop:
-            h_V = torch.clone(h_V_enc)
-            order_mask = torch.zeros(chain_M.shape[1], device=device).float()
-            if backbone_only:
-                order_mask = torch.ones(chain_M.shape[1], device=device).float()
-                order_mask[idx] = 0.0
-            else:
-                order_mask = torch.zeros(chain_M.shape[1], device=device).float()
-                order_mask[idx] = 1.0
-            decoding_order = torch.argsort(
-                (order_mask[None,] + 0.0001) * (torch.abs(randn))
-            )  # [numbers will be smaller for places where chain_M = 0.0 and higher for places where chain_M = 1.0]
-            mask_size = E_idx.shape[1]
-            permutation_matrix_reverse = torch.nn.functional.one_hot(
-                decoding_order, num_classes=mask_size
-            ).float()
-            order_mask_backward = torch.einsum(
-                "ij, biq, bjp->bqp",
-                (1 - torch.triu(torch.ones(mask_size, mask_size, device=device))),
-                permutation_matrix_reverse,
-                permutation_matrix_reverse,
+            # Decoder layer l runs on nodes[num_layers - 1 - l] and reads the
+            # states of the previous layer through their position in its nodes
+            h_V_prev, position = None, None
+            for l, layer in enumerate(self.decoder_layers):
+                t = nodes[num_layers - 1 - l]  # [R, T]
+                E_idx_t = E_idx[b[:, None], t]  # [R, T, K]
+                if h_V_prev is None:
+                    h_V_t = h_V_enc[b[:, None], t]
+                    h_V_neighbors = h_V_enc[b[:, None, None], E_idx_t]
+                else:
+                    h_V_t = torch.gather(
+                        h_V_prev,
+                        1,
+                        torch.gather(position, 1, t)[:, :, None].expand(
+                            -1, -1, h_V_prev.shape[-1]
+                        ),
+                    )
+                    h_V_neighbors = gather_nodes(
+                        h_V_prev,
+                        torch.gather(position, 1, E_idx_t.flatten(1)).view(
+                            E_idx_t.shape
+                        ),
+                    )
+                h_ESV = torch.cat([h_ES[b[:, None], t], h_V_neighbors], -1)
+                mask_t = mask[b[:, None], t]  # [R, T]
+                rank_t = torch.gather(rank, 1, t)
+                rank_neighbors = torch.gather(rank, 1, E_idx_t.flatten(1)).view(
+                    E_idx_t.shape
+                )
+                mask_attend = (rank_neighbors < rank_t[:, :, None]).float()
+                mask_bw = (mask_t[:, :, None] * mask_attend)[..., None]
+                mask_fw = (mask_t[:, :, None] * (1.0 - mask_attend))[..., None]
+                h_ESV = mask_bw * h_ESV + mask_fw * h_EXV_encoder[b[:, None], t]
+                mask_neighbors = mask[b[:, None, None], E_idx_t]
+                h_V_prev = layer(h_V_t, h_ESV, mask_t, mask_neighbors)
+                position = torch.zeros_like(rank).scatter_(
+                    1, t, torch.arange(t.shape[1], device=device).expand(R, -1)
+                )
+
+            log_probs = F.log_softmax(self.W_out(h_V_prev[:, 0]), dim=-1)
+            log_conditional_probs[:, idx_to_loop[start : start + chunk_size]] = (
+                log_probs.view(-1, N_batch, 21).transpose(0, 1)
             )
-            mask_attend = torch.gather(order_mask_backward, 2, E_idx).unsqueeze(-1)
-            mask_1D = mask.view([mask.size(0), mask.size(1), 1, 1])
-            mask_bw = mask_1D * mask_attend
-            mask_fw = mask_1D * (1.0 - mask_attend)
-
-            h_EXV_encoder_fw = mask_fw * h_EXV_encoder
-            for layer in self.decoder_layers:
-                # Masked positions attend to encoder information, unmasked see.
-                h_ESV = cat_neighbors_nodes(h_V, h_ES, E_idx)
-                h_ESV = mask_bw * h_ESV + h_EXV_encoder_fw
-                h_V = layer(h_V, h_ESV, mask)
-
-            logits = self.W_out(h_V)
-            log_probs = F.log_softmax(logits, dim=-1)
-            log_conditional_probs[:, idx, :] = log_probs[:, idx, :]
         return log_conditional_probs
 
-    def unconditional_probs(self, X, mask, residue_idx, chain_encoding_all):
+    def unconditional_probs(
+        self, X, mask, residue_idx, chain_encoding_all, encoding=None
+    ):
         """Graph-conditioned sequence model"""
         device = X.device
-        # Prepare node and edge embeddings
-        E, E_idx = self.features(X, mask, residue_idx, chain_encoding_all)
-        h_V = torch.zeros((E.shape[0], E.shape[1], E.shape[-1]), device=E.device)
-        h_E = self.W_e(E)
-
-        # Encoder is unmasked self-attention
-        mask_attend = gather_nodes(mask.unsqueeze(-1), E_idx).squeeze(-1)
-        mask_attend = mask.unsqueeze(-1) * mask_attend
-        for layer in self.encoder_layers:
-            h_V, h_E = layer(h_V, h_E, E_idx, mask, mask_attend)
+        if encoding is None:
+            encoding = self.encode(X, mask, residue_idx, chain_encoding_all)
+        h_V, h_E, E_idx = encoding["h_V"], encoding["h_E"], encoding["E_idx"]
 
         # Build encoder embeddings
         h_EX_encoder = cat_neighbors_nodes(torch.zeros_like(h_V), h_E, E_idx)
         h_EXV_encoder = cat_neighbors_nodes(h_V, h_EX_encoder, E_idx)
 
-        order_mask_backward = torch.zeros(
-            [X.shape[0], X.shape[1], X.shape[1]], device=device
-        )
-        mask_attend = torch.gather(order_mask_backward, 2, E_idx).unsqueeze(-1)
+        # no neighbour is decoded before any node
+        mask_attend = torch.zeros(E_idx.shape, device=device).unsqueeze(-1)
         mask_1D = mask.view([mask.size(0), mask.size(1), 1, 1])
         mask_bw = mask_1D * mask_attend
         mask_fw = mask_1D * (1.0 - mask_attend)
 
         h_EXV_encoder_fw = mask_fw * h_EXV_encoder
+        mask_neighbors = neighbor_mask(mask, E_idx)
         for layer in self.decoder_layers:
-            h_V = layer(h_V, h_EXV_encoder_fw, mask)
+            h_V = layer(h_V, h_EXV_encoder_fw, mask, mask_neighbors)
 
         logits = self.W_out(h_V)
         log_probs = F.log_softmax(logits, dim=-1)
         return log_probs
+
+
+class IncrementalScorer:
+    """
+    Scores of sequences that differ from a reference sequence at a few positions.
+
+    Keeps the decoder states of every layer for the reference sequence under a
+    fixed decoding order. A mutation at position m changes the first decoder
+    layer only at the residues that have m as an earlier decoded neighbour, and
+    every further layer adds the residues with an earlier decoded neighbour
+    among the changed ones, so only these rows are decoded again. The scores are
+    the ones of a full `ProteinMPNN.forward` pass with the same ``randn``, up to
+    floating point rounding.
+
+    Parameters
+    ----------
+    model : ProteinMPNN
+        Model in eval mode.
+    encoding : dict
+        Output of `ProteinMPNN.encode` with batch size B.
+    S : torch.tensor
+        Reference sequences with shape (B, L).
+    chain_M : torch.tensor
+        1.0 for the designable, i.e. scored, residues with shape (B, L).
+    randn : torch.tensor
+        Random numbers that set the decoding order as in `ProteinMPNN.forward`,
+        with shape (B, L).
+
+    Attributes
+    ----------
+    S : torch.tensor
+        Current reference sequences.
+    scores : torch.tensor
+        `_scores` of the reference sequences over ``chain_M`` with shape (B,).
+    num_decoded : int
+        Residues times layers decoded again by the last `score` or `update` call.
+
+    Examples
+    --------
+    >>> model = ProteinMPNN(21, 16, 16, 16, k_neighbors=4, augment_eps=0.0).eval()
+    >>> X, S = torch.randn(1, 30, 4, 3), torch.randint(20, (1, 30))
+    >>> mask, randn = torch.ones(1, 30), torch.randn(1, 30)
+    >>> with torch.no_grad():
+    ...     encoding = model.encode(X, mask, torch.arange(30)[None], mask)
+    ...     scorer = IncrementalScorer(model, encoding, S, mask, randn)
+    ...     S_new = S.clone()
+    ...     S_new[0, 7] = 3
+    ...     scores = scorer.update(S_new)
+    ...     log_probs = model.decode(encoding, S_new, mask, randn)
+    >>> torch.allclose(scores, _scores(S_new, log_probs, mask))
+    True
+    >>> scorer.num_decoded < 30 * len(model.decoder_layers)
+    True
+    """
+
+    def __init__(self, model, encoding, S, chain_M, randn):
+        self.model = model
+        self.encoding = encoding
+        self.mask_for_loss = chain_M * encoding["mask"]
+        decoding_order = torch.argsort((self.mask_for_loss + 0.0001) * torch.abs(randn))
+        self.h_V_stack, self.h_EXV_encoder_fw, self.mask_bw = model._decoder_states(
+            encoding, S, decoding_order
+        )
+        self.S = S
+        self.log_probs = F.log_softmax(model.W_out(self.h_V_stack[-1]), dim=-1)
+        self.scores = _scores(S, self.log_probs, self.mask_for_loss)
+        self.num_decoded = 0
+
+    def _affected(self, S):
+        """Residues whose states in each decoder layer depend on where S changed"""
+        E_idx = self.encoding["E_idx"]
+        B, L, K = E_idx.shape
+        earlier = self.mask_bw[..., 0] > 0  # [B, L, K]
+        changed = S != self.S
+        affected = [torch.zeros_like(changed)]
+        for _ in self.model.decoder_layers:
+            source = torch.gather(changed | affected[-1], 1, E_idx.flatten(1))
+            affected.append(affected[-1] | (earlier & source.view(B, L, K)).any(-1))
+        return affected[1:]
+
+    def _rescore(self, S):
+        h_S = self.model.W_s(S)
+        h_E, E_idx = self.encoding["h_E"], self.encoding["E_idx"]
+        h_V_stack = list(self.h_V_stack)
+        self.num_decoded = 0
+        for l, (layer, affected) in enumerate(
+            zip(self.model.decoder_layers, self._affected(S), strict=False)
+        ):
+            num_affected = int(affected.sum(1).max())
+            if num_affected == 0:
+                continue
+            # Rows with fewer affected residues are padded with unaffected ones,
+            # which are decoded to the states they already have
+            t = torch.sort((~affected).byte(), dim=1, stable=True)[1][:, :num_affected]
+
+            def rows(x, t=t):
+                index = t.view(*t.shape, *[1] * (x.dim() - 2))
+                return torch.gather(x, 1, index.expand(-1, -1, *x.shape[2:]))
+
+            E_idx_t = rows(E_idx)
+            h_ES_t = cat_neighbors_nodes(h_S, rows(h_E), E_idx_t)
+            h_ESV_t = cat_neighbors_nodes(h_V_stack[l], h_ES_t, E_idx_t)
+            h_ESV_t = rows(self.mask_bw) * h_ESV_t + rows(self.h_EXV_encoder_fw)
+            mask = self.encoding["mask"]
+            h_V_t = layer(
+                rows(h_V_stack[l]), h_ESV_t, rows(mask), neighbor_mask(mask, E_idx_t)
+            )
+            h_V_stack[l + 1] = h_V_stack[l + 1].scatter(
+                1, t[:, :, None].expand(-1, -1, h_V_t.shape[-1]), h_V_t
+            )
+            self.num_decoded += t.numel()
+
+        log_probs = self.log_probs
+        if self.num_decoded > 0:
+            log_probs = log_probs.scatter(
+                1,
+                t[:, :, None].expand(-1, -1, log_probs.shape[-1]),
+                F.log_softmax(self.model.W_out(h_V_t), dim=-1),
+            )
+        scores = _scores(S, log_probs, self.mask_for_loss)
+        return scores, h_V_stack, log_probs
+
+    def score(self, S):
+        """
+        Scores of ``S`` with shape (B,), keeping the reference sequences.
+
+        ``S`` has shape (B, L) and should differ from `S` at a few positions.
+        """
+        return self._rescore(S)[0]
+
+    def update(self, S):
+        """Scores of ``S`` with shape (B,), which becomes the reference sequence."""
+        scores, self.h_V_stack, self.log_probs = self._rescore(S)
+        self.S = S
+        self.scores = scores
+        return scores
+
+
+class _DirectoryCache:
+    """
+    Directory with one subdirectory per cache key and a size limit.
+
+    Entries are written to a temporary directory and renamed into place, so runs
+    sharing the directory never see partial entries. Reading an entry updates its
+    modification time, and the least recently used entries are deleted once the
+    directory grows beyond ``max_bytes``.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+        # Least recently used entries first
+        entries = []
+        for entry in os.scandir(path):
+            if entry.is_dir() and not entry.name.startswith("tmp"):
+                entries.append((entry.stat().st_mtime, entry.name, entry.path))
+        self.entries = {
+            name: self._size(entry_path) for _, name, entry_path in sorted(entries)
+        }
+        self.num_bytes = sum(self.entries.values())
+
+    @staticmethod
+    def _size(path):
+        size = 0
+        for root, _, files in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        return size
+
+    def _touch(self, key):
+        entry = os.path.join(self.path, key)
+        os.utime(entry)
+        if key in self.entries:
+            self.entries[key] = self.entries.pop(key)
+        else:
+            # Added by another run after this one started
+            self.entries[key] = self._size(entry)
+            self.num_bytes += self.entries[key]
+
+    def _new_entry(self):
+        return tempfile.mkdtemp(prefix="tmp", dir=self.path)
+
+    def _add(self, key, tmp):
+        size = self._size(tmp)
+        try:
+            os.rename(tmp, os.path.join(self.path, key))
+        except OSError:
+            # Another run stored the same entry in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.entries[key] = size
+        self.num_bytes += size
+        while self.num_bytes > self.max_bytes and len(self.entries) > 1:
+            old = next(iter(self.entries))
+            self.num_bytes -= self.entries.pop(old)
+            shutil.rmtree(os.path.join(self.path, old), ignore_errors=True)
+
+
+class EncoderCache(_DirectoryCache):
+    """
+    On-disk cache of `ProteinMPNN.encode` outputs keyed by structure.
+
+    The encoder output only depends on the backbone coordinates, the chain layout,
+    the model weights and the backbone noise, while fixed positions, biases, omit
+    lists and temperatures only enter the decoder. Every batch row is therefore
+    looked up by a SHA-256 digest of its ``X``, ``mask``, ``residue_idx`` and
+    ``chain_encoding_all`` together with a digest of the model. An entry is a
+    directory of ``.npy`` files that are memory-mapped when they are read. When
+    the entries grow beyond ``max_bytes`` the least recently used ones are deleted.
+
+    Parameters
+    ----------
+    path : str
+        Cache directory, created if needed and shared between runs.
+    model : ProteinMPNN
+        Model with its weights loaded.
+    max_bytes : int, optional
+        Size limit of the cache directory.
+
+    Attributes
+    ----------
+    hits : int
+        Number of distinct rows that were read from the cache.
+    misses : int
+        Number of distinct rows that were encoded and added to the cache.
+
+    Examples
+    --------
+    >>> model = ProteinMPNN(21, 16, 16, 16, k_neighbors=4, augment_eps=0.0).eval()
+    >>> X = torch.randn(1, 6, 4, 3).expand(2, -1, -1, -1)
+    >>> mask = torch.ones(2, 6)
+    >>> residue_idx = torch.arange(6).expand(2, -1)
+    >>> chain_encoding_all = torch.ones(2, 6)
+    >>> cache = EncoderCache(tempfile.mkdtemp(), model)
+    >>> with torch.no_grad():
+    ...     first = cache.encode(X, mask, residue_idx, chain_encoding_all)
+    ...     second = cache.encode(X, mask, residue_idx, chain_encoding_all)
+    >>> cache.hits, cache.misses, tuple(second["h_E"].shape)
+    (1, 1, (2, 6, 4, 16))
+    >>> torch.equal(first["h_E"], second["h_E"])
+    True
+    """
+
+    keys = ("h_V", "h_E", "E_idx")
+
+    def __init__(self, path, model, max_bytes=10 * 2**30):
+        super().__init__(path, max_bytes)
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+
+        digest = hashlib.sha256()
+        features = model.features
+        digest.update(
+            repr(
+                (
+                    type(features).__name__,
+                    features.top_k,
+                    features.augment_eps,
+                    model.factorized,
+                )
+            ).encode()
+        )
+        for name, tensor in model.state_dict().items():
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().numpy().tobytes())
+        self.model_digest = digest.digest()
+
+    def row_key(self, X, mask, residue_idx, chain_encoding_all):
+        """Hex digest that identifies the encoding of a single batch row."""
+        digest = hashlib.sha256(self.model_digest)
+        for tensor in (X, mask, residue_idx, chain_encoding_all):
+            array = tensor.detach().cpu().numpy()
+            digest.update(repr((array.shape, array.dtype.str)).encode())
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    def _load(self, key, device):
+        entry = os.path.join(self.path, key)
+        try:
+            encoding = {
+                k: torch.from_numpy(
+                    np.load(os.path.join(entry, k + ".npy"), mmap_mode="c")
+                ).to(device)
+                for k in self.keys
+            }
+            self._touch(key)
+        except (OSError, ValueError):
+            return None
+        return encoding
+
+    def _store(self, key, encoding):
+        tmp = self._new_entry()
+        for k in self.keys:
+            np.save(os.path.join(tmp, k + ".npy"), encoding[k].cpu().numpy())
+        self._add(key, tmp)
+
+    def encode(self, X, mask, residue_idx, chain_encoding_all):
+        """
+        Same as `ProteinMPNN.encode`, reading and storing one entry per distinct row.
+
+        Rows that are copies of each other, as produced by ``tied_featurize`` with
+        ``num_copies > 1``, are looked up and encoded once. With backbone noise
+        the cache is bypassed, since every call perturbs the backbone differently.
+        """
+        if self.model.features.augment_eps > 0:
+            return self.model.encode(X, mask, residue_idx, chain_encoding_all)
+
+        inputs = (X, mask, residue_idx, chain_encoding_all)
+        row_keys = [self.row_key(*(x[b] for x in inputs)) for b in range(X.shape[0])]
+        unique_keys = list(dict.fromkeys(row_keys))
+        rows = {key: [] for key in unique_keys}
+        for b, key in enumerate(row_keys):
+            rows[key].append(b)
+
+        encodings = {key: self._load(key, X.device) for key in unique_keys}
+        missing = [key for key in unique_keys if encodings[key] is None]
+        self.hits += len(unique_keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            first_rows = torch.tensor(
+                [rows[key][0] for key in missing], device=X.device
+            )
+            encoding = self.model.encode(*(x[first_rows] for x in inputs))
+            for i, key in enumerate(missing):
+                encodings[key] = {k: encoding[k][i] for k in self.keys}
+                self._store(key, encodings[key])
+
+        if len(unique_keys) == 1:
+            (encoding,) = encodings.values()
+            batch = {
+                k: v.unsqueeze(0).expand(X.shape[0], *v.shape)
+                for k, v in encoding.items()
+            }
+        else:
+            order = torch.tensor(
+                [unique_keys.index(key) for key in row_keys], device=X.device
+            )
+            batch = {
+                k: torch.stack([encodings[key][k] for key in unique_keys])[order]
+                for k in self.keys
+            }
+        batch["mask"] = mask
+        return batch
+
+
+class ResultCache(_DirectoryCache):
+    """
+    On-disk cache of the files written by a run, keyed by its inputs.
+
+    With a fixed seed a run is a pure function of its options, input files and
+    model weights. `key` hashes a JSON-serializable description of these, and an
+    entry holds a copy of every file the run created or changed in the
+    subfolders of ``OUTPUT_DIRS``, so an identical run can be answered by copying
+    the files back. Other files in the output folder, e.g. logs of a wrapper
+    script, are never cached.
+
+    Parameters
+    ----------
+    path : str
+        Cache directory, created if needed and shared between runs.
+    max_bytes : int, optional
+        Size limit of the cache directory.
+
+    Examples
+    --------
+    >>> cache = ResultCache(tempfile.mkdtemp())
+    >>> key = cache.key({"seed": 37, "jsonl_path": "0f3c"})
+    >>> out, again = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> cache.restore(key, out)
+    False
+    >>> before = cache.snapshot(out)
+    >>> os.makedirs(os.path.join(out, "seqs"))
+    >>> with open(os.path.join(out, "seqs", "toy.fa"), "w") as f:
+    ...     _ = f.write(">toy\\nGAW\\n")
+    >>> with open(os.path.join(out, "run.log"), "w") as f:
+    ...     _ = f.write("not an output\\n")
+    >>> cache.store(key, out, before)
+    >>> cache.restore(key, again)
+    True
+    >>> open(os.path.join(again, "seqs", "toy.fa")).read()
+    '>toy\\nGAW\\n'
+    >>> os.listdir(again)
+    ['seqs']
+    """
+
+    # Subfolders of the output folder that main() writes to
+    OUTPUT_DIRS = (
+        "seqs",
+        "scores",
+        "probs",
+        "score_only",
+        "conditional_probs_only",
+        "unconditional_probs_only",
+        "mutational_scan",
+    )
+
+    def __init__(self, path, max_bytes=10 * 2**30):
+        super().__init__(path, max_bytes)
+
+    @staticmethod
+    def key(inputs):
+        """Hex digest of ``inputs`` serialized as JSON with sorted keys."""
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def path_digest(path):
+        """
+        Hex digest of the contents of a file or of all files below a directory.
+
+        Returns None if ``path`` does not exist, e.g. for unset optional inputs.
+        """
+        if not path or not os.path.exists(path):
+            return None
+        digest = hashlib.sha256()
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.relpath(os.path.join(root, f), path)
+                for root, _, names in os.walk(path)
+                for f in names
+            )
+        else:
+            files = [""]
+        for name in files:
+            digest.update(name.encode() + b"\0")
+            with open(os.path.join(path, name) if name else path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    @classmethod
+    def snapshot(cls, folder):
+        """
+        Directories in the ``OUTPUT_DIRS`` of ``folder``, and size and mtime of the
+        files in them.
+        """
+        files = {}
+        for output_dir in cls.OUTPUT_DIRS:
+            for root, _, names in os.walk(os.path.join(folder, output_dir)):
+                files[os.path.relpath(root, folder)] = None
+                for name in names:
+                    stat = os.stat(os.path.join(root, name))
+                    rel = os.path.relpath(os.path.join(root, name), folder)
+                    files[rel] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def restore(self, key, folder):
+        """Copy the files of entry ``key`` into ``folder``; False if it is missing."""
+        entry = os.path.join(self.path, key)
+        if not os.path.isdir(entry):
+            return False
+        try:
+            shutil.copytree(entry, folder, dirs_exist_ok=True)
+            self._touch(key)
+        except OSError:
+            return False
+        return True
+
+    def store(self, key, folder, before):
+        """
+        Add the output files created or changed in ``folder`` since ``before``.
+
+        ``before`` is a `snapshot` of ``folder`` taken when the run started, and the
+        entry is stored as ``key``.
+        """
+        tmp = self._new_entry()
+        for rel, stat in self.snapshot(folder).items():
+            if stat is None:
+                if rel not in before:
+                    os.makedirs(os.path.join(tmp, rel), exist_ok=True)
+            elif before.get(rel) != stat:
+                os.makedirs(os.path.dirname(os.path.join(tmp, rel)), exist_ok=True)
+                shutil.copyfile(os.path.join(folder, rel), os.path.join(tmp, rel))
+        self._add(key, tmp)